@@ -0,0 +1,321 @@
+import argparse
+import bz2
+import contextlib
+import gzip
+import io
+import json
+import lzma
+import os
+import platform
+import resource
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import zipfile
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from ride_data import AppDB, QueryCache
+
+GENERATE_CHUNK_SIZE = 200_000
+COMPRESSED_OPENERS = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+BENCH_REPEAT = 5
+REGRESSION_TOLERANCE = 0.25
+# flow_trips seconds per million trips the origin destination flows are expected to stay under
+FLOW_TRIPS_TARGET_SECONDS = 1.0
+
+# share of checkouts per hour of day, commuting peaks and an afternoon leisure bump
+HOURLY_WEIGHTS = np.array(
+    [1, 0.5, 0.3, 0.2, 0.3, 1, 3, 6, 7, 4, 4, 5, 6, 6, 6, 7, 9, 10, 8, 6, 4, 3, 2, 1.5],
+)
+MEMBERSHIP_TYPES = np.array(["Annual", "Monthly", "Pay Per Ride", "Day Pass", ""], dtype=object)
+MEMBERSHIP_WEIGHTS = np.array([0.35, 0.15, 0.3, 0.15, 0.05])
+USER_ROLES = np.array(["Member", "Customer", "Maintenance"], dtype=object)
+USER_CITIES = np.array(["Des Moines", "West Des Moines", "Ankeny", "Urbandale", ""], dtype=object)
+PROGRAM_NAME = "Des Moines BCycle"
+RANGE_QUERY = (
+    "SELECT CheckoutKioskName, COUNT(*) AS trips, AVG(DurationMins) AS duration "
+    "FROM {table} GROUP BY CheckoutKioskName;"
+)
+
+
+class TripGenerator:
+    """
+    Writes synthetic BCycle format trip reports, with every AppDB.csv_fields() column
+    """
+
+    def __init__(
+        self,
+        kiosks: int = 60,
+        bikes: int = 800,
+        users: int = 40_000,
+        start_date: str = "2024-01-01",
+        days: int = 365,
+        first_trip_id: int = 30_000_000,
+        seed: int = 0,
+    ) -> None:
+        self.kiosks = kiosks
+        self.bikes = bikes
+        self.users = users
+        self.start = np.datetime64(start_date, "s")
+        self.days = days
+        self.first_trip_id = first_trip_id
+        self.rng = np.random.default_rng(seed)
+
+        self.kiosk_names = np.array([f"Kiosk {number:03d}" for number in range(1, kiosks + 1)], dtype=object)
+        popularity = 1 / np.arange(1, kiosks + 1) ** 0.8
+        self.kiosk_weights = popularity / popularity.sum()
+        self.bike_names = np.array([str(number) for number in range(10_000, 10_000 + bikes)], dtype=object)
+        self.bike_types = np.where(np.arange(bikes) < bikes * 0.3, "E-Bike", "Standard").astype(object)
+        self.hour_weights = HOURLY_WEIGHTS / HOURLY_WEIGHTS.sum()
+        self.time_strings = np.array(
+            [f"{each // 3600:02d}:{each // 60 % 60:02d}:{each % 60:02d}" for each in range(86_400)], dtype=object
+        )
+
+    def date_strings(self, day_numbers: np.ndarray) -> np.ndarray:
+        dates = (self.start.astype("datetime64[D]") + np.arange(day_numbers.max() + 1)).astype(str).astype(object)
+        return dates[day_numbers]
+
+    def trips(self, first_row: int, rows: int, total_rows: int) -> pd.DataFrame:
+        """
+        Trips first_row to first_row + rows of a total_rows report, checkouts in time and TripId order
+        """
+        rng = self.rng
+        positions = np.arange(first_row, first_row + rows)
+        checkout = (
+            positions * self.days // total_rows * 86_400
+            + rng.choice(24, rows, p=self.hour_weights) * 3600
+            + rng.integers(0, 3600, rows)
+        )
+        checkout.sort()
+        duration_secs = np.clip(rng.lognormal(np.log(12 * 60), 0.8, rows), 8, 6 * 3600).astype(np.int64)
+        duration_mins = np.round(duration_secs / 60, 2)
+        returned = checkout + duration_secs
+
+        checkout_kiosk = rng.choice(self.kiosks, rows, p=self.kiosk_weights)
+        round_trip = rng.random(rows) < 0.2
+        return_kiosk = np.where(round_trip, checkout_kiosk, rng.choice(self.kiosks, rows, p=self.kiosk_weights))
+        bike = rng.integers(0, self.bikes, rows)
+        membership = rng.choice(len(MEMBERSHIP_TYPES), rows, p=MEMBERSHIP_WEIGHTS)
+        members = membership < 2
+        fee = np.where(members, 0.0, 3 + 0.25 * np.maximum(0, np.ceil(duration_mins - 30)))
+        distance = np.round(duration_mins * rng.uniform(0.08, 0.2, rows), 2)
+
+        return pd.DataFrame(
+            {
+                "TripId": self.first_trip_id + positions,
+                "UserProgramName": PROGRAM_NAME,
+                "UserId": rng.integers(1_000_000, 1_000_000 + self.users, rows),
+                "UserRole": USER_ROLES[np.where(members, 0, rng.choice(3, rows, p=[0.1, 0.88, 0.02]))],
+                "UserCity": USER_CITIES[rng.integers(0, len(USER_CITIES), rows)],
+                "UserState": "IA",
+                "UserZip": rng.integers(50_000, 50_400, rows).astype(str),
+                "UserCountry": "UNITED STATES",
+                "MembershipType": MEMBERSHIP_TYPES[membership],
+                "Bike": self.bike_names[bike],
+                "BikeType": self.bike_types[bike],
+                "CheckoutKioskName": self.kiosk_names[checkout_kiosk],
+                "ReturnKioskName": self.kiosk_names[return_kiosk],
+                "DurationMins": duration_mins,
+                "AdjustedDurationMins": duration_mins,
+                "UsageFee": fee,
+                "AdjustmentFlag": "N",
+                "Distance": distance,
+                "EstimatedCarbonOffset": np.round(distance * 0.9, 2),
+                "EstimatedCaloriesBurned": np.round(distance * 48, 1),
+                "CheckoutDateLocal": self.date_strings(checkout // 86_400),
+                "ReturnDateLocal": self.date_strings(returned // 86_400),
+                "CheckoutTimeLocal": self.time_strings[checkout % 86_400],
+                "ReturnTimeLocal": self.time_strings[returned % 86_400],
+                "TripOver30Mins": np.where(duration_mins > 30, "Y", "N"),
+                "LocalProgramFlag": "Y",
+                "TripRouteCategory": np.where(return_kiosk == checkout_kiosk, "Round Trip", "One Way"),
+                "TripProgramName": PROGRAM_NAME,
+            },
+            columns=AppDB.csv_fields(),
+        )
+
+    def write_report(self, path: str, rows: int, chunk_size: int = GENERATE_CHUNK_SIZE) -> int:
+        """
+        Write a rows long report, chunk_size rows at a time through one handle. Compressed when the path ends
+        in .gz, .bz2 or .xz, a .zip path is an archive of one csv member named after it
+        """
+        extension = os.path.splitext(path)[1].lower()
+        with contextlib.ExitStack() as stack:
+            if extension == ".zip":
+                archive = stack.enter_context(zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED))
+                member = os.path.splitext(os.path.basename(path))[0]
+                member += "" if member.lower().endswith(".csv") else ".csv"
+                binary = stack.enter_context(archive.open(member, "w", force_zip64=True))
+            else:
+                binary = stack.enter_context(COMPRESSED_OPENERS.get(extension, open)(path, "wb"))
+            output = stack.enter_context(io.TextIOWrapper(binary, encoding="utf-8", newline=""))
+            for first_row in range(0, rows, chunk_size):
+                df = self.trips(first_row, min(chunk_size, rows - first_row), rows)
+                df.to_csv(output, index=False, header=first_row == 0)
+        return rows
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1 << 20 if sys.platform == "darwin" else 1 << 10), 1)
+
+
+def timed(function, repeat: int = 1) -> float:
+    """
+    Median wall time of repeat calls
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def run_benchmarks(rows: int, work_dir: str, repeat: int = BENCH_REPEAT, **generator_options) -> dict:
+    """
+    Generate a report of rows trips and time importing it, db_stats, date range queries and every report,
+    without the query cache, then the repeated db_stats and reports from the cache
+    """
+    report_path = os.path.join(work_dir, "bench_report.csv")
+    db_path = os.path.join(work_dir, "bench.db")
+    generator = TripGenerator(**generator_options)
+    generate_seconds = timed(lambda: generator.write_report(report_path, rows))
+
+    app_db = AppDB(db_path)
+    app_db.init_db()
+    app_db.query_cache = None
+    results = {"generate": {"seconds": round(generate_seconds, 4)}}
+
+    import_seconds = timed(lambda: app_db.import_report_to_db(report_path))
+    results["import"] = {"seconds": round(import_seconds, 4), "rows_per_sec": round(rows / import_seconds)}
+    results["import"]["peak_rss_mb"] = peak_rss_mb()
+
+    results["db_stats"] = {"seconds": round(timed(app_db.db_stats, repeat), 6)}
+    results["db_stats_rebuild"] = {"seconds": round(timed(lambda: app_db.db_stats(rebuild=True), repeat), 4)}
+
+    first_day = str(generator.start.astype("datetime64[D]") + generator.days // 3)
+    last_day = str(generator.start.astype("datetime64[D]") + generator.days // 3 + 30)
+    app_db.set_date_range(first_day, last_day)
+    results["date_range_view"] = {
+        "seconds": round(timed(lambda: app_db.query_range(RANGE_QUERY, materialize=False), repeat), 4)
+    }
+    results["date_range_materialize"] = {
+        "seconds": round(timed(lambda: app_db.query_range(RANGE_QUERY, materialize=True)), 4)
+    }
+    results["date_range_working_set"] = {"seconds": round(timed(lambda: app_db.query_range(RANGE_QUERY), repeat), 4)}
+
+    for name in app_db.report_definitions():
+        results[f"report_{name}"] = {"seconds": round(timed(lambda: app_db.rollup_report(name), repeat), 6)}
+    results["flow_trips"] = {"seconds": round(timed(lambda: app_db.flow_trips(None, None), repeat), 4)}
+    results["flow_trips"]["target_seconds"] = round(FLOW_TRIPS_TARGET_SECONDS * rows / 1_000_000, 4)
+    results["flow_trips"]["on_target"] = results["flow_trips"]["seconds"] <= results["flow_trips"]["target_seconds"]
+    for exact in (False, True):
+        results[f"sketch_kiosk_month{'_exact' if exact else ''}"] = {
+            "seconds": round(timed(lambda: app_db.sketch_report(("KioskName", "Month"), exact=exact), repeat), 4)
+        }
+
+    app_db.query_cache = QueryCache()
+    app_db.db_stats()
+    results["db_stats_cached"] = {"seconds": round(timed(app_db.db_stats, repeat), 6)}
+    names = list(app_db.report_definitions())
+    [app_db.rollup_report(name) for name in names]
+    results["reports_cached"] = {
+        "seconds": round(timed(lambda: [app_db.rollup_report(name) for name in names], repeat), 6)
+    }
+    if app_db.session_conn is not None:
+        app_db.session_conn.close()
+    return {
+        "rows": rows,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "peak_rss_mb": peak_rss_mb(),
+        "results": results,
+    }
+
+
+def compare_baseline(current: dict, baseline: dict, tolerance: float = REGRESSION_TOLERANCE) -> list:
+    """
+    Benchmarks more than tolerance slower than the baseline, skipped when the row counts differ
+    """
+    if current["rows"] != baseline["rows"]:
+        print(f"# Baseline row count {baseline['rows']:,} does not match {current['rows']:,}, not compared")
+        return []
+    regressions = []
+    for name, result in current["results"].items():
+        previous = baseline["results"].get(name, {}).get("seconds")
+        if "seconds" not in result or not previous:
+            continue
+        if result["seconds"] > previous * (1 + tolerance):
+            regressions.append(
+                {
+                    "name": name,
+                    "seconds": result["seconds"],
+                    "baseline_seconds": previous,
+                    "change": round(result["seconds"] / previous - 1, 3),
+                }
+            )
+    return regressions
+
+
+def bench_args() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Ride data trip generator and benchmarks")
+    commands = parser.add_subparsers(dest="command", metavar="command", required=True)
+
+    generate_parser = commands.add_parser("generate", help="write a synthetic trip report")
+    generate_parser.add_argument("output", help="report path, .csv or compressed .csv.gz")
+    generate_parser.add_argument("--rows", type=int, default=10_000, help="number of trips")
+
+    run_parser = commands.add_parser("run", help="run the benchmark suite")
+    run_parser.add_argument("--rows", type=int, default=100_000, help="number of trips")
+    run_parser.add_argument("--repeat", type=int, default=BENCH_REPEAT, help="runs per timed query")
+    run_parser.add_argument("--output", help="write results JSON to this path")
+    run_parser.add_argument("--baseline", help="baseline results JSON to compare against")
+    run_parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE, help="allowed slowdown")
+
+    for each in (generate_parser, run_parser):
+        each.add_argument("--kiosks", type=int, default=60, help="number of kiosks")
+        each.add_argument("--bikes", type=int, default=800, help="number of bikes")
+        each.add_argument("--users", type=int, default=40_000, help="number of riders")
+        each.add_argument("--start-date", default="2024-01-01", help="first checkout day, YYYY-MM-DD")
+        each.add_argument("--days", type=int, default=365, help="days of trips")
+        each.add_argument("--seed", type=int, default=0, help="random seed")
+    return parser
+
+
+def run(argv: Optional[list] = None) -> int:
+    args = bench_args().parse_args(argv)
+    generator_options = {
+        "kiosks": args.kiosks,
+        "bikes": args.bikes,
+        "users": args.users,
+        "start_date": args.start_date,
+        "days": args.days,
+        "seed": args.seed,
+    }
+    if args.command == "generate":
+        TripGenerator(**generator_options).write_report(args.output, args.rows)
+        print(f"# Wrote {args.rows:,} trips to '{args.output}'")
+        return 0
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        current = run_benchmarks(args.rows, work_dir, args.repeat, **generator_options)
+    if args.baseline:
+        with open(args.baseline) as fopen:
+            current["regressions"] = compare_baseline(current, json.load(fopen), args.tolerance)
+    if args.output:
+        with open(args.output, "w") as fopen:
+            json.dump(current, fopen, indent=2)
+    print(json.dumps(current, indent=2))
+    return int(bool(current.get("regressions")))
+
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -1,278 +1,3704 @@
+from __future__ import annotations
+
 import pathlib
 import argparse
+import calendar
+import contextlib
+import csv
+import functools
+import glob
+import hashlib
+import itertools
+import json
 import os
 import re
 
-# import csv
 import sqlite3
 import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
 from sqlite3 import Connection
-from typing import Optional
+from typing import TYPE_CHECKING, Iterator, Optional
+
+if TYPE_CHECKING:
+    # pandas is imported on the import and analytics paths only, it dominates startup time
+    import numpy as np
+    import pandas as pd
+    import pyarrow.dataset as ds
+
+DB_NAME = "ridedb.db"
+# result set column names of AppDB.dict_factory, by cursor description
+ROW_FIELDS = {}
+IMPORT_CHUNK_SIZE = 50_000
+REPORT_PATTERNS = ("*.csv", "*.csv.gz", "*.csv.zip", "*.zip")
+COMPRESSED_SUFFIXES = (".gz", ".zip", ".bz2", ".xz", ".zst")
+HASH_BLOCK_SIZE = 1 << 20
+RANGE_VIEW = "ride_range"
+RANGE_TABLE = "ride_range_set"
+MATERIALIZE_AFTER = 3
+DELETE_BATCH_SIZE = 20_000
+EXPORT_BATCH_SIZE = 10_000
+ARCHIVE_BATCH_SIZE = 100_000
+DENSE_FLOW_CELLS = 4_000_000
+FLOW_CACHE_SIZE = 8
+TIMELINE_SCAN_FRACTION = 0.25
+QUERY_CACHE_BYTES = 32 << 20
+QUERY_DISK_CACHE_BYTES = 256 << 20
+READ_POOL_SIZE = 4
+SHARD_PERIODS = {"year": 12, "month": 1}
+UNDATED_SHARD = "undated"
+SHARD_ATTACH_BATCH = 9
+SKETCH_PRECISION = 12
+SKETCH_ACCURACY = 0.01
+SKETCH_QUANTILES = (0.5, 0.95)
+SKETCH_GROUPS = ("Day", "Month", "KioskName", "MembershipType")
+SKETCH_BATCH_DAYS = 31
+VACUUM_STEP_PAGES = 2_000
+SLOW_QUERY_SECS = 0.1
+PLANNED_STATEMENTS = ("SELECT", "WITH", "INSERT", "REPLACE", "UPDATE", "DELETE")
+
+
+class Tracer:
+    """
+    Collects per stage timings and row counts and AppDB query timings, appended to a JSON lines trace file.
+    Slow queries are recorded with their EXPLAIN QUERY PLAN
+    """
+
+    def __init__(self, path: str, slow_query_secs: float = SLOW_QUERY_SECS) -> None:
+        self.path = path
+        self.slow_query_secs = slow_query_secs
+        self.run_id = f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+        self.totals = {}
+
+    def write(self, record: dict) -> None:
+        record = {"run": self.run_id, "time": time.strftime("%Y-%m-%d %H:%M:%S"), **record}
+        with open(self.path, "a") as fopen:
+            fopen.write(json.dumps(record, default=str) + "\n")
+
+    def add(self, stage: str, seconds: float, rows: int = 0, **fields) -> None:
+        """
+        Count a finished stage in the totals and the trace file
+        """
+        total = self.totals.setdefault(stage, {"calls": 0, "seconds": 0.0, "rows": 0})
+        total["calls"] += 1
+        total["seconds"] += seconds
+        total["rows"] += rows
+        self.write({"event": "stage", "stage": stage, "seconds": round(seconds, 6), "rows": rows, **fields})
+
+    @contextlib.contextmanager
+    def stage(self, stage: str, **fields) -> Iterator[dict]:
+        """
+        Time the body as a stage, set 'rows' on the yielded dict to record a row count
+        """
+        span = dict(fields)
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            self.add(stage, time.perf_counter() - start, **span)
+
+    def take_totals(self) -> dict:
+        """
+        Stage totals since the last call
+        """
+        totals, self.totals = self.totals, {}
+        return {stage: {**total, "seconds": round(total["seconds"], 4)} for stage, total in totals.items()}
+
+    def query(self, conn: Connection, sql: str, parameters, seconds: float) -> None:
+        record = {"event": "query", "sql": " ".join(sql.split()), "seconds": round(seconds, 6)}
+        if seconds >= self.slow_query_secs:
+            record["slow"] = True
+            if sql.lstrip().upper().startswith(PLANNED_STATEMENTS):
+                try:
+                    plan = sqlite3.Connection.execute(conn, f"EXPLAIN QUERY PLAN {sql}", parameters).fetchall()
+                    record["plan"] = [row["detail"] for row in plan]
+                except sqlite3.Error as e:
+                    record["plan_error"] = str(e)
+            print(f"# Slow query {seconds:.3f}s | {record['sql'][:120]}")
+        self.write(record)
+
+
+class TracedConnection(sqlite3.Connection):
+    """
+    Connection reporting each execute to a Tracer, executemany calls are timed by the import stages
+    """
+
+    tracer: Optional[Tracer] = None
+
+    def execute(self, sql: str, parameters=(), /):
+        start = time.perf_counter()
+        cursor = super().execute(sql, parameters)
+        if self.tracer is not None:
+            self.tracer.query(self, sql, parameters, time.perf_counter() - start)
+        return cursor
+
+
+class QueryCache:
+    """
+    Least recently used query results within a memory budget, keyed on the database path, normalized SQL,
+    parameters, the database data version and the random id the database was created with, so a result is never
+    served once newer data has landed, nor from an earlier database recreated at the same path. Results are sized
+    by their JSON encoding. With a path, results are also kept in a sqlite file within its own budget, the
+    on disk tier, which outlives the process
+    """
+
+    def __init__(
+        self, max_bytes: int = QUERY_CACHE_BYTES, path: Optional[str] = None, disk_bytes: int = QUERY_DISK_CACHE_BYTES
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.disk_bytes = disk_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = self.misses = 0
+        self.versions = {}
+        self.disk = None
+        if path is not None:
+            self.disk = sqlite3.connect(path, isolation_level=None)
+            columns = [each[1] for each in self.disk.execute("PRAGMA table_info(query_cache);").fetchall()]
+            if columns and "DatabaseId" not in columns:
+                # a cache file from before database ids, its results can not be told apart
+                self.disk.execute("DROP TABLE query_cache;")
+            self.disk.execute(
+                "CREATE TABLE IF NOT EXISTS query_cache ("
+                "`Key` TEXT PRIMARY KEY,`Database` TEXT,`DatabaseId` TEXT,`Version` INTEGER,`Bytes` INTEGER,"
+                "`Used` REAL,`Rows` TEXT"
+                ");"
+            )
+
+    @staticmethod
+    def key(database: str, sql: str, params: tuple, version: int, database_id: str = "") -> tuple:
+        return (
+            os.path.abspath(database),
+            " ".join(sql.split()),
+            json.dumps(list(params), default=str),
+            version,
+            database_id,
+        )
+
+    @staticmethod
+    def disk_key(key: tuple) -> str:
+        return hashlib.sha1(json.dumps(key).encode()).hexdigest()
+
+    def expire(self, database: str, version: int, database_id: str = "") -> None:
+        """
+        Drop the results of a database's older data versions, and of any other database once at its path
+        """
+        if self.versions.get(database) == (version, database_id):
+            return
+        self.versions[database] = (version, database_id)
+        for key in [each for each in self.entries if each[0] == database and each[3:] != (version, database_id)]:
+            self.bytes -= self.entries.pop(key)[1]
+        if self.disk is not None:
+            self.disk.execute(
+                "DELETE FROM query_cache WHERE Database = ? AND (Version != ? OR DatabaseId != ?);",
+                (database, version, database_id),
+            )
+
+    def get(self, key: tuple) -> Optional[list]:
+        self.expire(key[0], key[3], key[4])
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
+        if self.disk is not None:
+            disk_key = self.disk_key(key)
+            row = self.disk.execute("SELECT Rows FROM query_cache WHERE Key = ?;", (disk_key,)).fetchone()
+            if row is not None:
+                self.disk.execute("UPDATE query_cache SET Used = ? WHERE Key = ?;", (time.time(), disk_key))
+                rows = json.loads(row[0])
+                self.hits += 1
+                self.put(key, rows, encoded=row[0], disk=False)
+                return rows
+        self.misses += 1
+        return None
+
+    def put(self, key: tuple, rows: list, encoded: Optional[str] = None, disk: bool = True) -> None:
+        encoded = encoded or json.dumps(rows, default=str)
+        if key in self.entries:
+            self.bytes -= self.entries.pop(key)[1]
+        if len(encoded) <= self.max_bytes:
+            self.entries[key] = (rows, len(encoded))
+            self.bytes += len(encoded)
+            while self.bytes > self.max_bytes:
+                self.bytes -= self.entries.popitem(last=False)[1][1]
+        if disk and self.disk is not None and len(encoded) <= self.disk_bytes:
+            self.disk.execute(
+                "REPLACE INTO query_cache VALUES (?, ?, ?, ?, ?, ?, ?);",
+                (self.disk_key(key), key[0], key[4], key[3], len(encoded), time.time(), encoded),
+            )
+            self.disk.execute(
+                "DELETE FROM query_cache WHERE Key IN (SELECT Key FROM (SELECT Key, SUM(Bytes) OVER "
+                "(ORDER BY Used DESC, Key) AS kept FROM query_cache) WHERE kept > ?);",
+                (self.disk_bytes,),
+            )
+
+    def stats(self) -> dict:
+        return {"entries": len(self.entries), "bytes": self.bytes, "hits": self.hits, "misses": self.misses}
+
+
+class FlowMatrix:
+    """
+    Trip counts by checkout weekday, checkout hour, checkout kiosk and return kiosk, counted in one vectorized
+    pass over integer kiosk codes. Held as a dense array when it has at most DENSE_FLOW_CELLS cells,
+    otherwise as its sorted non zero cells
+    """
+
+    def __init__(self, kiosks: list, origins: np.ndarray, destinations: np.ndarray, epochs: np.ndarray) -> None:
+        import numpy as np
+
+        self.kiosks = list(kiosks)
+        self.trips = len(epochs)
+        size = len(self.kiosks)
+        # 1970-01-01 was a Thursday, weekday 0 is Monday
+        slots = (epochs // 86400 + 3) % 7 * 24 + epochs // 3600 % 24
+        keys = (slots * size + origins) * size + destinations
+        self.shape = (7, 24, size, size)
+        if 7 * 24 * size * size <= DENSE_FLOW_CELLS:
+            self.counts = np.bincount(keys, minlength=7 * 24 * size * size).reshape(self.shape)
+            self.cells = self.cell_counts = None
+        else:
+            self.counts = None
+            self.cells, self.cell_counts = np.unique(keys, return_counts=True)
+
+    def matrix(self, weekday: Optional[int] = None, hour: Optional[int] = None) -> np.ndarray:
+        """
+        Checkout kiosk by return kiosk trip counts, for one weekday (0 is Monday) and or checkout hour, all by default
+        """
+        import numpy as np
+
+        size = len(self.kiosks)
+        if self.counts is not None:
+            cube = self.counts if weekday is None else self.counts[weekday : weekday + 1]
+            cube = cube if hour is None else cube[:, hour : hour + 1]
+            return cube.sum(axis=(0, 1))
+
+        slots, pairs = np.divmod(self.cells, size * size)
+        keep = np.ones(len(self.cells), dtype=bool)
+        if weekday is not None:
+            keep &= slots // 24 == weekday
+        if hour is not None:
+            keep &= slots % 24 == hour
+        counts = np.bincount(pairs[keep], weights=self.cell_counts[keep], minlength=size * size)
+        return counts.astype(np.int64).reshape(size, size)
+
+    def net_flows(self, weekday: Optional[int] = None, hour: Optional[int] = None) -> list:
+        """
+        Per kiosk trips out, trips in and net inflow, kiosks losing the most bikes first
+        """
+        matrix = self.matrix(weekday, hour)
+        outflow, inflow = matrix.sum(axis=1), matrix.sum(axis=0)
+        rows = [
+            {"KioskName": kiosk, "Outflow": int(out), "Inflow": int(into), "Net": int(into - out)}
+            for kiosk, out, into in zip(self.kiosks, outflow, inflow)
+            if out or into
+        ]
+        return sorted(rows, key=lambda row: (row["Net"], row["KioskName"]))
+
+
+class BikeTimeline:
+    """
+    Per bike ride time, idle gaps between rides and the kiosks bikes sat idle at, computed with array operations
+    over the trips sorted once by bike and checkout epoch. A trip checked out before the bike's latest earlier
+    return is flagged 'overlap', one without a return or returned before its checkout is flagged 'impossible'
+    and counts no ride time. A timeline of appended trips continues from each bike's previous latest return
+    and return kiosk, its rows add to the bike's earlier rows
+    """
+
+    def __init__(
+        self,
+        bikes: list,
+        kiosks: list,
+        trip_ids: np.ndarray,
+        bike_codes: np.ndarray,
+        checkouts: np.ndarray,
+        returns: np.ndarray,
+        return_kiosks: np.ndarray,
+        previous_returns: Optional[np.ndarray] = None,
+        previous_kiosks: Optional[np.ndarray] = None,
+    ) -> None:
+        """
+        Codes index bikes and kiosks, missing returns are -1. The previous arrays are by bike code, -1 for none
+        """
+        import numpy as np
+
+        self.bikes, self.kiosks = list(bikes), list(kiosks)
+        order = np.lexsort((trip_ids, checkouts, bike_codes))
+        self.trip_ids, self.codes = trip_ids[order], bike_codes[order]
+        self.checkouts, returns, return_kiosks = checkouts[order], returns[order], return_kiosks[order]
+        self.return_kiosks = return_kiosks
+        self.impossible = returns < self.checkouts
+        self.returns = np.where(self.impossible, self.checkouts, returns)
+        self.ride_secs = self.returns - self.checkouts
+
+        self.starts = np.flatnonzero(np.diff(self.codes, prepend=-1))
+        first = np.zeros(len(self.codes), dtype=bool)
+        first[self.starts] = True
+        # running latest return, shifting each bike's epochs above the previous bike's restarts it per bike
+        shift = self.codes * (1 << 34)
+        latest = np.maximum.accumulate(self.returns + shift) - shift
+        before, before_kiosks = np.roll(latest, 1), np.roll(return_kiosks, 1)
+        before[first] = -1
+        if previous_returns is not None:
+            before = np.maximum(before, previous_returns[self.codes])
+            before_kiosks[first] = previous_kiosks[self.codes[first]]
+        self.gaps = np.flatnonzero(before >= 0)
+        self.gap_kiosks = before_kiosks[self.gaps]
+        waits = self.checkouts[self.gaps] - before[self.gaps]
+        self.overlap = np.zeros(len(self.codes), dtype=bool)
+        self.overlap[self.gaps] = waits < 0
+        self.idle_secs = np.zeros(len(self.codes), dtype=np.int64)
+        self.idle_secs[self.gaps] = np.maximum(waits, 0)
+
+    def bike_rows(self) -> list:
+        """
+        (Bike, Trips, RideSecs, IdleSecs, MaxIdleSecs, FirstCheckout, LastCheckout, LastReturn, Utilization,
+        Overlaps, Impossible, LastKioskName) per bike. Utilization is ride time over the span from first checkout
+        to last return, LastKioskName is where the bike was last returned
+        """
+        import numpy as np
+
+        if not len(self.codes):
+            return []
+        size = len(self.bikes)
+        trips = np.bincount(self.codes, minlength=size)
+        ride = np.bincount(self.codes, weights=self.ride_secs, minlength=size)
+        idle = np.bincount(self.codes, weights=self.idle_secs, minlength=size)
+        overlaps = np.bincount(self.codes, weights=self.overlap, minlength=size)
+        impossible = np.bincount(self.codes, weights=self.impossible, minlength=size)
+        max_idle = np.maximum.reduceat(self.idle_secs, self.starts)
+        last_return = np.maximum.reduceat(self.returns, self.starts)
+        ends = np.append(self.starts[1:], len(self.codes)) - 1
+        span = last_return - self.checkouts[self.starts]
+        rows = []
+        for position, code in enumerate(self.codes[self.starts]):
+            utilization = round(float(ride[code] / span[position]), 4) if span[position] > 0 else None
+            rows.append(
+                (
+                    self.bikes[code],
+                    int(trips[code]),
+                    int(ride[code]),
+                    int(idle[code]),
+                    int(max_idle[position]),
+                    int(self.checkouts[self.starts[position]]),
+                    int(self.checkouts[ends[position]]),
+                    int(last_return[position]),
+                    utilization,
+                    int(overlaps[code]),
+                    int(impossible[code]),
+                    self.kiosks[self.return_kiosks[ends[position]]],
+                )
+            )
+        return rows
+
+    def idle_rows(self) -> list:
+        """
+        (Bike, KioskName, Gaps, IdleSecs), idle gaps are placed at the return kiosk of the trip before them.
+        Overlapping trips have no gap
+        """
+        import numpy as np
+
+        keep = ~self.overlap[self.gaps]
+        gaps = self.gaps[keep]
+        keys = self.codes[gaps] * len(self.kiosks) + self.gap_kiosks[keep]
+        cells, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        idle = np.bincount(inverse, weights=self.idle_secs[gaps], minlength=len(cells))
+        bikes, kiosks = np.divmod(cells, len(self.kiosks))
+        return [
+            (self.bikes[bike], self.kiosks[kiosk], int(count), int(secs))
+            for bike, kiosk, count, secs in zip(bikes, kiosks, counts, idle)
+        ]
+
+    def flag_rows(self) -> list:
+        """
+        (Bike, TripId, Flag) of the overlapping and impossible trips
+        """
+        import numpy as np
+
+        rows = []
+        for flag, mask in (("overlap", self.overlap), ("impossible", self.impossible)):
+            for position in np.flatnonzero(mask):
+                rows.append((self.bikes[self.codes[position]], int(self.trip_ids[position]), flag))
+        return rows
+
+
+class HyperLogLog:
+    """
+    Mergeable distinct count sketches, one per group code. Each of a sketch's 2 ** precision registers keeps the
+    longest run of leading zero bits plus one among the 64 bit hashes routed to it, held here as the sorted
+    (group, register, rank) cells of the non zero registers. The standard error of an estimate is
+    1.04 / sqrt(2 ** precision), 1.6% at the default precision 12, and small counts are estimated by linear
+    counting, close to exact. Merging takes the register maxima, so cells of several sketches given the same
+    group code are the sketch of their union
+    """
+
+    def __init__(
+        self, groups: np.ndarray, registers: np.ndarray, ranks: np.ndarray, size: int, precision: int = SKETCH_PRECISION
+    ) -> None:
+        import numpy as np
+
+        self.size, self.precision = size, precision
+        keys = groups.astype(np.int64) * (1 << precision) + registers
+        order = np.lexsort((ranks, keys))
+        keys, ranks = keys[order], ranks[order]
+        # the highest rank of each register is the last of its run
+        ends = np.flatnonzero(np.diff(keys, append=-1))
+        self.groups, self.registers = np.divmod(keys[ends], 1 << precision)
+        self.ranks = ranks[ends].astype(np.uint8)
+        self.bounds = np.searchsorted(self.groups, np.arange(size + 1))
+
+    @classmethod
+    def from_values(
+        cls, groups: np.ndarray, values: np.ndarray, size: int, precision: int = SKETCH_PRECISION
+    ) -> HyperLogLog:
+        """
+        Sketches of text values by group code, values hashed to 64 bits the same way in every process and run
+        """
+        import numpy as np
+        import pandas as pd
+
+        hashes = pd.util.hash_array(np.asarray(values, dtype=object))
+        rest = hashes << np.uint64(precision)
+        # bit length of the remaining bits, from their 32 bit halves where float logarithms are exact
+        high, low = (rest >> np.uint64(32)).astype(np.float64), (rest & np.uint64(0xFFFFFFFF)).astype(np.float64)
+        with np.errstate(divide="ignore"):
+            bits = np.where(high > 0, 33 + np.floor(np.log2(high)), np.where(low > 0, 1 + np.floor(np.log2(low)), 0))
+        ranks = np.minimum(65 - bits, 65 - precision)
+        return cls(groups, (hashes >> np.uint64(64 - precision)).astype(np.int64), ranks, size, precision)
+
+    @staticmethod
+    def cell_dtype() -> np.dtype:
+        import numpy as np
+
+        return np.dtype([("register", "<u2"), ("rank", "u1")])
+
+    @classmethod
+    def from_bytes(cls, groups: np.ndarray, encoded: list, size: int, precision: int = SKETCH_PRECISION) -> HyperLogLog:
+        """
+        Merge encoded sketches by group code, decoded together from one joined buffer
+        """
+        import numpy as np
+
+        groups = np.asarray(groups, dtype=np.int64)
+        lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+        dense = lengths == 1 << precision
+        cells = np.frombuffer(b"".join(itertools.compress(encoded, ~dense)), dtype=cls.cell_dtype())
+        registers = np.frombuffer(b"".join(itertools.compress(encoded, dense)), dtype=np.uint8)
+        registers = registers.reshape(-1, 1 << precision)
+        rows, dense_registers = np.nonzero(registers)
+        return cls(
+            np.concatenate([np.repeat(groups[~dense], lengths[~dense] // 3), groups[dense][rows]]),
+            np.concatenate([cells["register"].astype(np.int64), dense_registers]),
+            np.concatenate([cells["rank"], registers[rows, dense_registers]]),
+            size,
+            precision,
+        )
+
+    def to_bytes(self) -> list:
+        """
+        Each group's sketch encoded as register and rank cells, or as its dense registers when that is smaller
+        """
+        import numpy as np
+
+        cells = np.empty(len(self.registers), dtype=self.cell_dtype())
+        cells["register"], cells["rank"] = self.registers, self.ranks
+        encoded = []
+        for first, last in zip(self.bounds[:-1], self.bounds[1:]):
+            if 3 * (last - first) < 1 << self.precision:
+                encoded.append(cells[first:last].tobytes())
+            else:
+                dense = np.zeros(1 << self.precision, dtype=np.uint8)
+                dense[self.registers[first:last]] = self.ranks[first:last]
+                encoded.append(dense.tobytes())
+        return encoded
+
+    def estimates(self) -> np.ndarray:
+        """
+        Distinct count estimate of each group
+        """
+        import numpy as np
+
+        size = 1 << self.precision
+        zeros = size - np.bincount(self.groups, minlength=self.size)
+        harmonic = zeros + np.bincount(
+            self.groups, weights=np.ldexp(1.0, -self.ranks.astype(np.int64)), minlength=self.size
+        )
+        raw = 0.7213 / (1 + 1.079 / size) * size * size / harmonic
+        with np.errstate(divide="ignore"):
+            linear = size * np.log(size / zeros)
+        return np.where((raw <= 2.5 * size) & (zeros > 0), linear, raw)
+
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketches, one per group code, value counts in logarithmic buckets (the DDSketch scheme) so
+    a quantile read back is within the relative accuracy, 1% by default, of the exact value at its rank, whatever
+    the distribution. Zero and negative values are counted in a bucket of their own and read back as 0. Held as
+    the sorted (group, bucket, count) cells, counts of the same group and bucket are added, which merges sketches
+    """
+
+    zero_bucket = -(1 << 15)
+
+    def __init__(
+        self, groups: np.ndarray, buckets: np.ndarray, counts: np.ndarray, size: int, accuracy: float = SKETCH_ACCURACY
+    ) -> None:
+        import numpy as np
+
+        self.size, self.accuracy = size, accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        keys = groups.astype(np.int64) * (1 << 16) + buckets - self.zero_bucket
+        cells, inverse = np.unique(keys, return_inverse=True)
+        self.counts = np.bincount(inverse, weights=counts, minlength=len(cells)).astype(np.int64)
+        self.groups, self.buckets = np.divmod(cells, 1 << 16)
+        self.buckets += self.zero_bucket
+        self.bounds = np.searchsorted(self.groups, np.arange(size + 1))
+
+    @classmethod
+    def from_values(
+        cls, groups: np.ndarray, values: np.ndarray, size: int, accuracy: float = SKETCH_ACCURACY
+    ) -> QuantileSketch:
+        import numpy as np
+
+        gamma = (1 + accuracy) / (1 - accuracy)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            buckets = np.clip(np.ceil(np.log(values) / np.log(gamma)), 1 - (1 << 15), (1 << 15) - 1)
+        buckets = np.where(values > 0, buckets, cls.zero_bucket).astype(np.int64)
+        return cls(groups, buckets, np.ones(len(buckets), dtype=np.int64), size, accuracy)
+
+    @staticmethod
+    def cell_dtype() -> np.dtype:
+        import numpy as np
+
+        return np.dtype([("bucket", "<i2"), ("count", "<u4")])
+
+    @classmethod
+    def from_bytes(
+        cls, groups: np.ndarray, encoded: list, size: int, accuracy: float = SKETCH_ACCURACY
+    ) -> QuantileSketch:
+        """
+        Merge encoded sketches by group code, decoded together from one joined buffer
+        """
+        import numpy as np
+
+        lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+        cells = np.frombuffer(b"".join(encoded), dtype=cls.cell_dtype())
+        return cls(
+            np.repeat(np.asarray(groups, dtype=np.int64), lengths // cls.cell_dtype().itemsize),
+            cells["bucket"].astype(np.int64),
+            cells["count"].astype(np.int64),
+            size,
+            accuracy,
+        )
+
+    def to_bytes(self) -> list:
+        """
+        Each group's sketch encoded as bucket and count cells
+        """
+        import numpy as np
+
+        cells = np.empty(len(self.buckets), dtype=self.cell_dtype())
+        cells["bucket"], cells["count"] = self.buckets, self.counts
+        return [cells[first:last].tobytes() for first, last in zip(self.bounds[:-1], self.bounds[1:])]
+
+    def quantiles(self, q: float) -> np.ndarray:
+        """
+        Value at rank floor(q * (count - 1)) of each group's sorted values, NaN for a group without values
+        """
+        import numpy as np
+
+        totals = np.bincount(self.groups, weights=self.counts, minlength=self.size)
+        running = np.cumsum(self.counts)
+        before = np.append(0, running)[self.bounds[:-1]]
+        # the first cell of each group whose running count passes the rank
+        cells = np.searchsorted(running, before + np.floor(q * (totals - 1)), side="right")
+        cells = np.minimum(cells, max(len(self.counts) - 1, 0))
+        buckets = self.buckets[cells] if len(self.counts) else np.zeros(self.size, dtype=np.int64)
+        values = np.where(buckets == self.zero_bucket, 0.0, 2 * self.gamma ** buckets.astype(float) / (self.gamma + 1))
+        return np.where(totals > 0, values, np.nan)
+
+
+class AppDB:
+    """
+    class for managing sqlite database
+    """
+
+    def __init__(self, path: str) -> None:
+        self.db_path = path
+        self.start_range = None
+        self.end_range = None
+        self.session_conn = None
+        self.range_queries = 0
+        self.range_data_version = None
+        self.tracer = None
+        self.dimension_cache = {}
+        self.flow_cache = {}
+        self.query_cache = QueryCache()
+        self.read_pool = []
+        self.pool_lock = threading.Lock()
+        self.write_conn = None
+        self.write_lock = threading.RLock()
+        self.known_kiosks = None
+        self.shard_months = None
+        self.shards = {}
+
+    @staticmethod
+    def csv_fields() -> list:
+        return [
+            "TripId",
+            "UserProgramName",
+            "UserId",
+            "UserRole",
+            "UserCity",
+            "UserState",
+            "UserZip",
+            "UserCountry",
+            "MembershipType",
+            "Bike",
+            "BikeType",
+            "CheckoutKioskName",
+            "ReturnKioskName",
+            "DurationMins",
+            "AdjustedDurationMins",
+            "UsageFee",
+            "AdjustmentFlag",
+            "Distance",
+            "EstimatedCarbonOffset",
+            "EstimatedCaloriesBurned",
+            "CheckoutDateLocal",
+            "ReturnDateLocal",
+            "CheckoutTimeLocal",
+            "ReturnTimeLocal",
+            "TripOver30Mins",
+            "LocalProgramFlag",
+            "TripRouteCategory",
+            "TripProgramName",
+        ]
+
+    @staticmethod
+    def create_db_schema() -> str:
+        return (
+            "CREATE TABLE IF NOT EXISTS ride_data ("
+            "`TripId` INTEGER  PRIMARY KEY,"
+            "`UserProgramName` TEXT,"
+            "`UserId` INTEGER,"
+            "`UserRole` TEXT,"
+            "`UserCity` TEXT,"
+            "`UserState` TEXT,"
+            "`UserZip` TEXT,"
+            "`UserCountry` TEXT,"
+            "`MembershipType` TEXT,"
+            "`Bike` TEXT,"
+            "`BikeType` TEXT,"
+            "`CheckoutKioskName` TEXT,"
+            "`ReturnKioskName` TEXT,"
+            "`DurationMins` REAL,"
+            "`AdjustedDurationMins` REAL,"
+            "`UsageFee` REAL,"
+            "`AdjustmentFlag` TEXT,"
+            "`Distance` REAL,"
+            "`EstimatedCarbonOffset` REAL,"
+            "`EstimatedCaloriesBurned` REAL,"
+            "`CheckoutDateLocal` TEXT,"
+            "`ReturnDateLocal` TEXT,"
+            "`CheckoutTimeLocal` TEXT,"
+            "`ReturnTimeLocal` TEXT,"
+            "`TripOver30Mins` TEXT,"
+            "`LocalProgramFlag` TEXT,"
+            "`TripRouteCategory` TEXT,"
+            "`TripProgramName` TEXT,"
+            "`FileName` TEXT,"
+            "`ImportDateTime` TEXT,"
+            "`CheckoutDateTime` TEXT,"
+            "`ReturnDateTime` TEXT,"
+            "`CheckoutEpoch` INTEGER,"
+            "`ReturnEpoch` INTEGER"
+            ");"
+        )
+
+    @staticmethod
+    def ride_data_indexes() -> dict:
+        return {
+            "idx_ride_data_checkout_epoch": ("CheckoutEpoch",),
+            "idx_ride_data_return_epoch": ("ReturnEpoch",),
+            "idx_ride_data_file_name": ("FileName",),
+            "idx_ride_data_checkout_kiosk": ("CheckoutKioskName",),
+            "idx_ride_data_return_kiosk": ("ReturnKioskName",),
+            "idx_ride_data_bike": ("Bike",),
+            "idx_ride_data_user_id": ("UserId",),
+        }
+
+    @staticmethod
+    def dimensions() -> dict:
+        """
+        Dimension tables of the normalized layout, with the ride_data text columns each one encodes and the
+        ride_trip id column that replaces them
+        """
+        return {
+            "dim_kiosk": {
+                "key": "KioskId",
+                "value": "KioskName",
+                "columns": {"CheckoutKioskName": "CheckoutKioskId", "ReturnKioskName": "ReturnKioskId"},
+            },
+            "dim_program": {
+                "key": "ProgramId",
+                "value": "ProgramName",
+                "columns": {"UserProgramName": "UserProgramId", "TripProgramName": "TripProgramId"},
+            },
+            "dim_user_city": {"key": "UserCityId", "value": "UserCity", "columns": {"UserCity": "UserCityId"}},
+            "dim_user_country": {
+                "key": "UserCountryId",
+                "value": "UserCountry",
+                "columns": {"UserCountry": "UserCountryId"},
+            },
+            "dim_file": {"key": "FileId", "value": "FileName", "columns": {"FileName": "FileId"}},
+        }
+
+    @staticmethod
+    def encoded_columns() -> dict:
+        """
+        ride_data text columns stored as dimension ids in the normalized layout, and their id columns
+        """
+        return {
+            column: id_column for each in AppDB.dimensions().values() for column, id_column in each["columns"].items()
+        }
+
+    @staticmethod
+    def ride_trip_indexes() -> dict:
+        encoded = AppDB.encoded_columns()
+        return {
+            index_name.replace("ride_data", "ride_trip"): tuple(encoded.get(each, each) for each in index_columns)
+            for index_name, index_columns in AppDB.ride_data_indexes().items()
+        }
+
+    @staticmethod
+    def create_manifest_schema() -> str:
+        return (
+            "CREATE TABLE IF NOT EXISTS import_manifest ("
+            "`FileName` TEXT PRIMARY KEY,"
+            "`FileSize` INTEGER,"
+            "`FileMtime` REAL,"
+            "`ContentHash` TEXT,"
+            "`RowCount` INTEGER,"
+            "`TripIdMin` INTEGER,"
+            "`TripIdMax` INTEGER,"
+            "`ImportSeconds` REAL,"
+            "`ImportDateTime` TEXT"
+            ");"
+        )
+
+    @staticmethod
+    def create_quarantine_schema() -> list:
+        return [
+            (
+                "CREATE TABLE IF NOT EXISTS import_quarantine ("
+                "`FileName` TEXT,"
+                "`TripId` TEXT,"
+                "`Reason` TEXT,"
+                "`RowData` TEXT,"
+                "`ImportDateTime` TEXT"
+                ");"
+            ),
+            "CREATE INDEX IF NOT EXISTS idx_import_quarantine_file ON import_quarantine (FileName, Reason);",
+        ]
 
-import pandas as pd
-import pendulum
+    @staticmethod
+    def df_dtype() -> dict:
+        """
+        Report column dtypes. Text columns load as categoricals, each distinct value is held once
+        """
+        return {
+            "TripId": "int64",
+            "UserProgramName": "category",
+            "UserId": "int64",
+            "UserRole": "category",
+            "UserCity": "category",
+            "UserState": "category",
+            "UserZip": "category",
+            "UserCountry": "category",
+            "MembershipType": "category",
+            "Bike": "category",
+            "BikeType": "category",
+            "CheckoutKioskName": "category",
+            "ReturnKioskName": "category",
+            "DurationMins": "float64",
+            "AdjustedDurationMins": "float64",
+            "UsageFee": "float64",
+            "AdjustmentFlag": "category",
+            "Distance": "float64",
+            "EstimatedCarbonOffset": "float64",
+            "EstimatedCaloriesBurned": "float64",
+            "CheckoutDateLocal": "category",
+            "ReturnDateLocal": "category",
+            "CheckoutTimeLocal": "category",
+            "ReturnTimeLocal": "category",
+            "TripOver30Mins": "category",
+            "LocalProgramFlag": "category",
+            "TripRouteCategory": "category",
+            "TripProgramName": "category",
+        }
+
+    @staticmethod
+    def flag_columns() -> list:
+        """
+        Y/N report columns, held as nullable booleans in import frames
+        """
+        return ["AdjustmentFlag", "TripOver30Mins", "LocalProgramFlag"]
+
+    @staticmethod
+    def datetime_text_columns() -> dict:
+        """
+        Date time text columns and their date and time parts, built as rows are bound
+        """
+        return {
+            "ReturnDateTime": ("ReturnDateLocal", "ReturnTimeLocal"),
+            "CheckoutDateTime": ("CheckoutDateLocal", "CheckoutTimeLocal"),
+        }
+
+    @staticmethod
+    def import_pragmas() -> dict:
+        """
+        Connection settings applied before a bulk load
+        """
+        return {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "cache_size": -65536,
+            "temp_store": "MEMORY",
+        }
+
+    @staticmethod
+    def replace_sql(columns: list, table_name: str = "ride_data") -> str:
+        return "REPLACE INTO {} ({}) VALUES ({});".format(table_name, ", ".join(columns), ", ".join("?" * len(columns)))
+
+    @staticmethod
+    def column_values(values: pd.Series) -> list:
+        """
+        Native python values of a frame column, for binding.
+        Missing text and flags are '', flags are 'Y' or 'N' and missing numbers are None
+        """
+        import numpy as np
+        import pandas as pd
+
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            lookup = np.append(values.cat.categories.to_numpy(dtype=object), "")
+            return lookup[values.cat.codes.to_numpy()].tolist()
+        if pd.api.types.is_bool_dtype(values.dtype):
+            lookup = np.array(["N", "Y", ""], dtype=object)
+            return lookup[values.to_numpy(dtype="int8", na_value=2)].tolist()
+        if values.dtype == object:
+            return values.where(values.notna(), "").tolist()
+        if values.hasnans:
+            return values.astype(object).where(values.notna(), None).tolist()
+        return values.tolist()
+
+    @staticmethod
+    def frame_rows(df: pd.DataFrame, chunk_size: int) -> Iterator[list]:
+        """
+        Yield lists of native python row tuples, chunk_size rows at a time, for the frame columns followed
+        by the datetime_text_columns() it lacks. Compact columns are expanded one chunk at a time
+        """
+        for start in range(0, len(df), chunk_size):
+            chunk = df.iloc[start : start + chunk_size]
+            columns = {name: AppDB.column_values(chunk[name]) for name in chunk.columns}
+            for name, (day, clock) in AppDB.datetime_text_columns().items():
+                if name not in columns:
+                    columns[name] = [f"{each} {other}" for each, other in zip(columns[day], columns[clock])]
+            yield list(zip(*columns.values()))
+
+    @staticmethod
+    def apply_pragmas(conn: Connection, pragmas: dict) -> None:
+        for key, value in pragmas.items():
+            conn.execute(f"PRAGMA {key} = {value};")
+
+    @staticmethod
+    def dict_factory(cursor, row):
+        # the column names are built once per result set, not for every row
+        description = cursor.description
+        fields = ROW_FIELDS.get(id(description))
+        if fields is None or fields[0] is not description:
+            if len(ROW_FIELDS) >= 256:
+                ROW_FIELDS.clear()
+            fields = ROW_FIELDS[id(description)] = (description, tuple(column[0] for column in description))
+        return dict(zip(fields[1], row))
+
+    def connect_db(self, path: str, shared: bool = False) -> Connection:
+        """
+        New connection returning dict rows, shared connections may be used from any thread, one at a time
+        """
+        if self.tracer is None:
+            conn = sqlite3.connect(path, check_same_thread=not shared)
+        else:
+            conn = sqlite3.connect(path, check_same_thread=not shared, factory=TracedConnection)
+            conn.tracer = self.tracer
+        conn.row_factory = AppDB.dict_factory
+        return conn
+
+    @contextlib.contextmanager
+    def reader(self) -> Iterator[Connection]:
+        """
+        A read connection from the pool, returned to it afterwards, at most READ_POOL_SIZE are kept open.
+        In WAL mode readers see the last commit and are not blocked by a running import
+        """
+        with self.pool_lock:
+            conn = self.read_pool.pop() if self.read_pool else None
+        if conn is not None and getattr(conn, "tracer", None) is not self.tracer:
+            # connections are traced from their creation
+            conn.close()
+            conn = None
+        conn = conn or self.connect_db(self.db_path, shared=True)
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            with self.pool_lock:
+                if len(self.read_pool) < READ_POOL_SIZE:
+                    self.read_pool.append(conn)
+                    conn = None
+            if conn is not None:
+                conn.close()
+
+    @contextlib.contextmanager
+    def writer(self) -> Iterator[Connection]:
+        """
+        The one write connection, held by one caller at a time. Commits when left, rolls back on an error
+        """
+        with self.write_lock:
+            if self.write_conn is not None and getattr(self.write_conn, "tracer", None) is not self.tracer:
+                self.write_conn.close()
+                self.write_conn = None
+            if self.write_conn is None:
+                self.write_conn = self.connect_db(self.db_path, shared=True)
+            with self.write_conn:
+                yield self.write_conn
+
+    def close(self) -> None:
+        """
+        Close the pooled, write and session connections
+        """
+        with self.pool_lock:
+            pool, self.read_pool = self.read_pool, []
+        for conn in pool + [self.write_conn, self.session_conn]:
+            if conn is not None:
+                conn.close()
+        for shard in self.shards.values():
+            shard.close()
+        self.write_conn = self.session_conn = None
+        self.range_data_version = None
+        self.range_queries = 0
+
+    def trace(self, stage: str, **fields):
+        """
+        Time a stage when tracing, the context yields a dict taking the stage's 'rows'
+        """
+        if self.tracer is None:
+            return contextlib.nullcontext({})
+        return self.tracer.stage(stage, **fields)
+
+    def trace_iter(self, stage: str, items: Iterator, **fields) -> Iterator:
+        """
+        Time producing each item of an iterator as a stage, with the item length as its rows
+        """
+        if self.tracer is None:
+            yield from items
+            return
+        while True:
+            with self.tracer.stage(stage, **fields) as span:
+                item = next(items, None)
+                span["rows"] = 0 if item is None else len(item)
+            if item is None:
+                return
+            yield item
+
+    def schema_migrations(self) -> list:
+        """
+        Ordered (user_version, migration) pairs, each migration runs once in its own transaction
+        """
+        return [
+            (1, self.migrate_base_schema),
+            (2, self.migrate_datetime_columns),
+            (3, self.migrate_rollups),
+            (4, self.migrate_bike_timeline),
+            (5, self.migrate_db_meta),
+            (6, self.migrate_quarantine),
+            (7, self.migrate_sketches),
+        ]
+
+    def migrate_base_schema(self, conn: Connection) -> None:
+        conn.execute(self.create_db_schema())
+        conn.execute(self.create_manifest_schema())
+
+    def migrate_datetime_columns(self, conn: Connection) -> None:
+        """
+        Add the integer epoch columns, backfill them from the local date and time text, and index
+        """
+        columns = self.table_columns(conn, "ride_data")
+        for column in ("CheckoutEpoch", "ReturnEpoch"):
+            if column not in columns:
+                conn.execute(f"ALTER TABLE ride_data ADD COLUMN `{column}` INTEGER;")
+                columns.add(column)
+
+        if {"CheckoutDateLocal", "CheckoutTimeLocal", "ReturnDateLocal", "ReturnTimeLocal"} <= columns:
+            conn.execute(
+                "UPDATE ride_data SET "
+                "CheckoutEpoch = CAST(strftime('%s', CheckoutDateLocal || ' ' || CheckoutTimeLocal) AS INTEGER), "
+                "ReturnEpoch = CAST(strftime('%s', ReturnDateLocal || ' ' || ReturnTimeLocal) AS INTEGER);"
+            )
+        for index_name, index_columns in self.ride_data_indexes().items():
+            if set(index_columns) <= columns:
+                conn.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON ride_data ({', '.join(index_columns)});")
+
+    def migrate_rollups(self, conn: Connection) -> None:
+        for sql in self.create_rollup_schema():
+            conn.execute(sql)
+        if {"CheckoutEpoch", "CheckoutKioskName"} <= self.table_columns(conn, "ride_data"):
+            self.rebuild_rollups(conn)
+
+    def migrate_bike_timeline(self, conn: Connection) -> None:
+        for sql in self.create_bike_timeline_schema():
+            conn.execute(sql)
+        if {"CheckoutEpoch", "Bike"} <= self.table_columns(conn, "ride_data"):
+            self.refresh_bike_timeline(conn)
+
+    def migrate_db_meta(self, conn: Connection) -> None:
+        conn.execute("CREATE TABLE IF NOT EXISTS db_meta (`Name` TEXT PRIMARY KEY, `Value` INTEGER);")
+        conn.execute("INSERT OR IGNORE INTO db_meta VALUES ('data_version', 0);")
+
+    def migrate_quarantine(self, conn: Connection) -> None:
+        for sql in self.create_quarantine_schema():
+            conn.execute(sql)
+
+    def migrate_sketches(self, conn: Connection) -> None:
+        conn.execute(self.create_sketch_schema())
+        if {"CheckoutEpoch", "UserId", "Bike", "DurationMins", "Distance"} <= self.table_columns(conn, "ride_data"):
+            self.rebuild_sketches(conn)
+
+    def migrate_db(self, conn: Connection) -> int:
+        """
+        Bring the database schema up to the latest migration, returns the resulting schema version
+        """
+        version = conn.execute("PRAGMA user_version;").fetchone()["user_version"]
+        for target, migration in self.schema_migrations():
+            if target <= version:
+                continue
+            try:
+                conn.execute("BEGIN;")
+                migration(conn)
+                conn.execute(f"PRAGMA user_version = {target};")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            version = target
+        return version
+
+    def init_db(self, quiet: bool = False) -> None:
+        # os path must exist, :memory: not supported, quiet for the databases of an app, like its shards
+        if os.path.exists(self.db_path):
+            try:
+                conn = self.connect_db(self.db_path)
+                exists = self.db_table_exists(conn, self.storage_table(conn))
+                conn.close()
+            except Exception as e:
+                raise Exception(f"connection failure | {e}")
+        else:
+            exists = False
+
+        if not exists and not quiet:
+            print("# Intializing database")
+        try:
+            with self.writer() as conn:
+                if not exists:
+                    # only takes effect before the first table is created, see enable_incremental_vacuum
+                    conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+                # readers are not blocked by a write in WAL mode, the mode is kept in the database file
+                conn.execute("PRAGMA journal_mode = WAL;")
+                self.migrate_db(conn)
+                # tells a database apart from an earlier one at the same path, see QueryCache
+                conn.execute("INSERT OR IGNORE INTO db_meta VALUES ('database_id', ?);", (uuid.uuid4().hex,))
+                conn.commit()
+                row = conn.execute("SELECT Value FROM db_meta WHERE Name = 'shard_months';").fetchone()
+                self.shard_months = row["Value"] if row else None
+        except Exception as e:
+            raise Exception(f"database creation error | {e}")
+
+    @staticmethod
+    def table_columns(conn: Connection, table_name: str) -> set:
+        return {each["name"] for each in conn.execute(f"PRAGMA table_info({table_name});").fetchall()}
+
+    @staticmethod
+    def db_table_exists(conn: Connection, table_name: str) -> bool:
+        try:
+            qry = "SELECT name FROM sqlite_master WHERE type='table' AND name=?;"
+            return conn.execute(qry, (table_name,)).fetchone() is not None
+        except sqlite3.OperationalError:
+            return False
+
+    @staticmethod
+    def storage_table(conn: Connection) -> str:
+        """
+        Table the trips are written to, ride_trip in the normalized layout where ride_data is a view
+        """
+        return "ride_trip" if AppDB.db_table_exists(conn, "ride_trip") else "ride_data"
+
+    def drop_temp_tables(self):
+        """
+        Drop the session's working set, a TEMP view and, once materialized, a TEMP table of the session
+        connection. Other sessions of the database keep theirs
+        """
+        if self.session_conn is not None:
+            self.session_conn.execute(f"DROP TABLE IF EXISTS temp.{RANGE_TABLE};")
+            self.session_conn.execute(f"DROP VIEW IF EXISTS temp.{RANGE_VIEW};")
+        self.range_queries = 0
+        self.range_data_version = None
+
+    @staticmethod
+    def create_stats_schema() -> str:
+        return (
+            "CREATE TABLE IF NOT EXISTS stats_catalog ("
+            "`FileName` TEXT PRIMARY KEY,"
+            "`RowCount` INTEGER,"
+            "`MinCheckout` INTEGER,"
+            "`MaxCheckout` INTEGER"
+            ");"
+        )
+
+    @staticmethod
+    def create_rollup_schema() -> list:
+        measures = "`Trips` INTEGER,`Minutes` REAL,`Revenue` REAL,`Distance` REAL,`Calories` REAL,"
+        return [
+            (
+                "CREATE TABLE IF NOT EXISTS rollup_hourly ("
+                "`Day` TEXT,`Hour` INTEGER,`KioskName` TEXT,`MembershipType` TEXT,`BikeType` TEXT,"
+                f"{measures}"
+                "PRIMARY KEY (`Day`, `Hour`, `KioskName`, `MembershipType`, `BikeType`)"
+                ");"
+            ),
+            (
+                "CREATE TABLE IF NOT EXISTS rollup_daily ("
+                "`Day` TEXT,`KioskName` TEXT,`MembershipType` TEXT,`BikeType` TEXT,"
+                f"{measures}"
+                "PRIMARY KEY (`Day`, `KioskName`, `MembershipType`, `BikeType`)"
+                ");"
+            ),
+        ]
+
+    @staticmethod
+    def rollup_sql(day_range: bool = False) -> list:
+        """
+        Aggregate ride_data by checkout hour and kiosk into rollup_hourly, then rollup_hourly into rollup_daily.
+        With day_range, the statements take a checkout epoch range and a first and last Day parameter
+        """
+        hourly_where = "AND CheckoutEpoch >= ? AND CheckoutEpoch < ?" if day_range else ""
+        daily_where = "WHERE Day BETWEEN ? AND ?" if day_range else ""
+        return [
+            (
+                "INSERT INTO rollup_hourly (Day, Hour, KioskName, MembershipType, BikeType, "
+                "Trips, Minutes, Revenue, Distance, Calories) "
+                "SELECT date(CheckoutEpoch, 'unixepoch'), CAST(strftime('%H', CheckoutEpoch, 'unixepoch') AS INTEGER), "
+                "CheckoutKioskName, MembershipType, BikeType, COUNT(*), TOTAL(DurationMins), TOTAL(UsageFee), "
+                "TOTAL(Distance), TOTAL(EstimatedCaloriesBurned) "
+                f"FROM ride_data WHERE CheckoutEpoch IS NOT NULL {hourly_where} GROUP BY 1, 2, 3, 4, 5;"
+            ),
+            (
+                "INSERT INTO rollup_daily (Day, KioskName, MembershipType, BikeType, "
+                "Trips, Minutes, Revenue, Distance, Calories) "
+                "SELECT Day, KioskName, MembershipType, BikeType, SUM(Trips), SUM(Minutes), SUM(Revenue), "
+                f"SUM(Distance), SUM(Calories) FROM rollup_hourly {daily_where} GROUP BY 1, 2, 3, 4;"
+            ),
+        ]
+
+    @staticmethod
+    def day_runs(days: set) -> list:
+        """
+        Group epoch day numbers into (first, last) runs of consecutive days
+        """
+        runs = []
+        for day in sorted(days):
+            if runs and day == runs[-1][1] + 1:
+                runs[-1][1] = day
+            else:
+                runs.append([day, day])
+        return [tuple(each) for each in runs]
+
+    def rebuild_rollups(self, conn: Connection) -> None:
+        """
+        Recompute all rollups from ride_data, in the caller's transaction
+        """
+        conn.execute("DELETE FROM rollup_hourly;")
+        conn.execute("DELETE FROM rollup_daily;")
+        for sql in self.rollup_sql():
+            conn.execute(sql)
+
+    def refresh_rollups(self, conn: Connection, days: set) -> None:
+        """
+        Recompute the rollups of the given epoch days only, each run of days is read through the CheckoutEpoch index
+        """
+        for first, last in self.day_runs(days):
+            start, end = first * 86400, (last + 1) * 86400
+            day_bounds = tuple(time.strftime("%Y-%m-%d", time.gmtime(each)) for each in (start, end - 1))
+            conn.execute("DELETE FROM rollup_hourly WHERE Day BETWEEN ? AND ?;", day_bounds)
+            conn.execute("DELETE FROM rollup_daily WHERE Day BETWEEN ? AND ?;", day_bounds)
+            hourly_sql, daily_sql = self.rollup_sql(day_range=True)
+            conn.execute(hourly_sql, (start, end))
+            conn.execute(daily_sql, day_bounds)
+
+    @staticmethod
+    def report_definitions() -> dict:
+        """
+        Reports answered from the rollup tables, name: description, rollup table and grouping columns
+        """
+        return {
+            "daily": {"description": "Trips by day", "table": "rollup_daily", "group_by": ["Day"]},
+            "hourly": {"description": "Trips by hour of day", "table": "rollup_hourly", "group_by": ["Hour"]},
+            "kiosk": {"description": "Trips by checkout kiosk", "table": "rollup_daily", "group_by": ["KioskName"]},
+            "kiosk_daily": {
+                "description": "Trips by checkout kiosk and day",
+                "table": "rollup_daily",
+                "group_by": ["KioskName", "Day"],
+            },
+            "kiosk_hourly": {
+                "description": "Trips by checkout kiosk and hour of day",
+                "table": "rollup_hourly",
+                "group_by": ["KioskName", "Hour"],
+            },
+            "membership": {
+                "description": "Trips by membership and bike type",
+                "table": "rollup_daily",
+                "group_by": ["MembershipType", "BikeType"],
+            },
+        }
+
+    def rollup_report(self, name: str, start: Optional[str] = None, end: Optional[str] = None) -> list:
+        """
+        Run a named report over the rollups, for checkout days between start and end ('YYYY-MM-DD', inclusive).
+        Defaults to the app date range, results are cached until the data version changes
+        """
+        report = self.report_definitions()[name]
+        group_by = ", ".join(report["group_by"])
+        start, end = start or self.start_range, end or self.end_range
+        where = ["Day >= ?"] * (start is not None) + ["Day <= ?"] * (end is not None)
+        params = [each for each in (start, end) if each is not None]
+        qry = (
+            f"SELECT {group_by}, SUM(Trips) AS Trips, ROUND(SUM(Minutes), 2) AS Minutes, "
+            "ROUND(SUM(Revenue), 2) AS Revenue, ROUND(SUM(Distance), 2) AS Distance, "
+            f"ROUND(SUM(Calories), 2) AS Calories FROM {report['table']} "
+            f"{'WHERE ' + ' AND '.join(where) if where else ''} GROUP BY {group_by} ORDER BY {group_by};"
+        )
+        run = None
+        if self.shard_months:
+            partial_sql = f"SELECT * FROM {report['table']} {'WHERE ' + ' AND '.join(where) if where else ''};"
+            run = functools.partial(
+                self.gather,
+                qry,
+                tuple(params),
+                partial_sql,
+                tuple(params),
+                report["table"],
+                *self.date_range_epochs(start, end),
+            )
+        return self.cached_query(qry, tuple(params), run)
+
+    @staticmethod
+    def create_sketch_schema() -> str:
+        return (
+            "CREATE TABLE IF NOT EXISTS sketch_daily ("
+            "`Day` TEXT,`KioskName` TEXT,`MembershipType` TEXT,`Trips` INTEGER,"
+            "`Users` BLOB,`Bikes` BLOB,`Durations` BLOB,`Distances` BLOB,"
+            "PRIMARY KEY (`Day`, `KioskName`, `MembershipType`)"
+            ");"
+        )
+
+    @staticmethod
+    def sketch_rows(df: pd.DataFrame) -> list:
+        """
+        sketch_daily rows of trips by Day, KioskName and MembershipType: distinct UserId and Bike HyperLogLog
+        sketches and DurationMins and Distance QuantileSketch sketches, each built for all groups at once
+        """
+        import pandas as pd
+
+        if df.empty:
+            return []
+        grouped = df.groupby(["Day", "KioskName", "MembershipType"], dropna=False, sort=True)
+        groups, trips = grouped.ngroup().to_numpy(), grouped.size()
+        columns = []
+        for column in ("UserId", "Bike"):
+            keep = df[column].notna().to_numpy()
+            columns.append(HyperLogLog.from_values(groups[keep], df[column].to_numpy()[keep], len(trips)).to_bytes())
+        for column in ("DurationMins", "Distance"):
+            values = pd.to_numeric(df[column], errors="coerce").to_numpy(dtype=float)
+            keep = ~pd.isna(values)
+            columns.append(QuantileSketch.from_values(groups[keep], values[keep], len(trips)).to_bytes())
+        return [
+            (*(None if pd.isna(each) else each for each in key), int(count), *sketches)
+            for key, count, *sketches in zip(trips.index, trips.to_numpy(), *columns)
+        ]
+
+    def write_sketches(self, conn: Connection, first_day: int, last_day: int) -> None:
+        """
+        Add the sketch_daily rows of checkout epoch days first_day to last_day, reading SKETCH_BATCH_DAYS days
+        of trips at a time through the CheckoutEpoch index
+        """
+        import pandas as pd
+
+        qry = (
+            "SELECT date(CheckoutEpoch, 'unixepoch') AS Day, CheckoutKioskName AS KioskName, MembershipType, "
+            "CAST(UserId AS TEXT) AS UserId, NULLIF(Bike, '') AS Bike, DurationMins, Distance FROM ride_data "
+            "WHERE CheckoutEpoch >= ? AND CheckoutEpoch < ?;"
+        )
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        for day in range(first_day, last_day + 1, SKETCH_BATCH_DAYS):
+            cursor.execute(qry, (day * 86400, min(day + SKETCH_BATCH_DAYS, last_day + 1) * 86400))
+            df = pd.DataFrame.from_records(cursor.fetchall(), columns=[each[0] for each in cursor.description])
+            conn.executemany("INSERT INTO sketch_daily VALUES (?, ?, ?, ?, ?, ?, ?, ?);", self.sketch_rows(df))
+
+    def rebuild_sketches(self, conn: Connection) -> None:
+        """
+        Recompute all sketches from ride_data, in the caller's transaction
+        """
+        conn.execute("DELETE FROM sketch_daily;")
+        qry = "SELECT MIN(CheckoutEpoch) / 86400 AS first, MAX(CheckoutEpoch) / 86400 AS last FROM ride_data;"
+        bounds = conn.execute(qry).fetchone()
+        if bounds["first"] is not None:
+            self.write_sketches(conn, bounds["first"], bounds["last"])
+
+    def refresh_sketches(self, conn: Connection, days: set) -> None:
+        """
+        Recompute the sketches of the given epoch days only, in the caller's transaction
+        """
+        for first, last in self.day_runs(days):
+            day_bounds = tuple(time.strftime("%Y-%m-%d", time.gmtime(each * 86400)) for each in (first, last))
+            conn.execute("DELETE FROM sketch_daily WHERE Day BETWEEN ? AND ?;", day_bounds)
+            self.write_sketches(conn, first, last)
+
+    @staticmethod
+    def sketch_groups(df: pd.DataFrame, group_by: tuple) -> tuple:
+        """
+        (group values, group code of each row) of a frame with a Day column grouped by any of SKETCH_GROUPS,
+        a single group without group_by. Missing values are None
+        """
+        import numpy as np
+        import pandas as pd
+
+        if not group_by:
+            return [()], np.zeros(len(df), dtype=np.int64)
+        grouped = df.assign(Month=df["Day"].str[:7]).groupby(list(group_by), dropna=False, sort=True)
+        keys = grouped.size().reset_index()[list(group_by)].itertuples(index=False, name=None)
+        return [tuple(None if pd.isna(each) else each for each in key) for key in keys], grouped.ngroup().to_numpy()
+
+    @staticmethod
+    def sketch_report_rows(group_by: tuple, keys: list, counts: dict, quantiles: dict) -> list:
+        """
+        Report rows of group keys, counts {column: per group counts} and quantiles {name: q -> per group values}
+        """
+        import numpy as np
+
+        columns = {name: np.rint(values).astype(np.int64) for name, values in counts.items()}
+        for name, quantile in quantiles.items():
+            columns.update({f"{name}P{q * 100:g}": np.round(quantile(q), 2) for q in SKETCH_QUANTILES})
+        return [
+            {
+                **dict(zip(group_by, key)),
+                **{
+                    name: None if np.isnan(values[position]) else values[position].item()
+                    for name, values in columns.items()
+                },
+            }
+            for position, key in enumerate(keys)
+        ]
+
+    @classmethod
+    def merge_sketches(cls, df: pd.DataFrame, group_by: tuple) -> list:
+        """
+        Report rows of sketch_daily rows, their sketches merged per group
+        """
+        import numpy as np
+
+        if df.empty:
+            return []
+        keys, groups = cls.sketch_groups(df, group_by)
+        size = len(keys)
+        counts = {
+            "Trips": np.bincount(groups, weights=df["Trips"].to_numpy(dtype=float), minlength=size),
+            "Users": HyperLogLog.from_bytes(groups, df["Users"].tolist(), size).estimates(),
+            "Bikes": HyperLogLog.from_bytes(groups, df["Bikes"].tolist(), size).estimates(),
+        }
+        quantiles = {
+            "Duration": QuantileSketch.from_bytes(groups, df["Durations"].tolist(), size).quantiles,
+            "Distance": QuantileSketch.from_bytes(groups, df["Distances"].tolist(), size).quantiles,
+        }
+        return cls.sketch_report_rows(group_by, keys, counts, quantiles)
+
+    @classmethod
+    def exact_sketch_rows(cls, df: pd.DataFrame, group_by: tuple) -> list:
+        """
+        Report rows counted from the trips themselves, quantiles by the same rank as QuantileSketch
+        """
+        import pandas as pd
+
+        if df.empty:
+            return []
+        keys, groups = cls.sketch_groups(df, group_by)
+        grouped = df.assign(DurationMins=pd.to_numeric(df["DurationMins"]), Distance=pd.to_numeric(df["Distance"]))
+        grouped = grouped.groupby(groups)
+        counts = {
+            "Trips": grouped.size().to_numpy(dtype=float),
+            "Users": grouped["UserId"].nunique().to_numpy(dtype=float),
+            "Bikes": grouped["Bike"].nunique().to_numpy(dtype=float),
+        }
+        quantiles = {
+            "Duration": lambda q: grouped["DurationMins"].quantile(q, interpolation="lower").to_numpy(dtype=float),
+            "Distance": lambda q: grouped["Distance"].quantile(q, interpolation="lower").to_numpy(dtype=float),
+        }
+        return cls.sketch_report_rows(group_by, keys, counts, quantiles)
+
+    def sketch_report(
+        self,
+        group_by: tuple = ("KioskName",),
+        start: Optional[str] = None,
+        end: Optional[str] = None,
+        exact: bool = False,
+    ) -> list:
+        """
+        Trips, distinct users and bikes, and SKETCH_QUANTILES of DurationMins and Distance, by any of SKETCH_GROUPS,
+        for checkout days between start and end ('YYYY-MM-DD', inclusive), the app date range by default.
+        Merged from the daily sketches, so distinct counts have a standard error of about 1.6% and quantiles
+        are within 1% of the value at their rank, with zero for non positive values. With exact, counted from
+        every trip in the range instead. Results are cached until the data version changes
+        """
+        import pandas as pd
+
+        if unknown := set(group_by) - set(SKETCH_GROUPS):
+            raise ValueError(f"unknown sketch groups {', '.join(sorted(unknown))}")
+        start, end = start or self.start_range, end or self.end_range
+        start_epoch, end_epoch = self.date_range_epochs(start, end)
+        if exact:
+            where = ["CheckoutEpoch IS NOT NULL"]
+            where += ["CheckoutEpoch >= ?"] * (start_epoch is not None)
+            where += ["CheckoutEpoch < ?"] * (end_epoch is not None)
+            params = tuple(each for each in (start_epoch, end_epoch) if each is not None)
+            qry = (
+                "SELECT date(CheckoutEpoch, 'unixepoch') AS Day, CheckoutKioskName AS KioskName, MembershipType, "
+                "CAST(UserId AS TEXT) AS UserId, NULLIF(Bike, '') AS Bike, DurationMins, Distance FROM ride_data "
+                f"WHERE {' AND '.join(where)};"
+            )
+        else:
+            where = ["Day >= ?"] * (start is not None) + ["Day <= ?"] * (end is not None)
+            params = tuple(each for each in (start, end) if each is not None)
+            qry = f"SELECT * FROM sketch_daily {'WHERE ' + ' AND '.join(where) if where else ''};"
+
+        def run() -> list:
+            if self.shard_months:
+                rows = self.gather("SELECT * FROM partial;", (), qry, params, None, start_epoch, end_epoch)
+                df = pd.DataFrame.from_records(rows)
+            else:
+                df = self.query_frame(qry, params)
+            return self.exact_sketch_rows(df, group_by) if exact else self.merge_sketches(df, group_by)
+
+        # the grouping is part of the cache key
+        return self.cached_query(qry, (*params, *group_by), run)
+
+    @staticmethod
+    def file_stats_sql(where: str = "") -> str:
+        """
+        Per file row count and checkout range from ride_data, for filling stats_catalog
+        """
+        return (
+            "INSERT INTO stats_catalog (FileName, RowCount, MinCheckout, MaxCheckout) "
+            "SELECT FileName, COUNT(*), MIN(checkout), MAX(checkout) FROM ("
+            "SELECT FileName, COALESCE(CheckoutEpoch, "
+            "CAST(strftime('%s', CheckoutDateLocal || ' ' || CheckoutTimeLocal) AS INTEGER)) AS checkout "
+            f"FROM ride_data {where}) GROUP BY FileName;"
+        )
+
+    def rebuild_stats(self, conn: Connection) -> None:
+        """
+        Recompute the whole stats catalog from ride_data, in the caller's transaction
+        """
+        conn.execute("DROP TABLE IF EXISTS stats_catalog;")
+        conn.execute(self.create_stats_schema())
+        conn.execute(self.file_stats_sql())
+
+    def refresh_stats(self, conn: Connection, filenames: set) -> None:
+        """
+        Recompute the stats catalog rows of the given files, in the caller's transaction.
+        Uses the FileName index, so the cost follows the size of those files, not of ride_data
+        """
+        if not self.db_table_exists(conn, "stats_catalog"):
+            self.rebuild_stats(conn)
+            return
+
+        filenames = list(filenames)
+        placeholders = ", ".join("?" * len(filenames))
+        conn.execute(f"DELETE FROM stats_catalog WHERE FileName IN ({placeholders});", filenames)
+        conn.execute(self.file_stats_sql(f"WHERE FileName IN ({placeholders})"), filenames)
+        conn.execute("DELETE FROM stats_catalog WHERE RowCount = 0;")
+
+    @staticmethod
+    def create_bike_timeline_schema() -> list:
+        return [
+            (
+                "CREATE TABLE IF NOT EXISTS bike_timeline ("
+                "`Bike` TEXT PRIMARY KEY,`Trips` INTEGER,`RideSecs` INTEGER,`IdleSecs` INTEGER,`MaxIdleSecs` INTEGER,"
+                "`FirstCheckout` INTEGER,`LastCheckout` INTEGER,`LastReturn` INTEGER,`Utilization` REAL,"
+                "`Overlaps` INTEGER,`Impossible` INTEGER,`LastKioskName` TEXT"
+                ");"
+            ),
+            (
+                "CREATE TABLE IF NOT EXISTS bike_idle ("
+                "`Bike` TEXT,`KioskName` TEXT,`Gaps` INTEGER,`IdleSecs` INTEGER,"
+                "PRIMARY KEY (`Bike`, `KioskName`)"
+                ");"
+            ),
+            (
+                "CREATE TABLE IF NOT EXISTS bike_trip_flag ("
+                "`Bike` TEXT,`TripId` INTEGER,`Flag` TEXT,"
+                "PRIMARY KEY (`Bike`, `TripId`, `Flag`)"
+                ");"
+            ),
+        ]
+
+    def bike_timeline(
+        self, conn: Connection, bikes: Optional[set] = None, appended: Optional[dict] = None
+    ) -> BikeTimeline:
+        """
+        BikeTimeline of the trips of the given bikes, all bikes by default. With appended, {bike: first new
+        checkout epoch}, only those bikes' newer trips are read, through the CheckoutEpoch index, continuing from
+        their bike_timeline rows. Trips without a bike or checkout time are left out
+        """
+        import numpy as np
+        import pandas as pd
+
+        qry = (
+            "SELECT TripId, Bike, CheckoutEpoch, COALESCE(ReturnEpoch, -1), ReturnKioskName FROM ride_data "
+            "WHERE CheckoutEpoch IS NOT NULL AND Bike != ''"
+        )
+        params = []
+        if appended:
+            qry += " AND CheckoutEpoch >= ?"
+            params.append(min(appended.values()))
+        elif bikes is not None:
+            qry += " AND Bike IN (SELECT value FROM json_each(?))"
+            params.append(json.dumps(sorted(bikes)))
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        values = np.fromiter(itertools.chain.from_iterable(cursor.execute(qry + ";", params)), dtype=object)
+        values = values.reshape(-1, 5)
+        previous = {}
+        if appended:
+            values = values[[bike in appended and checkout >= appended[bike] for bike, checkout in values[:, 1:3]]]
+            qry = (
+                "SELECT Bike, LastReturn, LastKioskName FROM bike_timeline "
+                "WHERE Bike IN (SELECT value FROM json_each(?));"
+            )
+            previous = {each["Bike"]: each for each in conn.execute(qry, (json.dumps(sorted(appended)),))}
+
+        bike_codes, bike_index = pd.factorize(values[:, 1])
+        last_kiosks = [previous[each]["LastKioskName"] if each in previous else "" for each in bike_index]
+        kiosk_codes, kiosk_index = pd.factorize(np.append(values[:, 4], np.array(last_kiosks, dtype=object)))
+        previous_returns = [previous[each]["LastReturn"] if each in previous else -1 for each in bike_index]
+        return BikeTimeline(
+            list(bike_index),
+            list(kiosk_index),
+            values[:, 0].astype(np.int64),
+            bike_codes.astype(np.int64),
+            values[:, 2].astype(np.int64),
+            values[:, 3].astype(np.int64),
+            kiosk_codes[: len(values)].astype(np.int64),
+            np.array(previous_returns, dtype=np.int64) if previous else None,
+            kiosk_codes[len(values) :].astype(np.int64) if previous else None,
+        )
+
+    def refresh_bike_timeline(
+        self, conn: Connection, bikes: Optional[set] = None, appended: Optional[dict] = None
+    ) -> None:
+        """
+        Bring the bike timeline tables up to date in the caller's transaction. The given bikes, all bikes by default,
+        are recomputed from all their trips. Trips appended after a bike's last checkout, appended is
+        {bike: first new checkout epoch}, are merged into its rows, other appended bikes are recomputed.
+        When at least TIMELINE_SCAN_FRACTION of the bikes are recomputed, all of them are
+        """
+        if not self.db_table_exists(conn, "bike_timeline"):
+            for sql in self.create_bike_timeline_schema():
+                conn.execute(sql)
+            bikes = None
+        if bikes is None:
+            for table_name in ("bike_timeline", "bike_idle", "bike_trip_flag"):
+                conn.execute(f"DELETE FROM {table_name};")
+            self.write_bike_timeline(conn, self.bike_timeline(conn))
+            return
+
+        appended = appended or {}
+        qry = "SELECT Bike, LastCheckout FROM bike_timeline WHERE Bike IN (SELECT value FROM json_each(?));"
+        last_checkouts = {
+            each["Bike"]: each["LastCheckout"] for each in conn.execute(qry, (json.dumps(sorted(appended)),))
+        }
+        merged = {
+            bike: epoch
+            for bike, epoch in appended.items()
+            if bike not in bikes and bike in last_checkouts and last_checkouts[bike] < epoch
+        }
+        recompute = sorted((set(bikes) | set(appended)) - set(merged))
+        known = conn.execute("SELECT COUNT(*) AS bikes FROM bike_timeline;").fetchone()["bikes"]
+        if len(recompute) >= TIMELINE_SCAN_FRACTION * (known + len(set(appended) - set(last_checkouts))):
+            # reading most bikes through the Bike index costs more than one scan of all trips
+            self.refresh_bike_timeline(conn)
+            return
+        if recompute:
+            for table_name in ("bike_timeline", "bike_idle", "bike_trip_flag"):
+                conn.execute(
+                    f"DELETE FROM {table_name} WHERE Bike IN (SELECT value FROM json_each(?));",
+                    (json.dumps(recompute),),
+                )
+            self.write_bike_timeline(conn, self.bike_timeline(conn, set(recompute)))
+        if merged:
+            self.write_bike_timeline(conn, self.bike_timeline(conn, appended=merged))
+
+    @staticmethod
+    def write_bike_timeline(conn: Connection, timeline: BikeTimeline) -> None:
+        """
+        Add a timeline's rows to the bike timeline tables, summing with the rows already there
+        """
+        conn.executemany(
+            "INSERT INTO bike_timeline (Bike, Trips, RideSecs, IdleSecs, MaxIdleSecs, FirstCheckout, LastCheckout, "
+            "LastReturn, Utilization, Overlaps, Impossible, LastKioskName) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (Bike) DO UPDATE SET Trips = Trips + excluded.Trips, "
+            "RideSecs = RideSecs + excluded.RideSecs, IdleSecs = IdleSecs + excluded.IdleSecs, "
+            "MaxIdleSecs = MAX(MaxIdleSecs, excluded.MaxIdleSecs), LastCheckout = excluded.LastCheckout, "
+            "LastReturn = MAX(LastReturn, excluded.LastReturn), Overlaps = Overlaps + excluded.Overlaps, "
+            "Impossible = Impossible + excluded.Impossible, LastKioskName = excluded.LastKioskName, "
+            "Utilization = ROUND(CAST(RideSecs + excluded.RideSecs AS REAL) "
+            "/ NULLIF(MAX(LastReturn, excluded.LastReturn) - FirstCheckout, 0), 4);",
+            timeline.bike_rows(),
+        )
+        conn.executemany(
+            "INSERT INTO bike_idle (Bike, KioskName, Gaps, IdleSecs) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (Bike, KioskName) DO UPDATE SET Gaps = Gaps + excluded.Gaps, "
+            "IdleSecs = IdleSecs + excluded.IdleSecs;",
+            timeline.idle_rows(),
+        )
+        conn.executemany("INSERT OR REPLACE INTO bike_trip_flag VALUES (?, ?, ?);", timeline.flag_rows())
+
+    @staticmethod
+    def track_touched(conn: Connection, df: pd.DataFrame, touched: dict) -> dict:
+        """
+        Add the files, checkout days and bikes a frame about to be written affects to touched, including
+        rows already in its TripId range that REPLACE may overwrite. The first new checkout epoch of each
+        bike is kept in touched appended
+        """
+        if df.empty:
+            return touched
+        trip_range = (int(df["TripId"].min()), int(df["TripId"].max()))
+        qry = "SELECT DISTINCT FileName, CheckoutEpoch / 86400 AS day FROM ride_data WHERE TripId BETWEEN ? AND ?;"
+        for each in conn.execute(qry, trip_range).fetchall():
+            touched["files"].add(each["FileName"])
+            touched["days"].add(each["day"])
+        qry = "SELECT DISTINCT Bike FROM ride_data WHERE TripId BETWEEN ? AND ?;"
+        touched["bikes"].update(each["Bike"] for each in conn.execute(qry, trip_range).fetchall())
+        import pandas as pd
+
+        checkouts = pd.to_numeric(df["CheckoutEpoch"])
+        for bike, epoch in checkouts.groupby(df["Bike"], observed=True).min().dropna().items():
+            touched["appended"][str(bike)] = min(int(epoch), touched["appended"].get(str(bike), int(epoch)))
+        touched["files"].update(df["FileName"].unique())
+        touched["days"].update(int(each) for each in checkouts.dropna().floordiv(86400).unique())
+        touched["days"].discard(None)
+        return touched
+
+    def refresh_derived(self, conn: Connection, touched: dict, timeline: bool = True) -> None:
+        """
+        Bring the stats catalog, rollups, sketches and bike timeline up to date for touched files, days and bikes,
+        and bump the data version, in the caller's transaction. Without timeline the bike timeline is left to
+        the caller. In sharded storage each shard keeps its own derived tables, see write_shards
+        """
+        if not self.shard_months:
+            self.refresh_stats(conn, touched["files"])
+            self.refresh_rollups(conn, touched["days"])
+            self.refresh_sketches(conn, touched["days"])
+            if timeline:
+                self.refresh_bike_timeline(conn, touched["bikes"], touched["appended"])
+        self.bump_data_version(conn)
+
+    def commit_bike_timeline(self, conn: Connection, bikes: set) -> None:
+        """
+        Refresh the bike timeline of the given bikes and bump the data version in a transaction of its own
+        """
+        if bikes:
+            conn.execute("BEGIN IMMEDIATE;")
+            self.refresh_bike_timeline(conn, bikes)
+            self.bump_data_version(conn)
+            conn.commit()
+
+    def ensure_stats_catalog(self, conn: Connection, rebuild: bool = False) -> None:
+        """
+        Build the stats catalog when missing or asked to rebuild, in its own transaction
+        """
+        if rebuild or not self.db_table_exists(conn, "stats_catalog"):
+            conn.execute("BEGIN;")
+            self.rebuild_stats(conn)
+            self.bump_data_version(conn)
+            conn.commit()
+
+    def catalog_files(self) -> list:
+        """
+        Per report file row count and checkout range, from the stats catalog
+        """
+        qry = (
+            "SELECT FileName, RowCount, datetime(MinCheckout, 'unixepoch') AS MinCheckout, "
+            "datetime(MaxCheckout, 'unixepoch') AS MaxCheckout FROM stats_catalog ORDER BY FileName;"
+        )
+
+        def run() -> list:
+            if self.shard_months:
+                return self.gather(
+                    qry, partial_sql="SELECT * FROM stats_catalog;", merge="stats_catalog", prepare=prepare
+                )
+            with self.reader() as conn:
+                self.ensure_stats_catalog(conn)
+                rows = conn.execute(qry).fetchall()
+            return rows
+
+        def prepare(app_db: AppDB, conn: Connection) -> None:
+            app_db.ensure_stats_catalog(conn)
+
+        return self.cached_query(qry, run=run)
+
+    def quarantine_counts(self) -> list:
+        """
+        Quarantined row count per report file and reason
+        """
+        return self.cached_query(
+            "SELECT FileName, Reason, COUNT(*) AS Rows FROM import_quarantine "
+            "GROUP BY FileName, Reason ORDER BY FileName, Reason;"
+        )
+
+    @staticmethod
+    def bump_data_version(conn: Connection) -> None:
+        """
+        Count a change of the trips or their derived tables, in the caller's transaction.
+        Databases from before the db_meta migration have no counter and are not cached
+        """
+        if AppDB.db_table_exists(conn, "db_meta"):
+            conn.execute("UPDATE db_meta SET Value = Value + 1 WHERE Name = 'data_version';")
+
+    def data_version(self) -> Optional[int]:
+        """
+        The data version counter, None before the database is initialized
+        """
+        qry = "SELECT Value FROM db_meta WHERE Name = 'data_version';"
+        try:
+            with self.reader() as conn:
+                row = conn.execute(qry).fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return row["Value"] if row else None
+
+    def cache_version(self) -> Optional[tuple]:
+        """
+        (data version, database id) of the database, None before it is initialized
+        """
+        qry = "SELECT Name, Value FROM db_meta WHERE Name IN ('data_version', 'database_id');"
+        try:
+            with self.reader() as conn:
+                meta = {each["Name"]: each["Value"] for each in conn.execute(qry).fetchall()}
+        except sqlite3.OperationalError:
+            return None
+        return (meta["data_version"], meta.get("database_id", "")) if "data_version" in meta else None
+
+    def cached_query(self, sql: str, params: tuple = (), run=None) -> list:
+        """
+        Rows of a read only query, served from the query cache while the data version is unchanged.
+        run produces the rows on a miss, None results are not cached. Runs sql on a pooled reader by default
+        """
+        run = run or functools.partial(self.query_rows, sql, params)
+        version = None if self.query_cache is None else self.cache_version()
+        if version is None:
+            return run()
+        key = self.query_cache.key(self.db_path, sql, params, *version)
+        rows = self.query_cache.get(key)
+        if rows is None:
+            rows = run()
+            if rows is None:
+                return rows
+            self.query_cache.put(key, rows)
+        return [dict(each) for each in rows]
+
+    @staticmethod
+    def catalog_stats_sql() -> str:
+        return (
+            "SELECT COALESCE(SUM(RowCount), 0) AS row_count, COUNT(*) AS file_count, "
+            "datetime(MIN(MinCheckout), 'unixepoch') AS min_date, "
+            "datetime(MAX(MaxCheckout), 'unixepoch') AS max_date FROM stats_catalog;"
+        )
+
+    def query_rows(self, sql: str, params: tuple = ()) -> list:
+        with self.reader() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def query_frame(self, sql: str, params: tuple = ()) -> pd.DataFrame:
+        """
+        Result of a bulk query as a DataFrame, built from plain row tuples without per row dicts
+        """
+        import pandas as pd
+
+        with self.reader() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            cursor.execute(sql, params)
+            return pd.DataFrame.from_records(cursor.fetchall(), columns=[each[0] for each in cursor.description])
+
+    def db_stats(self, table_name: Optional[str] = None, rebuild: bool = False) -> dict:
+        """
+        Returns a dictionary with some database statistics
+
+        ride_data statistics are read from the stats catalog, which is built on first use or with rebuild,
+        and are cached until the data version changes. Any other table or view is scanned
+        """
+        if table_name in (None, "ride_data") and not rebuild:
+            rows = self.cached_query(
+                self.catalog_stats_sql(), run=lambda: [stats] if (stats := self.read_db_stats("ride_data")) else None
+            )
+            return rows[0] if rows else {}
+        return self.read_db_stats(table_name, rebuild)
+
+    def read_db_stats(self, table_name: Optional[str] = None, rebuild: bool = False) -> dict:
+        stats = {}
+        table_name = table_name or "ride_data"
+        if self.shard_months and table_name == "ride_data":
+            return self.read_shard_stats(rebuild)
+        with self.writer() if rebuild else self.reader() as conn:
+            try:
+                if table_name == "ride_data":
+                    self.ensure_stats_catalog(conn, rebuild)
+                    qry = self.catalog_stats_sql()
+                else:
+                    qry = (
+                        "WITH qry1 AS (SELECT FileName, datetime(CheckoutDateLocal||' '||CheckoutTimeLocal) AS checkout "
+                        "FROM {}) SELECT COUNT(*) AS row_count, COUNT(DISTINCT FileName) AS file_count, "
+                        "MIN(checkout) AS min_date, MAX(checkout) AS max_date FROM qry1;".format(table_name)
+                    )
+                stats = conn.execute(qry).fetchone()
+            except Exception as e:
+                conn.rollback()
+                print(f"\n# DB stats error | {e}")
+
+        return stats
+
+    def read_shard_stats(self, rebuild: bool = False) -> dict:
+        """
+        ride_data statistics gathered from the stats catalogs of the shards, each rebuilt first with rebuild
+        """
+        try:
+            stats = self.gather(
+                self.catalog_stats_sql(),
+                partial_sql="SELECT * FROM stats_catalog;",
+                merge="stats_catalog",
+                prepare=lambda app_db, conn: app_db.ensure_stats_catalog(conn, rebuild),
+            )[0]
+            if rebuild:
+                with self.writer() as conn:
+                    self.bump_data_version(conn)
+        except Exception as e:
+            print(f"\n# DB stats error | {e}")
+            return {}
+        return stats
+
+    @staticmethod
+    def read_report(report_path: str, chunk_size: Optional[int] = None, offset: int = 0) -> Iterator[pd.DataFrame]:
+        """
+        Yield a report csv as data frames, the whole file at once or chunk_size rows at a time.
+        gzip/zip/bz2/xz compressed reports are read directly, based on the file extension.
+        A non zero offset reads only the rows from that byte position on, for appended reports.
+        Numeric column types are inferred, a malformed value leaves its column as text for
+        validate_report_frame instead of failing the read
+        """
+        import pandas as pd
+
+        dtype = {name: each for name, each in AppDB.df_dtype().items() if each == "category"}
+        options = {"dtype": dtype, "chunksize": chunk_size, "compression": "infer"}
+        with open(report_path, "rb") if offset else contextlib.nullcontext(report_path) as source:
+            if offset:
+                # header names come from the first line, the data from the appended tail
+                options["names"] = next(csv.reader([source.readline().decode("utf-8-sig")]))
+                options.update(header=None, compression=None)
+                source.seek(offset)
+
+            result = pd.read_csv(source, **options)
+            if chunk_size is None:
+                yield result
+                return
+            with result as reader:
+                yield from reader
+
+    @staticmethod
+    def prepare_report_frame(df: pd.DataFrame, filename: str, import_datetime: str) -> pd.DataFrame:
+        """
+        Add the derived import columns, in place. Epochs are parsed from the distinct dates and times,
+        the date time text and missing values are filled per column as rows are bound, see frame_rows.
+        The flags are compacted to nullable booleans by validate_report_frame
+        """
+        import numpy as np
+        import pandas as pd
+
+        constant = np.zeros(len(df), dtype="int8")
+        df["FileName"] = pd.Categorical.from_codes(constant, [filename])
+        df["ImportDateTime"] = pd.Categorical.from_codes(constant, [import_datetime])
+        df["CheckoutEpoch"] = AppDB.epoch_seconds(df["CheckoutDateLocal"], df["CheckoutTimeLocal"])
+        df["ReturnEpoch"] = AppDB.epoch_seconds(df["ReturnDateLocal"], df["ReturnTimeLocal"])
+        return df
+
+    @staticmethod
+    def epoch_seconds(dates: pd.Series, times: pd.Series) -> pd.Series:
+        """
+        Local 'YYYY-MM-DD' dates and 'HH:MM:SS' times to nullable integer seconds, NA where either does
+        not parse. Each distinct date and time is parsed once. Matches sqlite's strftime('%s', ...),
+        local times are treated as UTC
+        """
+        import numpy as np
+        import pandas as pd
+
+        def lookup(values: pd.Series, seconds) -> np.ndarray:
+            values = values.astype("category")
+            # code -1, a missing value, indexes the trailing nan
+            table = np.append(seconds(values.cat.categories).to_numpy(dtype="float64", na_value=np.nan), np.nan)
+            return table[values.cat.codes.to_numpy()]
+
+        day_seconds = lookup(
+            dates,
+            lambda each: (pd.to_datetime(each, format="%Y-%m-%d", errors="coerce") - pd.Timestamp(0)).total_seconds(),
+        )
+        time_seconds = lookup(times, lambda each: pd.to_timedelta(each, errors="coerce").total_seconds())
+        return pd.Series(day_seconds + time_seconds, index=dates.index).astype("Int64")
+
+    @staticmethod
+    def validate_report_frame(df: pd.DataFrame, known_kiosks: Optional[set] = None, seen_trip_ids=None) -> tuple:
+        """
+        Split a prepared report frame into the rows to load, with the df_dtype() numeric types and the flags
+        as nullable booleans, and the rows to quarantine, with their report values. Each check runs over whole
+        columns, a row is quarantined with the reason code of the first check it fails: bad_type, bad_flag (a
+        flag other than Y, N or blank), bad_datetime, return_before_checkout, negative_duration, negative_fee,
+        unknown_kiosk (only checked with known_kiosks) and duplicate_trip_id, a TripId already in the frame
+        or one of those seen_trip_ids(trip_ids) returns as already loaded.
+        Returns the frame to load and the quarantined rows with their 'Reason'
+        """
+        import numpy as np
+        import pandas as pd
+
+        numbers = {}
+        bad_type = np.zeros(len(df), dtype=bool)
+        for name, dtype in AppDB.df_dtype().items():
+            if dtype == "category":
+                continue
+            values = df[name]
+            if not pd.api.types.is_numeric_dtype(values.dtype):
+                values = pd.to_numeric(values, errors="coerce")
+                bad_type |= (values.isna() & df[name].notna()).to_numpy()
+            if dtype == "int64" and values.dtype != "int64":
+                # TripId and UserId are required whole numbers
+                bad_type |= (values.isna() | (values % 1 != 0)).to_numpy()
+            numbers[name] = values
+        flags = {}
+        bad_flag = np.zeros(len(df), dtype=bool)
+        for name in AppDB.flag_columns():
+            flags[name] = df[name].astype("category").map({"Y": True, "N": False}).astype("boolean")
+            bad_flag |= (flags[name].isna() & df[name].notna()).to_numpy()
+
+        checkout, returned = df["CheckoutEpoch"], df["ReturnEpoch"]
+        return_given = (df["ReturnDateLocal"].notna() & df["ReturnTimeLocal"].notna()).to_numpy()
+        unknown_kiosk = np.zeros(len(df), dtype=bool)
+        if known_kiosks is not None:
+            for name in ("CheckoutKioskName", "ReturnKioskName"):
+                unknown_kiosk |= (df[name].notna() & ~df[name].isin(known_kiosks)).to_numpy()
+        checks = {
+            "bad_type": bad_type,
+            "bad_flag": bad_flag,
+            "bad_datetime": checkout.isna().to_numpy() | (return_given & returned.isna().to_numpy()),
+            "return_before_checkout": (returned < checkout).to_numpy(dtype=bool, na_value=False),
+            "negative_duration": ((numbers["DurationMins"] < 0) | (numbers["AdjustedDurationMins"] < 0)).to_numpy(),
+            "negative_fee": (numbers["UsageFee"] < 0).to_numpy(),
+            "unknown_kiosk": unknown_kiosk,
+        }
+        # the first copy of a TripId that passes the other checks is loaded
+        passed = ~np.logical_or.reduce(list(checks.values()))
+        trip_ids = numbers["TripId"].to_numpy()
+        duplicate = np.zeros(len(df), dtype=bool)
+        duplicate[passed] = pd.Series(trip_ids[passed]).duplicated().to_numpy()
+        if seen_trip_ids is not None and passed.any():
+            duplicate |= passed & np.isin(trip_ids, seen_trip_ids(trip_ids[passed].astype("int64")))
+        checks["duplicate_trip_id"] = duplicate
+
+        reasons = np.select(list(checks.values()), list(checks), default="")
+        bad = reasons != ""
+        quarantine = df.loc[bad].assign(Reason=reasons[bad])
+        if bad.any():
+            df = df.loc[~bad].copy()
+        for name, values in numbers.items():
+            df[name] = values[~bad].astype(AppDB.df_dtype()[name])
+        for name, values in flags.items():
+            df[name] = values[~bad]
+        return df, quarantine
+
+    @staticmethod
+    def quarantine_rows(quarantine: pd.DataFrame, filename: str, import_datetime: str) -> Iterator[tuple]:
+        """
+        import_quarantine rows of quarantined report rows, the report values are kept as JSON
+        """
+        columns = [name for name in AppDB.csv_fields() if name in quarantine]
+        values = {name: AppDB.column_values(quarantine[name]) for name in columns}
+        for index, reason in enumerate(quarantine["Reason"].tolist()):
+            row = {name: values[name][index] for name in columns}
+            if isinstance(row["TripId"], float) and row["TripId"].is_integer():
+                row["TripId"] = int(row["TripId"])
+            trip_id = "" if row["TripId"] is None else str(row["TripId"])
+            yield filename, trip_id, reason, json.dumps(row), import_datetime
+
+    @staticmethod
+    def write_quarantine(conn: Connection, quarantine: pd.DataFrame, filename: str, import_datetime: str) -> dict:
+        """
+        Save quarantined rows, returns the number of rows per reason
+        """
+        if quarantine.empty:
+            return {}
+        conn.executemany(
+            "INSERT INTO import_quarantine VALUES (?, ?, ?, ?, ?);",
+            AppDB.quarantine_rows(quarantine, filename, import_datetime),
+        )
+        return quarantine["Reason"].value_counts().to_dict()
+
+    @staticmethod
+    def print_quarantined(quarantined: dict) -> None:
+        if quarantined:
+            print(
+                f"# Quarantined {sum(quarantined.values()):,} rows | "
+                + " | ".join(f"{reason} {count:,}" for reason, count in sorted(quarantined.items()))
+            )
+
+    @staticmethod
+    def parse_report(
+        report_path: str, import_datetime: str, offset: int = 0, known_kiosks: Optional[set] = None
+    ) -> tuple:
+        """
+        Read, prepare and validate a whole report, run in import worker processes. Returns the frame to
+        load and the quarantined rows. The read, prepare and validate seconds are kept in the frame's
+        attrs, for the writer's trace
+        """
+        start = time.perf_counter()
+        df = next(AppDB.read_report(report_path, offset=offset))
+        read_seconds = time.perf_counter() - start
+        df = AppDB.prepare_report_frame(df, os.path.split(report_path)[1], import_datetime)
+        prepare_seconds = time.perf_counter() - start - read_seconds
+        df, quarantine = AppDB.validate_report_frame(df, known_kiosks)
+        df.attrs["stages"] = {
+            "read": read_seconds,
+            "prepare": prepare_seconds,
+            "validate": time.perf_counter() - start - read_seconds - prepare_seconds,
+        }
+        return df, quarantine
+
+    def dimension_ids(self, conn: Connection, table_name: str, values: list) -> dict:
+        """
+        Map of dimension values to their ids, values not in the dimension table yet are added.
+        Resolved in bulk through the in memory dimension cache, which is dropped when an import rolls back
+        """
+        dimension = self.dimensions()[table_name]
+        cache = self.dimension_cache.setdefault(table_name, {})
+        if missing := [each for each in dict.fromkeys(values) if each not in cache]:
+            conn.executemany(
+                f"INSERT OR IGNORE INTO {table_name} ({dimension['value']}) VALUES (?);", ((each,) for each in missing)
+            )
+            for start in range(0, len(missing), 500):
+                batch = missing[start : start + 500]
+                qry = (
+                    f"SELECT {dimension['key']} AS id, {dimension['value']} AS value FROM {table_name} "
+                    f"WHERE {dimension['value']} IN ({', '.join('?' * len(batch))});"
+                )
+                cache.update((each["value"], each["id"]) for each in conn.execute(qry, batch).fetchall())
+        return cache
+
+    def encode_dimensions(self, conn: Connection, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Replace the encoded text columns of a prepared frame with their dimension ids, missing text is ''
+        """
+        import numpy as np
+
+        encoded = df.drop(columns=list(self.encoded_columns()))
+        for table_name, dimension in self.dimensions().items():
+            for column, id_column in dimension["columns"].items():
+                values = df[column].astype("category")
+                names = values.cat.categories.to_list() + [""]
+                ids = self.dimension_ids(conn, table_name, names)
+                # code -1, a missing value, indexes the trailing ''
+                encoded[id_column] = np.array([ids[each] for each in names], dtype="int64")[values.cat.codes.to_numpy()]
+        return encoded
+
+    def write_report_frame(self, conn: Connection, df: pd.DataFrame, chunk_size: int = IMPORT_CHUNK_SIZE) -> int:
+        """
+        Write a prepared report frame, returns the number of rows written
+        """
+        table_name = self.storage_table(conn)
+        if table_name == "ride_trip":
+            with self.trace("encode", rows=len(df)):
+                df = self.encode_dimensions(conn, df)
+        columns = df.columns.to_list()
+        sql = self.replace_sql(
+            columns + [each for each in self.datetime_text_columns() if each not in columns], table_name
+        )
+        for rows in self.trace_iter("bind", self.frame_rows(df, chunk_size)):
+            with self.trace("execute", rows=len(rows)):
+                conn.executemany(sql, rows)
+        return len(df)
+
+    @staticmethod
+    def report_paths(source: str) -> list:
+        """
+        Expand a report file, directory or glob pattern into a sorted list of report files
+        """
+        if os.path.isdir(source):
+            paths = {path for pattern in REPORT_PATTERNS for path in glob.glob(os.path.join(source, pattern))}
+        else:
+            paths = set(glob.glob(source))
+        return sorted(path for path in paths if os.path.isfile(path))
+
+    @staticmethod
+    def file_hashes(path: str, prefix_size: Optional[int] = None) -> tuple:
+        """
+        Returns the sha256 of the first prefix_size bytes and of the whole file, in one read
+        """
+        hasher = hashlib.sha256()
+        prefix_hash = None
+        with open(path, "rb") as fopen:
+            if prefix_size is not None:
+                remaining = prefix_size
+                while remaining and (block := fopen.read(min(HASH_BLOCK_SIZE, remaining))):
+                    hasher.update(block)
+                    remaining -= len(block)
+                prefix_hash = hasher.hexdigest()
+            while block := fopen.read(HASH_BLOCK_SIZE):
+                hasher.update(block)
+        return prefix_hash, hasher.hexdigest()
+
+    @staticmethod
+    def ends_with_newline(path: str, offset: int) -> bool:
+        with open(path, "rb") as fopen:
+            fopen.seek(offset - 1)
+            return fopen.read(1) == b"\n"
+
+    def manifest_plan(self, conn: Connection, report_path: str, force: bool = False) -> dict:
+        """
+        Decide how a report is imported, from its import manifest entry:
+        'skip' when unchanged, 'append' when only new rows were added to the end of the file,
+        otherwise 'full'. Size and mtime are compared first, the file is only hashed when they differ
+        """
+        stat = os.stat(report_path)
+        filename = os.path.split(report_path)[1]
+        plan = {"action": "full", "offset": 0, "size": stat.st_size, "mtime": stat.st_mtime, "hash": None}
+        plan["entry"] = conn.execute("SELECT * FROM import_manifest WHERE FileName = ?;", (filename,)).fetchone()
+        entry = plan["entry"]
+        if not force and entry and (entry["FileSize"], entry["FileMtime"]) == (stat.st_size, stat.st_mtime):
+            plan.update(action="skip", hash=entry["ContentHash"])
+            return plan
+
+        grown = bool(entry) and stat.st_size > entry["FileSize"]
+        prefix_hash, plan["hash"] = self.file_hashes(report_path, entry["FileSize"] if grown else None)
+        if force or not entry:
+            return plan
+
+        if plan["hash"] == entry["ContentHash"]:
+            plan["action"] = "skip"
+        elif (
+            grown
+            and prefix_hash == entry["ContentHash"]
+            and not report_path.lower().endswith(COMPRESSED_SUFFIXES)
+            and self.ends_with_newline(report_path, entry["FileSize"])
+        ):
+            plan.update(action="append", offset=entry["FileSize"])
+        return plan
+
+    @staticmethod
+    def record_manifest(conn: Connection, filename: str, plan: dict, load: dict) -> None:
+        """
+        Save a report's manifest entry, load holds the rows, trip id range, seconds and import datetime
+        """
+        entry = plan["entry"] if plan["action"] != "full" else None
+        row_count = load["rows"] + (entry["RowCount"] if entry else 0)
+        trip_ids = [each for each in (load["trip_id_min"], load["trip_id_max"]) if each is not None]
+        if entry and entry["TripIdMin"] is not None:
+            trip_ids += [entry["TripIdMin"], entry["TripIdMax"]]
+        conn.execute(
+            "REPLACE INTO import_manifest (FileName, FileSize, FileMtime, ContentHash, RowCount, TripIdMin, "
+            "TripIdMax, ImportSeconds, ImportDateTime) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);",
+            (
+                filename,
+                plan["size"],
+                plan["mtime"],
+                plan["hash"],
+                row_count,
+                min(trip_ids, default=None),
+                max(trip_ids, default=None),
+                load["seconds"],
+                load["import_datetime"],
+            ),
+        )
+
+    def loaded_trip_ids(
+        self, conn: Connection, trip_ids: np.ndarray, filename: str, import_datetime: str, trip_range: tuple
+    ) -> np.ndarray:
+        """
+        The TripIds an import of filename at import_datetime has already loaded, of those in its trip_range so far.
+        They are looked up by the TripId primary key, in the main database or the shards
+        """
+        import numpy as np
+
+        if trip_range[0] is None:
+            return np.array([], dtype="int64")
+        trip_ids = trip_ids[(trip_ids >= trip_range[0]) & (trip_ids <= trip_range[1])]
+        if not len(trip_ids):
+            return trip_ids
+        qry = (
+            "SELECT TripId FROM ride_data WHERE TripId IN (SELECT value FROM json_each(?)) "
+            "AND FileName = ? AND ImportDateTime = ?;"
+        )
+        params = (json.dumps(trip_ids.tolist()), filename, import_datetime)
+
+        def read(app_db: AppDB) -> list:
+            with app_db.reader() as shard_conn:
+                return [each["TripId"] for each in shard_conn.execute(qry, params).fetchall()]
+
+        if self.shard_months:
+            loaded = [each for rows in self.shard_map(read, self.shard_keys()) for each in rows]
+        else:
+            loaded = [each["TripId"] for each in conn.execute(qry, params).fetchall()]
+        return np.array(loaded, dtype="int64")
+
+    @staticmethod
+    def trip_id_range(df: pd.DataFrame, current: tuple = (None, None)) -> tuple:
+        """
+        Widen a (min, max) TripId range with the ids of a frame
+        """
+        if df.empty:
+            return current
+        bounds = [each for each in current if each is not None] + [int(df["TripId"].min()), int(df["TripId"].max())]
+        return min(bounds), max(bounds)
+
+    @staticmethod
+    def print_stages(stages: dict) -> None:
+        print(
+            "# Stages | "
+            + " | ".join(f"{stage} {total['seconds']:.3f}s {total['rows']:,} rows" for stage, total in stages.items())
+        )
+
+    def import_report_to_db(
+        self, report_path: str, chunk_size: int = IMPORT_CHUNK_SIZE, stream: bool = False, force: bool = False
+    ) -> dict:
+        """
+        Import a csv file, of correct format to db
+
+        Rows are loaded with executemany, chunk_size rows per call, inside a single transaction.
+        With stream, the file is read chunk_size rows at a time and each chunk is committed as it
+        is loaded, so memory use does not grow with the file size. The derived tables and data version
+        are refreshed in each chunk's transaction, the manifest entry is recorded with the last one, so
+        a failed streamed import loads in full again.
+        Unchanged reports are skipped and appended reports only load their new rows, unless force is set.
+        Rows failing validate_report_frame are saved to import_quarantine with their reason, the rest load.
+        In sharded storage the rows go to the shards of their checkout dates, see write_shards.
+        Returns a summary of the load, empty on failure, with per stage totals when tracing.
+        """
+        summary = {}
+        if self.tracer is not None:
+            self.tracer.take_totals()
+        with self.writer() as conn:
+            try:
+                start = time.perf_counter()
+                filename = os.path.split(report_path)[1]
+                import_datetime = time.strftime("%Y-%m-%d %H:%M:%S")
+                print(f"# Importing report: '{filename}'")
+
+                self.apply_pragmas(conn, self.import_pragmas())
+                conn.execute("BEGIN;")
+                conn.execute(self.create_manifest_schema())
+                for sql in self.create_quarantine_schema():
+                    conn.execute(sql)
+                plan = self.manifest_plan(conn, report_path, force)
+                row_count = 0
+                trip_ids = (None, None)
+                quarantined = Counter()
+                touched = {"files": {filename}, "days": set(), "bikes": set(), "appended": {}}
+                if plan["action"] != "skip":
+                    if plan["action"] == "full":
+                        conn.execute("DELETE FROM import_quarantine WHERE FileName = ?;", (filename,))
+                    frames = self.read_report(report_path, chunk_size if stream else None, plan["offset"])
+                    for df in self.trace_iter("read", frames, file=filename):
+                        # pre-sql data processing
+                        with self.trace("prepare", file=filename, rows=len(df)):
+                            df = self.prepare_report_frame(df, filename, import_datetime)
+                        with self.trace("validate", file=filename, rows=len(df)):
+                            # earlier chunks are committed, their TripIds are probed rather than kept
+                            seen_trip_ids = None
+                            if stream:
+                                seen_trip_ids = functools.partial(
+                                    self.loaded_trip_ids,
+                                    conn,
+                                    filename=filename,
+                                    import_datetime=import_datetime,
+                                    trip_range=trip_ids,
+                                )
+                            df, quarantine = self.validate_report_frame(df, self.known_kiosks, seen_trip_ids)
+                            quarantined.update(self.write_quarantine(conn, quarantine, filename, import_datetime))
+                        if self.shard_months:
+                            row_count += self.write_shards(df, chunk_size)
+                        else:
+                            with self.trace("track", file=filename, rows=len(df)):
+                                self.track_touched(conn, df, touched)
+                            row_count += self.write_report_frame(conn, df, chunk_size)
+                        trip_ids = self.trip_id_range(df, trip_ids)
+                        if stream:
+                            with self.trace("refresh", file=filename):
+                                self.refresh_derived(conn, touched)
+                            touched = {"files": {filename}, "days": set(), "bikes": set(), "appended": {}}
+                            with self.trace("commit", file=filename):
+                                conn.commit()
+                            conn.execute("BEGIN;")
+
+                if plan["action"] == "skip":
+                    conn.execute(
+                        "UPDATE import_manifest SET FileMtime = ? WHERE FileName = ?;", (plan["mtime"], filename)
+                    )
+                else:
+                    with self.trace("refresh", file=filename):
+                        self.refresh_derived(conn, touched)
+                    # the manifest seconds cover the load and refresh, all but the commit of its own row
+                    seconds = round(time.perf_counter() - start, 3)
+                    load = {"rows": row_count, "seconds": seconds, "import_datetime": import_datetime}
+                    load.update(trip_id_min=trip_ids[0], trip_id_max=trip_ids[1])
+                    self.record_manifest(conn, filename, plan, load)
+                with self.trace("commit", file=filename):
+                    conn.commit()
+                elapsed = time.perf_counter() - start
+
+                summary = {
+                    "file": filename,
+                    "status": {"skip": "skipped", "append": "appended", "full": "imported"}[plan["action"]],
+                    "rows": row_count,
+                    "quarantined": dict(quarantined),
+                    "seconds": round(elapsed, 3),
+                    "rows_per_sec": round(row_count / elapsed) if elapsed else 0,
+                }
+                if plan["action"] == "skip":
+                    print(f"# Skipped unchanged report: '{filename}'")
+                else:
+                    print(
+                        f"# Imported {summary['rows']:,} rows in {elapsed:.2f}s ({summary['rows_per_sec']:,} rows/sec)"
+                    )
+                    self.print_quarantined(summary["quarantined"])
+                if self.tracer is not None:
+                    summary["stages"] = self.tracer.take_totals()
+                    self.print_stages(summary["stages"])
+            except Exception as e:
+                conn.rollback()
+                self.dimension_cache.clear()
+                print(f"\n# Import report failure | {e}")
+        return summary
+
+    def import_reports(
+        self, source: str, workers: Optional[int] = None, chunk_size: int = IMPORT_CHUNK_SIZE, force: bool = False
+    ) -> list:
+        """
+        Import every report matched by a file, directory or glob pattern
+
+        Reports are parsed in a pool of worker processes, parsed frames are written by this
+        process over a single connection, one transaction per report. At most two reports per
+        worker are held in memory waiting to be written. The import manifest is checked before
+        a report is parsed, so unchanged reports are skipped and appended reports load their tail.
+        Invalid rows are validated out in the workers and saved to import_quarantine by the writer.
+        Returns one result per report, with status 'imported', 'appended', 'skipped' or 'failed'.
+        """
+        results = []
+        paths = self.report_paths(source)
+        if not paths:
+            print(f"\n# No reports found | {source}")
+            return results
+
+        import_datetime = time.strftime("%Y-%m-%d %H:%M:%S")
+        workers = workers or os.cpu_count() or 1
+        print(f"# Importing {len(paths)} reports with {workers} workers")
+        from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+        with self.writer() as conn, ProcessPoolExecutor(max_workers=workers) as pool:
+            self.apply_pragmas(conn, self.import_pragmas())
+            conn.execute(self.create_manifest_schema())
+            for sql in self.create_quarantine_schema():
+                conn.execute(sql)
+            conn.commit()
+            pending = {}
+            queued = iter(paths)
+            while True:
+                while len(pending) < workers * 2 and (path := next(queued, None)):
+                    filename = os.path.split(path)[1]
+                    try:
+                        plan = self.manifest_plan(conn, path, force)
+                    except Exception as e:
+                        results.append({"file": filename, "status": "failed", "error": str(e)})
+                        print(f"\n# Import report failure | {filename} | {e}")
+                        continue
+                    if plan["action"] == "skip":
+                        conn.execute(
+                            "UPDATE import_manifest SET FileMtime = ? WHERE FileName = ?;", (plan["mtime"], filename)
+                        )
+                        conn.commit()
+                        results.append({"file": filename, "status": "skipped", "rows": 0, "seconds": 0.0})
+                        print(f"# Skipped unchanged report: '{filename}'")
+                        continue
+                    future = pool.submit(self.parse_report, path, import_datetime, plan["offset"], self.known_kiosks)
+                    pending[future] = (path, plan, time.perf_counter())
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path, plan, start = pending.pop(future)
+                    filename = os.path.split(path)[1]
+                    try:
+                        df, quarantine = future.result()
+                        if self.tracer is not None:
+                            self.tracer.take_totals()
+                            for stage, seconds in df.attrs.get("stages", {}).items():
+                                self.tracer.add(stage, seconds, len(df), file=filename)
+                        conn.execute("BEGIN;")
+                        if plan["action"] == "full":
+                            conn.execute("DELETE FROM import_quarantine WHERE FileName = ?;", (filename,))
+                        quarantined = self.write_quarantine(conn, quarantine, filename, import_datetime)
+                        touched = {"files": {filename}, "days": set(), "bikes": set(), "appended": {}}
+                        if self.shard_months:
+                            row_count = self.write_shards(df, chunk_size)
+                        else:
+                            with self.trace("track", file=filename, rows=len(df)):
+                                self.track_touched(conn, df, touched)
+                            row_count = self.write_report_frame(conn, df, chunk_size)
+                        trip_id_min, trip_id_max = self.trip_id_range(df)
+                        del df
+                        with self.trace("refresh", file=filename):
+                            self.refresh_derived(conn, touched)
+                        seconds = round(time.perf_counter() - start, 3)
+                        load = {"rows": row_count, "seconds": seconds, "import_datetime": import_datetime}
+                        load.update(trip_id_min=trip_id_min, trip_id_max=trip_id_max)
+                        self.record_manifest(conn, filename, plan, load)
+                        with self.trace("commit", file=filename):
+                            conn.commit()
+                        elapsed = time.perf_counter() - start
+                        status = "appended" if plan["action"] == "append" else "imported"
+                        results.append(
+                            {
+                                "file": filename,
+                                "status": status,
+                                "rows": row_count,
+                                "quarantined": quarantined,
+                                "seconds": round(elapsed, 3),
+                            }
+                        )
+                        print(f"# Imported '{filename}': {row_count:,} rows in {elapsed:.2f}s")
+                        self.print_quarantined(quarantined)
+                        if self.tracer is not None:
+                            results[-1]["stages"] = self.tracer.take_totals()
+                            self.print_stages(results[-1]["stages"])
+                    except Exception as e:
+                        conn.rollback()
+                        self.dimension_cache.clear()
+                        results.append({"file": filename, "status": "failed", "error": str(e)})
+                        print(f"\n# Import report failure | {filename} | {e}")
+        return results
+
+    def delete_rows(
+        self,
+        where: str,
+        params: tuple = (),
+        batch_size: int = DELETE_BATCH_SIZE,
+        epochs: tuple = (None, None),
+        forget_files: bool = False,
+    ) -> dict:
+        """
+        Delete the ride_data rows matching where, batch_size trips per transaction so the write lock is
+        released between batches. Each batch refreshes the stats, rollups and sketches of its files and days
+        and bumps the data version. The bike timeline of all the touched bikes is refreshed once, after the
+        last batch or the failing one, so a failed delete leaves the derived tables matching the rows removed
+        so far. With forget_files the manifest entries of its files are removed too, so the reports can be
+        imported again, otherwise the next import skips them and the rows stay deleted. The freed pages are
+        then returned to the file system with incremental vacuum.
+        In sharded storage the delete runs in each shard overlapping the (start, end) checkout epochs.
+        Returns a summary of the delete, empty on a failure before any row was removed, with the error
+        on a failure after some were
+        """
+        if self.shard_months:
+            return self.delete_shard_rows(where, params, batch_size, epochs, forget_files)
+        summary = {}
+        deleted_files, bikes = set(), set()
+        removed = 0
+        with self.writer() as conn:
+            try:
+                start = time.perf_counter()
+                select_sql = (
+                    f"SELECT TripId, FileName, Bike, CheckoutEpoch / 86400 AS day FROM ride_data WHERE {where} LIMIT ?;"
+                )
+                while True:
+                    conn.execute("BEGIN IMMEDIATE;")
+                    batch = conn.execute(select_sql, (*params, batch_size)).fetchall()
+                    if batch:
+                        conn.executemany(
+                            f"DELETE FROM {self.storage_table(conn)} WHERE TripId = ?;",
+                            ((each["TripId"],) for each in batch),
+                        )
+                        batch_touched = {"files": set(), "days": set(), "bikes": set(), "appended": {}}
+                        batch_touched["files"].update(each["FileName"] for each in batch)
+                        batch_touched["days"].update(each["day"] for each in batch if each["day"] is not None)
+                        batch_touched["bikes"].update(each["Bike"] for each in batch)
+                        # one timeline refresh after the batches, it may scan all trips when many bikes are touched
+                        self.refresh_derived(conn, batch_touched, timeline=False)
+                        files = list(batch_touched["files"])
+                        if forget_files:
+                            conn.execute(
+                                f"DELETE FROM import_manifest WHERE FileName IN ({', '.join('?' * len(files))});",
+                                files,
+                            )
+                        deleted_files.update(files)
+                    conn.commit()
+                    removed += len(batch)
+                    bikes.update(each["Bike"] for each in batch)
+                    if len(batch) < batch_size:
+                        break
+
+                self.commit_bike_timeline(conn, bikes)
+                bikes = set()
+                pages = self.incremental_vacuum(conn)
+
+                elapsed = time.perf_counter() - start
+                summary = {"rows": removed, "files": sorted(deleted_files), "pages_freed": pages}
+                summary["seconds"] = round(elapsed, 3)
+                print(f"# Deleted {removed:,} rows in {elapsed:.2f}s, freed {pages:,} pages")
+            except Exception as e:
+                conn.rollback()
+                print(f"\n# Delete rows failure | {e}")
+                try:
+                    self.commit_bike_timeline(conn, bikes)
+                except Exception as timeline_error:
+                    conn.rollback()
+                    print(f"\n# Bike timeline failure | {timeline_error}")
+                if removed:
+                    summary = {"rows": removed, "files": sorted(deleted_files), "pages_freed": 0, "error": str(e)}
+                    summary["seconds"] = round(time.perf_counter() - start, 3)
+        return summary
+
+    def delete_rows_by_filename(self, filename: str, batch_size: int = DELETE_BATCH_SIZE) -> dict:
+        return self.delete_rows("FileName = ?", (filename,), batch_size, forget_files=True)
+
+    def delete_rows_by_date_range(
+        self, start: Optional[str], end: Optional[str], batch_size: int = DELETE_BATCH_SIZE
+    ) -> dict:
+        """
+        Delete trips with a checkout day between start and end, 'YYYY-MM-DD' inclusive. Open ends are allowed,
+        but not both. The reports keep their manifest entries, importing them again does not restore the trips
+        """
+        start_epoch, end_epoch = self.date_range_epochs(start, end)
+        if start_epoch is None and end_epoch is None:
+            raise ValueError("a start or end date is required")
+        where = ["CheckoutEpoch >= ?"] * (start_epoch is not None) + ["CheckoutEpoch < ?"] * (end_epoch is not None)
+        params = tuple(each for each in (start_epoch, end_epoch) if each is not None)
+        return self.delete_rows(" AND ".join(where), params, batch_size, (start_epoch, end_epoch))
+
+    def delete_shard_rows(
+        self,
+        where: str,
+        params: tuple = (),
+        batch_size: int = DELETE_BATCH_SIZE,
+        epochs: tuple = (None, None),
+        forget_files: bool = False,
+    ) -> dict:
+        """
+        delete_rows in each shard overlapping the (start, end) checkout epochs, then with forget_files the
+        manifest entries of the touched files. Frozen shards fail the delete before any row is removed.
+        A shard failing stops the delete, the rows the shards removed before it are still counted in the
+        summary, with the error, and their files and the data version updated
+        """
+        summary = {"rows": 0, "files": [], "pages_freed": 0, "seconds": 0.0}
+        try:
+            keys = self.shard_keys(*epochs)
+            if frozen := [key for key in keys if self.shard_frozen(key)]:
+                raise Exception(f"frozen shards {', '.join(frozen)}")
+            for key in keys:
+                removed = self.shard(key).delete_rows(where, params, batch_size)
+                if removed:
+                    summary["rows"] += removed["rows"]
+                    summary["files"] = sorted(set(summary["files"]) | set(removed["files"]))
+                    summary["pages_freed"] += removed["pages_freed"]
+                    summary["seconds"] = round(summary["seconds"] + removed["seconds"], 3)
+                if not removed or "error" in removed:
+                    summary["error"] = f"shard {key} | {removed.get('error', 'delete failed')}"
+                    break
+            if summary["rows"]:
+                with self.writer() as conn:
+                    files = summary["files"]
+                    conn.execute("BEGIN;")
+                    if forget_files:
+                        conn.execute(
+                            f"DELETE FROM import_manifest WHERE FileName IN ({', '.join('?' * len(files))});", files
+                        )
+                    self.bump_data_version(conn)
+        except Exception as e:
+            print(f"\n# Delete rows failure | {e}")
+            return {}
+        return summary if summary["rows"] or "error" not in summary else {}
+
+    @staticmethod
+    def incremental_vacuum(conn: Connection, step_pages: int = VACUUM_STEP_PAGES) -> int:
+        """
+        Release free pages step_pages at a time, each step is a short write transaction.
+        Returns the pages freed, 0 when the database was not created with incremental auto vacuum
+        """
+        if conn.execute("PRAGMA auto_vacuum;").fetchone()["auto_vacuum"] != 2:
+            return 0
+        freed = 0
+        while free_pages := conn.execute("PRAGMA freelist_count;").fetchone()["freelist_count"]:
+            # the pragma frees a page per step, a cursor stops stepping it after the first page
+            conn.executescript(f"BEGIN; PRAGMA incremental_vacuum({step_pages}); COMMIT;")
+            step_freed = free_pages - conn.execute("PRAGMA freelist_count;").fetchone()["freelist_count"]
+            if not step_freed:
+                break
+            freed += step_freed
+        return freed
+
+    def enable_incremental_vacuum(self) -> None:
+        """
+        Switch a database created before incremental auto vacuum over to it, this runs one full, blocking VACUUM
+        """
+        with self.writer() as conn:
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+            conn.execute("VACUUM;")
+
+    def create_normalized_tables(self, conn: Connection) -> int:
+        """
+        Create and fill the dimension tables and ride_trip from the ride_data table, then replace it with the
+        ride_data view, in the caller's transaction. Returns the number of trips moved
+        """
+        encoded = self.encoded_columns()
+        for table_name, dimension in self.dimensions().items():
+            conn.execute(
+                f"CREATE TABLE {table_name} (`{dimension['key']}` INTEGER PRIMARY KEY, "
+                f"`{dimension['value']}` TEXT NOT NULL UNIQUE);"
+            )
+            conn.execute(f"INSERT INTO {table_name} ({dimension['value']}) VALUES ('');")
+            for column in dimension["columns"]:
+                conn.execute(
+                    f"INSERT OR IGNORE INTO {table_name} ({dimension['value']}) "
+                    f"SELECT DISTINCT COALESCE({column}, '') FROM ride_data;"
+                )
+
+        # the current columns, in their current order, so the view matches SELECT * on the table
+        definitions, trip_columns, selects, joins, view_columns = [], [], [], [], []
+        for each in conn.execute("PRAGMA table_info(ride_data);").fetchall():
+            name = each["name"]
+            if name not in encoded:
+                definitions.append(f"`{name}` {each['type']}{' PRIMARY KEY' if each['pk'] else ''}")
+                trip_columns.append(name)
+                selects.append(f"r.{name}")
+                view_columns.append(f"t.{name}")
+                continue
+            table_name, dimension = next(
+                (key, value) for key, value in self.dimensions().items() if name in value["columns"]
+            )
+            alias = f"d_{len(joins)}"
+            definitions.append(f"`{encoded[name]}` INTEGER")
+            trip_columns.append(encoded[name])
+            selects.append(f"{alias}.{dimension['key']}")
+            view_columns.append(f"{alias}.{dimension['value']} AS {name}")
+            joins.append((table_name, dimension, alias, name))
+
+        conn.execute(f"CREATE TABLE ride_trip ({', '.join(definitions)});")
+        conn.execute(
+            f"INSERT INTO ride_trip ({', '.join(trip_columns)}) SELECT {', '.join(selects)} FROM ride_data r "
+            + " ".join(
+                f"JOIN {table_name} {alias} ON {alias}.{dimension['value']} = COALESCE(r.{name}, '')"
+                for table_name, dimension, alias, name in joins
+            )
+            + ";"
+        )
+        conn.execute("DROP TABLE ride_data;")
+        for index_name, index_columns in self.ride_trip_indexes().items():
+            conn.execute(f"CREATE INDEX {index_name} ON ride_trip ({', '.join(index_columns)});")
+        conn.execute(
+            f"CREATE VIEW ride_data AS SELECT {', '.join(view_columns)} FROM ride_trip t "
+            + " ".join(
+                f"JOIN {table_name} {alias} ON {alias}.{dimension['key']} = t.{encoded[name]}"
+                for table_name, dimension, alias, name in joins
+            )
+            + ";"
+        )
+        return conn.execute("SELECT COUNT(*) AS cnt FROM ride_trip;").fetchone()["cnt"]
+
+    def normalize_storage(self) -> dict:
+        """
+        Move the trips to the normalized layout, in one transaction: each dimensions() text value is stored
+        once in its dimension table, the ride_trip table holds their integer ids, and a ride_data view joins
+        them back to the original column set so existing queries keep working. Missing text becomes ''.
+        Every trip is rewritten, so the file is compacted with one full VACUUM afterwards.
+        Returns a summary, empty on failure
+        """
+        summary = {}
+        with self.writer() as conn:
+            try:
+                if self.shard_months:
+                    raise Exception("sharded storage is not normalized")
+                if self.storage_table(conn) == "ride_trip":
+                    summary = {"status": "normalized", "rows": 0}
+                    print("# Storage is already normalized")
+                else:
+                    start = time.perf_counter()
+                    size_before = os.path.getsize(self.db_path)
+                    conn.execute("BEGIN IMMEDIATE;")
+                    rows = self.create_normalized_tables(conn)
+                    self.bump_data_version(conn)
+                    conn.commit()
+                    self.dimension_cache.clear()
+                    conn.execute("VACUUM;")
+
+                    elapsed = time.perf_counter() - start
+                    summary = {"status": "normalized", "rows": rows, "seconds": round(elapsed, 3)}
+                    summary.update(size_before=size_before, size_after=os.path.getsize(self.db_path))
+                    print(
+                        f"# Normalized {rows:,} rows in {elapsed:.2f}s, "
+                        f"{size_before:,} to {summary['size_after']:,} bytes"
+                    )
+            except Exception as e:
+                conn.rollback()
+                print(f"\n# Normalize storage failure | {e}")
+        return summary
+
+    def shard_root(self) -> str:
+        """
+        Directory of the shard files, next to the main database
+        """
+        return os.path.splitext(self.db_path)[0] + ".shards"
+
+    def shard_path(self, key: str) -> str:
+        return os.path.join(self.shard_root(), f"ride_{key}.db")
+
+    @staticmethod
+    def file_bytes(path: str) -> int:
+        """
+        Size of a database file with its write ahead log
+        """
+        return sum(os.path.getsize(each) for each in (path, path + "-wal") if os.path.exists(each))
+
+    @staticmethod
+    def shard_bounds(key: str) -> tuple:
+        """
+        [start, end) checkout epoch range of a 'YYYY' or 'YYYY-MM' shard, open for the undated shard
+        """
+        if key == UNDATED_SHARD:
+            return None, None
+        year, month = int(key[:4]), int(key[5:7]) if len(key) > 4 else 1
+        start = calendar.timegm((year, month, 1, 0, 0, 0))
+        if len(key) == 4:
+            return start, calendar.timegm((year + 1, 1, 1, 0, 0, 0))
+        return start, calendar.timegm((year + month // 12, month % 12 + 1, 1, 0, 0, 0))
+
+    def shard_keys(self, start_epoch: Optional[int] = None, end_epoch: Optional[int] = None) -> list:
+        """
+        Keys of the shards on disk overlapping a [start, end) checkout epoch range, all of them for an open range.
+        Trips without a checkout epoch are in the undated shard, which only an open range includes
+        """
+        keys = []
+        for path in sorted(glob.glob(os.path.join(self.shard_root(), "ride_*.db"))):
+            key = os.path.basename(path)[5:-3]
+            first, last = self.shard_bounds(key)
+            if key == UNDATED_SHARD:
+                if start_epoch is None and end_epoch is None:
+                    keys.append(key)
+            elif (end_epoch is None or first < end_epoch) and (start_epoch is None or last > start_epoch):
+                keys.append(key)
+        return keys
+
+    def shard(self, key: str) -> AppDB:
+        """
+        AppDB of a shard, its file and schema are created on first use. Shard results are not cached,
+        the main database caches the gathered results
+        """
+        shard = self.shards.get(key)
+        if shard is None:
+            os.makedirs(self.shard_root(), exist_ok=True)
+            shard = AppDB(self.shard_path(key))
+            shard.query_cache = None
+            shard.init_db(quiet=True)
+            self.shards[key] = shard
+        shard.tracer = self.tracer
+        return shard
+
+    @staticmethod
+    def shard_frames(df: pd.DataFrame, shard_months: int) -> Iterator[tuple]:
+        """
+        Yield (shard key, rows) parts of a prepared frame, by checkout year or month
+        """
+        import numpy as np
+
+        epochs = df["CheckoutEpoch"].to_numpy(dtype="float64", na_value=np.nan)
+        dated = ~np.isnan(epochs)
+        unit = "Y" if shard_months == 12 else "M"
+        periods = epochs[dated].astype("int64").astype("datetime64[s]").astype(f"datetime64[{unit}]")
+        for period in np.unique(periods):
+            mask = np.zeros(len(df), dtype=bool)
+            mask[dated] = periods == period
+            yield str(period), df.loc[mask]
+        if not dated.all():
+            yield UNDATED_SHARD, df.loc[~dated]
+
+    def shard_frozen(self, key: str) -> bool:
+        if not os.path.exists(self.shard_path(key)):
+            return False
+        rows = self.shard(key).query_rows("SELECT Value FROM db_meta WHERE Name = 'frozen';")
+        return bool(rows and rows[0]["Value"])
+
+    def moved_trips(self, parts: list) -> dict:
+        """
+        Rows of the trips of (shard key, rows) parts held by another shard, as their checkout moved period
+        since they were imported, by the key of the shard holding them
+        """
+        import numpy as np
+
+        trip_ids = {key: part["TripId"].to_numpy(dtype="int64") for key, part in parts}
+        all_ids = np.concatenate(list(trip_ids.values())) if trip_ids else np.array([], dtype="int64")
+        moved = {}
+        for key in self.shard_keys():
+            other_ids = np.setdiff1d(all_ids, trip_ids[key]) if key in trip_ids else np.unique(all_ids)
+            if not len(other_ids):
+                continue
+            shard = self.shard(key)
+            with shard.reader() as conn:
+                bounds = conn.execute("SELECT MIN(TripId) AS low, MAX(TripId) AS high FROM ride_data;").fetchone()
+                if bounds["low"] is None or bounds["high"] < other_ids[0] or bounds["low"] > other_ids[-1]:
+                    continue
+                rows = []
+                for offset in range(0, len(other_ids), 500):
+                    batch = [int(each) for each in other_ids[offset : offset + 500]]
+                    qry = (
+                        "SELECT TripId, FileName, Bike, CheckoutEpoch / 86400 AS day FROM ride_data "
+                        f"WHERE TripId IN ({', '.join('?' * len(batch))});"
+                    )
+                    rows += conn.execute(qry, batch).fetchall()
+            if rows:
+                moved[key] = rows
+        return moved
+
+    def write_shards(self, df: pd.DataFrame, chunk_size: int = IMPORT_CHUNK_SIZE) -> int:
+        """
+        Write a prepared frame to the shards of its checkout periods. Each part is written, and its shard's
+        derived tables refreshed, in one shard transaction, committed before the caller's manifest entry.
+        Earlier copies of re-imported trips whose checkout moved period are first deleted from the shards
+        holding them, by TripId. Writes to a frozen shard fail before any part is written.
+        Returns the number of rows written
+        """
+        parts = list(self.shard_frames(df, self.shard_months))
+        moved = self.moved_trips(parts)
+        if frozen := [key for key in sorted({key for key, _ in parts} | set(moved)) if self.shard_frozen(key)]:
+            raise Exception(f"frozen shards {', '.join(frozen)}")
+        for key, rows in moved.items():
+            shard = self.shard(key)
+            with shard.writer() as conn:
+                conn.execute("BEGIN;")
+                conn.executemany(
+                    f"DELETE FROM {shard.storage_table(conn)} WHERE TripId = ?;", ((each["TripId"],) for each in rows)
+                )
+                touched = {"files": set(), "days": set(), "bikes": set(), "appended": {}}
+                touched["files"].update(each["FileName"] for each in rows)
+                touched["days"].update(each["day"] for each in rows if each["day"] is not None)
+                touched["bikes"].update(each["Bike"] for each in rows)
+                with self.trace("refresh", shard=key):
+                    shard.refresh_derived(conn, touched)
+        for key, part in parts:
+            shard = self.shard(key)
+            with shard.writer() as conn:
+                shard.apply_pragmas(conn, shard.import_pragmas())
+                conn.execute("BEGIN;")
+                with self.trace("track", shard=key, rows=len(part)):
+                    touched = shard.track_touched(
+                        conn, part, {"files": set(), "days": set(), "bikes": set(), "appended": {}}
+                    )
+                shard.write_report_frame(conn, part, chunk_size)
+                with self.trace("refresh", shard=key):
+                    shard.refresh_derived(conn, touched)
+        return len(df)
+
+    def attach_shards(
+        self,
+        conn: Connection,
+        start_epoch: Optional[int] = None,
+        end_epoch: Optional[int] = None,
+        keys: Optional[list] = None,
+        main: bool = True,
+    ) -> list:
+        """
+        Attach the shards overlapping a checkout epoch range, or the given shard keys, to a connection in place
+        of any attached before, behind a TEMP ride_data view that shadows the empty main table, so ride_data
+        queries run unchanged. At most SQLITE_LIMIT_ATTACHED shards, 10 by default, can be attached, see
+        shard_batches for more. Returns the attached keys
+        """
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        cursor.execute("DROP VIEW IF EXISTS temp.ride_data;")
+        for _, name, _ in cursor.execute("PRAGMA database_list;").fetchall():
+            if name.startswith("shard_"):
+                cursor.execute(f"DETACH DATABASE {name};")
+        keys = self.shard_keys(start_epoch, end_epoch) if keys is None else keys
+        selects = ["SELECT * FROM main.ride_data"] * main
+        for key in keys:
+            schema = "shard_" + key.replace("-", "_")
+            try:
+                cursor.execute(f"ATTACH DATABASE ? AS {schema};", (self.shard_path(key),))
+            except sqlite3.OperationalError as e:
+                raise Exception(f"{len(keys)} shards in the date range, narrow it | {e}")
+            selects.append(f"SELECT * FROM {schema}.ride_data")
+        if not selects:
+            selects.append("SELECT * FROM main.ride_data WHERE 0")
+        cursor.execute(f"CREATE TEMP VIEW ride_data AS {' UNION ALL '.join(selects)};")
+        return keys
+
+    def shard_batches(
+        self, conn: Connection, start_epoch: Optional[int] = None, end_epoch: Optional[int] = None
+    ) -> Iterator[list]:
+        """
+        Attach the shards overlapping a checkout epoch range to a connection SHARD_ATTACH_BATCH at a time, see
+        attach_shards, yielding the keys of each batch while its ride_data view is in place. The first batch
+        also reads the main table, so each trip is read once across the batches
+        """
+        keys = self.shard_keys(start_epoch, end_epoch)
+        for offset in range(0, max(len(keys), 1), SHARD_ATTACH_BATCH):
+            yield self.attach_shards(conn, keys=keys[offset : offset + SHARD_ATTACH_BATCH], main=offset == 0)
+
+    def copy_shard_range(
+        self, conn: Connection, table_name: str, start_epoch: Optional[int] = None, end_epoch: Optional[int] = None
+    ) -> None:
+        """
+        Copy the trips of a checkout epoch range into a TEMP table of a connection with a CheckoutEpoch index,
+        for ranges over more shards than can be attached at once. The shards are detached afterwards
+        """
+        where = ["CheckoutEpoch >= ?"] * (start_epoch is not None) + ["CheckoutEpoch < ?"] * (end_epoch is not None)
+        params = tuple(each for each in (start_epoch, end_epoch) if each is not None)
+        select_sql = f"SELECT * FROM ride_data {'WHERE ' + ' AND '.join(where) if where else ''}"
+        conn.execute(f"DROP TABLE IF EXISTS temp.{table_name};")
+        for _ in self.shard_batches(conn, start_epoch, end_epoch):
+            conn.execute(f"CREATE TEMP TABLE IF NOT EXISTS {table_name} AS SELECT * FROM ride_data WHERE 0;")
+            conn.execute(f"INSERT INTO temp.{table_name} {select_sql};", params)
+            # an open transaction holds the shards, they can not be detached
+            conn.commit()
+        conn.execute(f"CREATE INDEX temp.idx_{table_name}_checkout_epoch ON {table_name} (CheckoutEpoch);")
+        self.attach_shards(conn, keys=[])
+
+    @contextlib.contextmanager
+    def shard_reader(self) -> Iterator[Connection]:
+        """
+        A connection to attach shards to, see attach_shards and shard_batches. It is not pooled,
+        the attachments go with it
+        """
+        conn = self.connect_db(self.db_path)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def shard_map(self, func, keys: list) -> list:
+        """
+        func applied to the AppDB of each shard key, one thread per shard, at most READ_POOL_SIZE at a time.
+        sqlite releases the GIL while a statement runs, so the shard queries overlap
+        """
+        shards = [self.shard(key) for key in keys]
+        if len(shards) < 2:
+            return [func(each) for each in shards]
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=min(len(shards), READ_POOL_SIZE)) as pool:
+            return list(pool.map(func, shards))
+
+    @staticmethod
+    def shard_merge_views() -> dict:
+        """
+        Derived tables kept per shard, merged across shards as views over the gathered 'partial' rows.
+        A day is in one shard, so rollup rows only need combining. A bike's idle gap across a shard boundary
+        is added to its timeline, not to the idle time of the kiosk
+        """
+        return {
+            "stats_catalog": (
+                "SELECT FileName, SUM(RowCount) AS RowCount, MIN(MinCheckout) AS MinCheckout, "
+                "MAX(MaxCheckout) AS MaxCheckout FROM partial GROUP BY FileName"
+            ),
+            "rollup_hourly": "SELECT * FROM partial",
+            "rollup_daily": "SELECT * FROM partial",
+            "bike_timeline": (
+                "WITH shard_gaps AS (SELECT *, FirstCheckout - MAX(LastReturn) OVER (PARTITION BY Bike "
+                "ORDER BY FirstCheckout ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING) AS Gap FROM partial) "
+                "SELECT Bike, SUM(Trips) AS Trips, SUM(RideSecs) AS RideSecs, "
+                "SUM(IdleSecs) + CAST(TOTAL(MAX(Gap, 0)) AS INTEGER) AS IdleSecs, "
+                "MAX(MAX(MaxIdleSecs), COALESCE(MAX(Gap), 0)) AS MaxIdleSecs, MIN(FirstCheckout) AS FirstCheckout, "
+                "MAX(LastCheckout) AS LastCheckout, MAX(LastReturn) AS LastReturn, "
+                "CASE WHEN MAX(LastReturn) > MIN(FirstCheckout) THEN "
+                "ROUND(SUM(RideSecs) * 1.0 / (MAX(LastReturn) - MIN(FirstCheckout)), 4) END AS Utilization, "
+                "SUM(Overlaps) AS Overlaps, SUM(Impossible) AS Impossible, "
+                "(SELECT p.LastKioskName FROM partial p WHERE p.Bike = shard_gaps.Bike "
+                "ORDER BY p.LastCheckout DESC LIMIT 1) AS LastKioskName FROM shard_gaps GROUP BY Bike"
+            ),
+            "bike_idle": (
+                "SELECT Bike, KioskName, SUM(Gaps) AS Gaps, SUM(IdleSecs) AS IdleSecs FROM partial "
+                "GROUP BY Bike, KioskName"
+            ),
+        }
+
+    def gather(
+        self,
+        sql: str,
+        params: tuple = (),
+        partial_sql: Optional[str] = None,
+        partial_params: tuple = (),
+        merge: Optional[str] = None,
+        start_epoch: Optional[int] = None,
+        end_epoch: Optional[int] = None,
+        prepare=None,
+    ) -> list:
+        """
+        Scatter gather query over the shards overlapping a checkout epoch range. partial_sql runs on the main
+        database and each shard in parallel, prepare(app_db, conn) first when given. The rows are gathered into
+        the 'partial' table of an in memory database, with the shard_merge_views() view named merge over them,
+        and sql runs there
+        """
+
+        def read(app_db: AppDB) -> tuple:
+            with app_db.reader() as conn:
+                if prepare is not None:
+                    prepare(app_db, conn)
+                cursor = conn.cursor()
+                cursor.row_factory = None
+                cursor.execute(partial_sql, partial_params)
+                return [each[0] for each in cursor.description], cursor.fetchall()
+
+        # the main database answers for the columns when no shard is in the range
+        results = [read(self)] + self.shard_map(read, self.shard_keys(start_epoch, end_epoch))
+        columns = results[0][0]
+        conn = sqlite3.connect(":memory:")
+        conn.row_factory = AppDB.dict_factory
+        try:
+            conn.execute(f"CREATE TABLE partial ({', '.join(f'`{each}`' for each in columns)});")
+            insert_sql = f"INSERT INTO partial VALUES ({', '.join('?' * len(columns))});"
+            for _, rows in results:
+                conn.executemany(insert_sql, rows)
+            if merge is not None:
+                conn.execute(f"CREATE VIEW {merge} AS {self.shard_merge_views()[merge]};")
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+    def shard_storage(self, period: str = "year") -> dict:
+        """
+        Move the trips to sharded storage, one database file per checkout year or month under shard_root().
+        Each shard holds its trips with their stats catalog, rollups, sketches and bike timeline, the main database
+        keeps the import manifest, quarantine and data version. Imports are then routed by checkout date, range
+        queries attach only the shards in their range, and stats and reports are gathered from the shards
+        in parallel, so old shards can be frozen, compacted or archived on their own.
+        Returns a summary, empty on failure
+        """
+        summary = {}
+        months = SHARD_PERIODS[period]
+        with self.writer() as conn:
+            try:
+                if self.shard_months:
+                    if self.shard_months != months:
+                        raise Exception(f"storage is sharded by {'year' if self.shard_months == 12 else 'month'}")
+                    print("# Storage is already sharded")
+                    return {"status": "sharded", "rows": 0, "shards": self.shard_keys()}
+                if self.storage_table(conn) == "ride_trip":
+                    raise Exception("normalized storage is not sharded")
+
+                start = time.perf_counter()
+                columns = [each["name"] for each in conn.execute("PRAGMA table_info(ride_data);").fetchall()]
+                key_sql = f"COALESCE(strftime('{'%Y' if months == 12 else '%Y-%m'}', CheckoutEpoch, 'unixepoch'), ?)"
+                qry = f"SELECT DISTINCT {key_sql} AS key FROM ride_data;"
+                keys = sorted(each["key"] for each in conn.execute(qry, (UNDATED_SHARD,)).fetchall())
+                rows = 0
+                for key in keys:
+                    shard = self.shard(key)
+                    conn.execute("ATTACH DATABASE ? AS shard;", (shard.db_path,))
+                    try:
+                        conn.execute("BEGIN;")
+                        # a shard left by an interrupted move is overwritten
+                        rows += conn.execute(
+                            f"INSERT OR REPLACE INTO shard.ride_data ({', '.join(columns)}) "
+                            f"SELECT {', '.join(columns)} FROM main.ride_data WHERE {key_sql} = ?;",
+                            (UNDATED_SHARD, key),
+                        ).rowcount
+                        conn.commit()
+                    finally:
+                        conn.execute("DETACH DATABASE shard;")
+                    with shard.writer() as shard_conn:
+                        shard_conn.execute("BEGIN;")
+                        shard.rebuild_stats(shard_conn)
+                        shard.rebuild_rollups(shard_conn)
+                        shard.rebuild_sketches(shard_conn)
+                        shard.refresh_bike_timeline(shard_conn)
+                        shard.bump_data_version(shard_conn)
+
+                conn.execute("BEGIN IMMEDIATE;")
+                # the main tables stay, empty, as the schema of gathered and attached queries
+                derived = (
+                    "stats_catalog",
+                    "rollup_hourly",
+                    "rollup_daily",
+                    "sketch_daily",
+                    "bike_timeline",
+                    "bike_idle",
+                    "bike_trip_flag",
+                )
+                for table_name in ("ride_data",) + derived:
+                    if self.db_table_exists(conn, table_name):
+                        conn.execute(f"DELETE FROM {table_name};")
+                conn.execute("INSERT OR REPLACE INTO db_meta VALUES ('shard_months', ?);", (months,))
+                self.bump_data_version(conn)
+                conn.commit()
+                self.shard_months = months
+                conn.execute("VACUUM;")
+
+                elapsed = time.perf_counter() - start
+                summary = {"status": "sharded", "rows": rows, "shards": keys, "seconds": round(elapsed, 3)}
+                print(f"# Moved {rows:,} rows to {len(keys)} shards in {elapsed:.2f}s")
+            except Exception as e:
+                conn.rollback()
+                print(f"\n# Shard storage failure | {e}")
+        return summary
+
+    def shard_list(self) -> list:
+        """
+        Row count, file count, checkout range, size and frozen flag of each shard
+        """
+
+        def describe(shard: AppDB) -> dict:
+            stats = shard.read_db_stats()
+            rows = shard.query_rows("SELECT Value FROM db_meta WHERE Name = 'frozen';")
+            return {**stats, "frozen": bool(rows and rows[0]["Value"]), "bytes": shard.file_bytes(shard.db_path)}
+
+        keys = self.shard_keys()
+        return [{"shard": key, **each} for key, each in zip(keys, self.shard_map(describe, keys))]
+
+    def freeze_shard(self, key: str, frozen: bool = True) -> None:
+        """
+        Refuse, or allow again, imports, restores and deletes of a shard's trips. The write ahead log is
+        checkpointed, so a frozen shard is one self contained file
+        """
+        if key not in self.shard_keys():
+            raise ValueError(f"no shard {key}")
+        with self.shard(key).writer() as conn:
+            conn.execute(
+                "INSERT INTO db_meta VALUES ('frozen', ?) ON CONFLICT (Name) DO UPDATE SET Value = excluded.Value;",
+                (int(frozen),),
+            )
+            conn.commit()
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+        print(f"# Shard {key} {'frozen' if frozen else 'thawed'}")
+
+    def compact_shard(self, key: str) -> dict:
+        """
+        Rebuild one shard file with VACUUM and checkpoint it, returns its size before and after
+        """
+        if key not in self.shard_keys():
+            raise ValueError(f"no shard {key}")
+        shard = self.shard(key)
+        size_before = shard.file_bytes(shard.db_path)
+        with shard.writer() as conn:
+            conn.execute("VACUUM;")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+        summary = {"shard": key, "size_before": size_before, "size_after": shard.file_bytes(shard.db_path)}
+        print(f"# Compacted shard {key}, {size_before:,} to {summary['size_after']:,} bytes")
+        return summary
+
+    def export_rows(
+        self,
+        output,
+        start: Optional[str] = None,
+        end: Optional[str] = None,
+        export_format: str = "csv",
+        batch_size: int = EXPORT_BATCH_SIZE,
+    ) -> int:
+        """
+        Stream ride_data rows with a checkout day between start and end to an open text file, as csv with a
+        header or as JSON lines. Rows are fetched as plain tuples, batch_size at a time. Sharded, the shards
+        are streamed a batch of them at a time, see shard_batches. Returns the number of rows written
+        """
+        start_epoch, end_epoch = self.date_range_epochs(start, end)
+        where = ["CheckoutEpoch >= ?"] * (start_epoch is not None) + ["CheckoutEpoch < ?"] * (end_epoch is not None)
+        params = tuple(each for each in (start_epoch, end_epoch) if each is not None)
+        row_count = 0
+        writer = csv.writer(output) if export_format == "csv" else None
+        with self.shard_reader() if self.shard_months else self.reader() as conn:
+            batches = self.shard_batches(conn, start_epoch, end_epoch) if self.shard_months else [None]
+            for offset, _ in enumerate(batches):
+                cursor = conn.cursor()
+                cursor.row_factory = None
+                cursor.execute(f"SELECT * FROM ride_data {'WHERE ' + ' AND '.join(where) if where else ''};", params)
+                columns = [column[0] for column in cursor.description]
+                if writer and offset == 0:
+                    writer.writerow(columns)
+                while rows := cursor.fetchmany(batch_size):
+                    if writer:
+                        writer.writerows(rows)
+                    else:
+                        output.writelines(json.dumps(dict(zip(columns, row))) + "\n" for row in rows)
+                    row_count += len(rows)
+        return row_count
+
+    @staticmethod
+    def month_range_epochs(start: Optional[str], end: Optional[str]) -> tuple:
+        """
+        Inclusive 'YYYY-MM-DD' start and end days widened to whole months, as a [start, end) checkout epoch range
+        """
+        if start:
+            start = f"{start[:7]}-01"
+        if end:
+            year, month = int(end[:4]), int(end[5:7])
+            end = f"{end[:7]}-{calendar.monthrange(year, month)[1]:02d}"
+        return AppDB.date_range_epochs(start, end)
 
-DB_NAME = "ridedb.db"
+    def archive_parquet(
+        self, root: str, start: Optional[str] = None, end: Optional[str] = None, batch_size: int = ARCHIVE_BATCH_SIZE
+    ) -> dict:
+        """
+        Write ride_data rows to a year=YYYY/month=M partitioned Parquet dataset under root, streaming
+        batch_size rows at a time. The range is widened to whole months and the months written replace
+        any earlier archive of them. Trips without a checkout epoch go to the default partition when
+        the range is open. Returns a summary of the archive
+        """
+        import pyarrow as pa
+        import pyarrow.dataset as ds
 
+        start_time = time.perf_counter()
+        start_epoch, end_epoch = self.month_range_epochs(start, end)
+        where = ["CheckoutEpoch >= ?"] * (start_epoch is not None) + ["CheckoutEpoch < ?"] * (end_epoch is not None)
+        params = tuple(each for each in (start_epoch, end_epoch) if each is not None)
+        # write_dataset pulls the batches from its own thread, one at a time
+        with contextlib.closing(sqlite3.connect(self.db_path, check_same_thread=False)) as conn:
+            arrow_types = {"INTEGER": pa.int64(), "REAL": pa.float64()}
+            fields, selects = [], []
+            for _, name, column_type, *_ in conn.execute("PRAGMA table_info(ride_data);").fetchall():
+                fields.append(pa.field(name, arrow_types.get(column_type.upper(), pa.string())))
+                # rows loaded before per column null handling hold '' in numeric columns
+                selects.append(f"NULLIF({name}, '') AS {name}" if column_type.upper() in arrow_types else name)
+            partitions = [pa.field("year", pa.int16()), pa.field("month", pa.int8())]
+            schema = pa.schema(fields + partitions)
+            qry = (
+                f"SELECT {', '.join(selects)}, CAST(strftime('%Y', CheckoutEpoch, 'unixepoch') AS INTEGER) AS year, "
+                "CAST(strftime('%m', CheckoutEpoch, 'unixepoch') AS INTEGER) AS month FROM ride_data "
+                f"WHERE {' AND '.join(where) if where else 'CheckoutEpoch IS NOT NULL'} ORDER BY CheckoutEpoch;"
+            )
+            queries = [(qry, params)]
+            if not where:
+                queries.append((qry.replace("CheckoutEpoch IS NOT NULL", "CheckoutEpoch IS NULL"), ()))
 
-class AppDB:
-    """
-    class for managing sqlite database
-    """
+            def batches() -> Iterator[pa.RecordBatch]:
+                # sharded, a batch of shards at a time, in checkout order
+                for _ in self.shard_batches(conn, start_epoch, end_epoch) if self.shard_months else [None]:
+                    for sql, sql_params in queries:
+                        cursor = conn.execute(sql, sql_params)
+                        while rows := cursor.fetchmany(batch_size):
+                            arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*rows), schema)]
+                            yield pa.RecordBatch.from_arrays(arrays, schema=schema)
 
-    def __init__(self, path: str) -> None:
-        self.db_path = path
-        self.start_range = None
-        self.end_range = None
+            files = []
+            ds.write_dataset(
+                batches(),
+                root,
+                schema=schema,
+                format="parquet",
+                partitioning=ds.partitioning(pa.schema(partitions), flavor="hive"),
+                file_options=ds.ParquetFileFormat().make_write_options(compression="zstd"),
+                basename_template="part-{i}.parquet",
+                existing_data_behavior="delete_matching",
+                file_visitor=lambda written: files.append(written),
+            )
+        row_count = sum(each.metadata.num_rows for each in files)
+        elapsed = time.perf_counter() - start_time
+        print(f"# Archived {row_count:,} rows to {len(files)} files in {elapsed:.2f}s")
+        return {
+            "rows": row_count,
+            "files": sorted(os.path.relpath(each.path, root) for each in files),
+            "seconds": round(elapsed, 3),
+        }
 
     @staticmethod
-    def csv_fields() -> list:
-        return [
-            "TripId",
-            "UserProgramName",
-            "UserId",
-            "UserRole",
-            "UserCity",
-            "UserState",
-            "UserZip",
-            "UserCountry",
-            "MembershipType",
-            "Bike",
-            "BikeType",
-            "CheckoutKioskName",
-            "ReturnKioskName",
-            "DurationMins",
-            "AdjustedDurationMins",
-            "UsageFee",
-            "AdjustmentFlag",
-            "Distance",
-            "EstimatedCarbonOffset",
-            "EstimatedCaloriesBurned",
-            "CheckoutDateLocal",
-            "ReturnDateLocal",
-            "CheckoutTimeLocal",
-            "ReturnTimeLocal",
-            "TripOver30Mins",
-            "LocalProgramFlag",
-            "TripRouteCategory",
-            "TripProgramName",
-        ]
+    def archive_dataset(root: str) -> ds.Dataset:
+        """
+        The archive under root, the categorical report columns read as dictionaries, so they load as categoricals
+        """
+        import pyarrow.dataset as ds
+
+        dictionary_columns = [name for name, dtype in AppDB.df_dtype().items() if dtype == "category"]
+        read_options = ds.ParquetReadOptions(dictionary_columns=dictionary_columns + ["FileName", "ImportDateTime"])
+        return ds.dataset(root, format=ds.ParquetFileFormat(read_options=read_options), partitioning="hive")
 
     @staticmethod
-    def create_db_schema() -> str:
-        return (
-            "CREATE TABLE IF NOT EXISTS ride_data ("
-            "`TripId` INTEGER  PRIMARY KEY,"
-            "`UserProgramName` TEXT,"
-            "`UserId` INTEGER,"
-            "`UserRole` TEXT,"
-            "`UserCity` TEXT,"
-            "`UserState` TEXT,"
-            "`UserZip` TEXT,"
-            "`UserCountry` TEXT,"
-            "`MembershipType` TEXT,"
-            "`Bike` TEXT,"
-            "`BikeType` TEXT,"
-            "`CheckoutKioskName` TEXT,"
-            "`ReturnKioskName` TEXT,"
-            "`DurationMins` REAL,"
-            "`AdjustedDurationMins` REAL,"
-            "`UsageFee` REAL,"
-            "`AdjustmentFlag` TEXT,"
-            "`Distance` REAL,"
-            "`EstimatedCarbonOffset` REAL,"
-            "`EstimatedCaloriesBurned` REAL,"
-            "`CheckoutDateLocal` TEXT,"
-            "`ReturnDateLocal` TEXT,"
-            "`CheckoutTimeLocal` TEXT,"
-            "`ReturnTimeLocal` TEXT,"
-            "`TripOver30Mins` TEXT,"
-            "`LocalProgramFlag` TEXT,"
-            "`TripRouteCategory` TEXT,"
-            "`TripProgramName` TEXT,"
-            "`FileName` TEXT,"
-            "`ImportDateTime` TEXT,"
-            "`CheckoutDateTime` TEXT,"
-            "`ReturnDateTime` TEXT"
-            ");"
-        )
+    def archive_filter(start: Optional[str], end: Optional[str]) -> ds.Expression | None:
+        """
+        Filter for the trips with a checkout day between start and end, its year and month terms let the
+        scan skip the partitions outside the range
+        """
+        import pyarrow.dataset as ds
+
+        start_epoch, end_epoch = AppDB.date_range_epochs(start, end)
+        year, month, epoch = ds.field("year"), ds.field("month"), ds.field("CheckoutEpoch")
+        conditions = []
+        if start:
+            first_year, first_month = int(start[:4]), int(start[5:7])
+            conditions.append((year > first_year) | ((year == first_year) & (month >= first_month)))
+            conditions.append(epoch >= start_epoch)
+        if end:
+            last_year, last_month = int(end[:4]), int(end[5:7])
+            conditions.append((year < last_year) | ((year == last_year) & (month <= last_month)))
+            conditions.append(epoch < end_epoch)
+        return functools.reduce(lambda left, right: left & right, conditions) if conditions else None
 
     @staticmethod
-    def df_dtype() -> dict:
-        return {
-            "TripId": "int",
-            "UserProgramName": "object",
-            "UserId": "int",
-            "UserRole": "object",
-            "UserCity": "object",
-            "UserState": "object",
-            "UserZip": "object",
-            "UserCountry": "object",
-            "MembershipType": "object",
-            "Bike": "object",
-            "BikeType": "object",
-            "CheckoutKioskName": "object",
-            "ReturnKioskName": "object",
-            "DurationMins": "float",
-            "AdjustedDurationMins": "float",
-            "UsageFee": "float",
-            "AdjustmentFlag": "object",
-            "Distance": "float",
-            "EstimatedCarbonOffset": "float",
-            "EstimatedCaloriesBurned": "float",
-            "CheckoutDateLocal": "object",
-            "ReturnDateLocal": "object",
-            "CheckoutTimeLocal": "object",
-            "ReturnTimeLocal": "object",
-            "TripOver30Mins": "object",
-            "LocalProgramFlag": "object",
-            "TripRouteCategory": "object",
-            "TripProgramName": "object",
-        }
+    def archive_frames(
+        root: str,
+        start: Optional[str] = None,
+        end: Optional[str] = None,
+        columns: Optional[list] = None,
+        batch_size: int = ARCHIVE_BATCH_SIZE,
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Yield archived trips with a checkout day between start and end as data frames, reading only the
+        partitions in the range and the given columns, all ride_data columns by default
+        """
+        import pandas as pd
+        import pyarrow as pa
+
+        dataset = AppDB.archive_dataset(root)
+        columns = columns or [each for each in dataset.schema.names if each not in ("year", "month")]
+        # integer columns with missing values stay integers
+        types = {pa.int64(): pd.Int64Dtype()}
+        for batch in dataset.to_batches(
+            columns=columns, filter=AppDB.archive_filter(start, end), batch_size=batch_size
+        ):
+            if batch.num_rows:
+                yield batch.to_pandas(types_mapper=types.get)
 
     @staticmethod
-    def dict_factory(cursor, row):
-        fields = [column[0] for column in cursor.description]
-        return {key: value for key, value in zip(fields, row)}
+    def read_archive(
+        root: str, start: Optional[str] = None, end: Optional[str] = None, columns: Optional[list] = None
+    ) -> pd.DataFrame:
+        """
+        Archived trips with a checkout day between start and end as one data frame, see archive_frames
+        """
+        import pandas as pd
 
-    def connect_db(self, path: str) -> Connection:
-        conn = sqlite3.connect(path)
-        conn.row_factory = AppDB.dict_factory
-        return conn
+        frames = list(AppDB.archive_frames(root, start, end, columns))
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
 
-    def init_db(self) -> None:
-        # os path must exist, :memory: not supported
-        if os.path.exists(self.db_path):
+    def restore_archive(
+        self, root: str, start: Optional[str] = None, end: Optional[str] = None, batch_size: int = ARCHIVE_BATCH_SIZE
+    ) -> dict:
+        """
+        Load archived trips with a checkout day between start and end back into ride_data, in one transaction.
+        Archived rows are already prepared, so they are written without the csv parsing and derivation.
+        Returns a summary of the load, empty on failure
+        """
+        summary = {}
+        with self.writer() as conn:
             try:
-                conn = self.connect_db(self.db_path)
-                if self.db_table_exists(conn, "ride_data"):
-                    conn.close()
-                    return
+                start_time = time.perf_counter()
+                self.apply_pragmas(conn, self.import_pragmas())
+                conn.execute("BEGIN;")
+                row_count = 0
+                touched = {"files": set(), "days": set(), "bikes": set(), "appended": {}}
+                for df in self.trace_iter("read", self.archive_frames(root, start, end, batch_size=batch_size)):
+                    if self.shard_months:
+                        touched["files"].update(df["FileName"].unique())
+                        row_count += self.write_shards(df)
+                        continue
+                    with self.trace("track", rows=len(df)):
+                        self.track_touched(conn, df, touched)
+                    row_count += self.write_report_frame(conn, df, IMPORT_CHUNK_SIZE)
+                if row_count:
+                    with self.trace("refresh"):
+                        self.refresh_derived(conn, touched)
+                with self.trace("commit"):
+                    conn.commit()
+
+                elapsed = time.perf_counter() - start_time
+                summary = {"rows": row_count, "files": sorted(touched["files"]), "seconds": round(elapsed, 3)}
+                summary["rows_per_sec"] = round(row_count / elapsed) if elapsed else 0
+                print(f"# Restored {row_count:,} rows in {elapsed:.2f}s ({summary['rows_per_sec']:,} rows/sec)")
             except Exception as e:
-                raise Exception(f"connection failure | {e}")
+                conn.rollback()
+                self.dimension_cache.clear()
+                print(f"\n# Restore archive failure | {e}")
+        return summary
 
-        print("# Intializing database")
-        try:
-            conn = self.connect_db(self.db_path)
-            conn.execute(self.create_db_schema())
+    def session_connection(self) -> Connection:
+        """
+        Long lived connection holding the session's TEMP working set tables
+        """
+        if self.session_conn is None:
+            self.session_conn = self.connect_db(self.db_path)
+        return self.session_conn
+
+    def create_temp_table(self, table_name: str, sql: str, materialize: bool = False) -> None:
+        """
+        Create a working set from a select statement, as a TEMP view of the session connection, or as a
+        TEMP table of it with a CheckoutEpoch index when materialized. In sharded storage the session
+        connection has the shards attached
+        """
+        if materialize:
+            conn = self.session_connection()
+            conn.execute(f"DROP TABLE IF EXISTS temp.{table_name};")
+            conn.execute(f"CREATE TEMP TABLE {table_name} AS {sql};")
+            conn.execute(f"CREATE INDEX temp.idx_{table_name}_checkout_epoch ON {table_name} (CheckoutEpoch);")
             conn.commit()
-            conn.close()
-        except Exception as e:
-            raise Exception(f"database creation error | {e}")
+            return
+        conn = self.session_connection()
+        conn.execute(f"DROP VIEW IF EXISTS temp.{table_name};")
+        conn.execute(f"CREATE TEMP VIEW {table_name} AS {sql};")
 
     @staticmethod
-    def db_table_exists(conn: Connection, table_name: str) -> bool:
-        try:
-            qry = "SELECT name FROM sqlite_master WHERE type='table' AND name=?;"
-            return conn.execute(qry, (table_name,)).fetchone() is not None
-        except sqlite3.OperationalError:
-            return False
+    def date_range_epochs(start: Optional[str], end: Optional[str]) -> tuple:
+        """
+        Inclusive 'YYYY-MM-DD' start and end days to a [start, end) checkout epoch range, open ends are None
+        """
+        start_epoch = calendar.timegm(time.strptime(start, "%Y-%m-%d")) if start else None
+        end_epoch = calendar.timegm(time.strptime(end, "%Y-%m-%d")) + 86400 if end else None
+        if None not in (start_epoch, end_epoch) and start_epoch >= end_epoch:
+            raise ValueError(f"start date {start} is after end date {end}")
+        return start_epoch, end_epoch
 
-    # TODO test
-    def drop_temp_tables(self):
+    def set_date_range(self, start: Optional[str] = None, end: Optional[str] = None) -> None:
         """
-        Temp tables is saved as views
+        Set the session date range, inclusive 'YYYY-MM-DD' checkout days, and build its working set view.
+        The view filters on the CheckoutEpoch index, it is materialized once queried MATERIALIZE_AFTER times.
+        A sharded range over more shards than can be attached at once is materialized from the start
         """
-        with self.connect_db(self.db_path) as conn:
-            if views := conn.execute("SELECT name from sqlite_master where type = 'view';").fetchall():
-                [conn.execute(f"DROP VIEW {each['name']};") for each in views]
+        start_epoch, end_epoch = self.date_range_epochs(start, end)
+        self.drop_temp_tables()
+        self.start_range, self.end_range = start, end
+        if self.shard_months:
+            conn = self.session_connection()
+            if len(self.shard_keys(start_epoch, end_epoch)) > SHARD_ATTACH_BATCH:
+                data_version = conn.execute("PRAGMA data_version;").fetchone()["data_version"]
+                self.copy_shard_range(conn, RANGE_TABLE, start_epoch, end_epoch)
+                conn.execute(f"CREATE TEMP VIEW {RANGE_VIEW} AS SELECT * FROM temp.{RANGE_TABLE};")
+                self.range_data_version = data_version
+                return
+            self.attach_shards(conn, start_epoch, end_epoch)
+        where = []
+        if start_epoch is not None:
+            where.append(f"CheckoutEpoch >= {start_epoch:d}")
+        if end_epoch is not None:
+            where.append(f"CheckoutEpoch < {end_epoch:d}")
+        self.create_temp_table(RANGE_VIEW, f"SELECT * FROM ride_data {'WHERE ' + ' AND '.join(where) if where else ''}")
 
-    # TODO test custom table name
-    def db_stats(self, table_name: Optional[str] = None) -> list:
+    def working_set(self, materialize: Optional[bool] = None) -> str:
         """
-        Returns a dictionary with some database statistics
+        Name of the relation holding the current date range, on the session connection.
+        Counts range queries and materializes the range once it is reused, a materialized range is
+        rebuilt when the database has changed since
         """
-        stats = []
-        table_name = table_name or "ride_data"
-        with self.connect_db(self.db_path) as conn:
-            try:
-                stats.append(
-                    {
-                        "name": "database count",
-                        "value": (
-                            conn.execute(
-                                "SELECT COUNT(*) AS cnt FROM {};".format(
-                                    table_name,
-                                )
-                            )
-                            .fetchone()
-                            .get("cnt", 0)
-                        ),
-                    }
-                )
-                stats.append(
-                    {
-                        "name": "file count",
-                        "value": (
-                            conn.execute(
-                                "WITH qry AS (SELECT FileName FROM {} GROUP BY FileName) "
-                                "SELECT count(*) AS count FROM qry;".format(
-                                    table_name,
-                                )
-                            )
-                            .fetchone()
-                            .get("count", 0)
-                        ),
-                    }
-                )
-                date_qry = (
-                    "WITH qry1 AS (select datetime(CheckoutDateLocal||' '||CheckoutTimeLocal) AS return_dt "
-                    "FROM {}) SELECT MIN(return_dt) AS min_return , MAX(return_dt) AS max_return FROM qry1;".format(
-                        table_name,
-                    )
-                )
-                date_rslt = conn.execute(date_qry).fetchone()
-                stats.append({"name": "min date", "value": date_rslt["min_return"]})
-                stats.append({"name": "max date", "value": date_rslt["max_return"]})
-            except Exception as e:
-                print(f"\n# DB stats error | {e}")
+        conn = self.session_connection()
+        if not conn.execute("SELECT name FROM temp.sqlite_master WHERE name = ?;", (RANGE_VIEW,)).fetchone():
+            self.set_date_range(self.start_range, self.end_range)
 
-        conn.close()
-        return stats
+        data_version = conn.execute("PRAGMA data_version;").fetchone()["data_version"]
+        if self.range_data_version is not None and data_version != self.range_data_version:
+            if self.shard_months:
+                # shards may have been added, and a copied range is not a view to materialize again
+                self.set_date_range(self.start_range, self.end_range)
+            else:
+                conn.execute(f"DROP TABLE IF EXISTS temp.{RANGE_TABLE};")
+                self.range_data_version = None
+                self.range_queries = 0
 
-    def import_report_to_db(self, report_path: str) -> None:
+        self.range_queries += 1
+        if self.range_data_version is None and (
+            materialize or (materialize is None and self.range_queries >= MATERIALIZE_AFTER)
+        ):
+            self.create_temp_table(RANGE_TABLE, f"SELECT * FROM {RANGE_VIEW}", materialize=True)
+            self.range_data_version = data_version
+        return f"temp.{RANGE_TABLE}" if self.range_data_version is not None else RANGE_VIEW
+
+    def query_range(self, sql: str, params: tuple = (), materialize: Optional[bool] = None) -> list:
         """
-        Import a csv file, of correct format to db
+        Run a query against the date range working set, '{table}' in sql is replaced with its name.
+        Results are cached by date range until the data version changes
         """
-        with self.connect_db(self.db_path) as conn:
-            try:
-                conn = self.connect_db(self.db_path)
-                filename = os.path.split(report_path)[1]
-                print(f"# Importing report: '{filename}'")
+        conn = self.session_connection()
+        return self.cached_query(
+            sql,
+            (*params, self.start_range, self.end_range),
+            run=lambda: conn.execute(sql.format(table=self.working_set(materialize)), params).fetchall(),
+        )
 
-                # pre-sql data processing
-                df = pd.read_csv(report_path, dtype=self.df_dtype())
-                df = df.fillna("")
-                df["FileName"] = filename
-                df["ImportDateTime"] = pendulum.now().to_datetime_string()
-                df["ReturnDateTime"] = df["ReturnDateLocal"] + " " + df["ReturnTimeLocal"]
-                df["CheckoutDateTime"] = df["CheckoutDateLocal"] + " " + df["CheckoutTimeLocal"]
-                df_cols = df.columns.to_list()
-
-                for row in df.itertuples():
-                    placeholders = ", ".join("?" * len(df_cols))
-                    values = [
-                        int(x) if isinstance(x, bool) else x for x in (row.__getattribute__(each) for each in df_cols)
-                    ]
-                    sql = "REPLACE INTO ride_data ({}) VALUES ({});".format(", ".join(df_cols), placeholders)
-                    conn.execute(sql, values)
-                conn.commit()
-            except Exception as e:
-                print(f"\n# Import report failure | {e}")
-        conn.close()
+    def flow_trips(self, start: Optional[str], end: Optional[str]) -> tuple:
+        """
+        Kiosk names, and the integer kiosk codes of checkout and return and the checkout epoch hour of the trips
+        with a checkout day between start and end, as arrays. Trips missing a kiosk or checkout time are left out.
+        Sharded, each shard codes its trips in parallel, see flow_codes, and the codes are merged by kiosk name
+        """
+        import numpy as np
+
+        start_epoch, end_epoch = self.date_range_epochs(start, end)
+        where = ["CheckoutEpoch IS NOT NULL"]
+        where += ["CheckoutEpoch >= ?"] * (start_epoch is not None) + ["CheckoutEpoch < ?"] * (end_epoch is not None)
+        params = tuple(each for each in (start_epoch, end_epoch) if each is not None)
+        if not self.shard_months:
+            return self.flow_codes(self.session_connection(), where, params)
+
+        def read(app_db: AppDB) -> tuple:
+            with app_db.reader() as conn:
+                return app_db.flow_codes(conn, where, params)
+
+        parts = [read(self)] + self.shard_map(read, self.shard_keys(start_epoch, end_epoch))
+        names = sorted(set().union(*(each[0] for each in parts)))
+        positions = {name: position for position, name in enumerate(names)}
+        origins, destinations, hours = [], [], []
+        for part_names, part_origins, part_destinations, part_hours in parts:
+            codes = np.array([positions[name] for name in part_names], dtype=np.int64)
+            origins.append(codes[part_origins])
+            destinations.append(codes[part_destinations])
+            hours.append(part_hours)
+        return names, np.concatenate(origins), np.concatenate(destinations), np.concatenate(hours)
+
+    def flow_codes(self, conn: Connection, where: list, params: tuple) -> tuple:
+        """
+        flow_trips of the ride_data rows of a connection matching the where terms.
+        Each trip is packed into one integer, the kiosks are coded in SQL: by the dim_kiosk ids in the normalized
+        layout, through a WITHOUT ROWID TEMP table of the kiosk names otherwise. Its names are read by skipping
+        along the kiosk name indexes, one seek per kiosk rather than a scan of the trips. The packed trips cross
+        from sqlite as one group_concat string parsed by NumPy, a Python int per trip costs more than the scan
+        """
+        import numpy as np
+
+        if self.storage_table(conn) == "ride_trip":
+            kiosks = {each["KioskId"]: each["KioskName"] for each in conn.execute("SELECT * FROM dim_kiosk;")}
+            origin, destination, table_name = "t.CheckoutKioskId", "t.ReturnKioskId", "ride_trip t"
+        else:
+            conn.execute("DROP TABLE IF EXISTS temp.flow_kiosk;")
+            conn.execute(
+                "CREATE TEMP TABLE flow_kiosk (`KioskName` TEXT PRIMARY KEY, `KioskId` INTEGER) WITHOUT ROWID;"
+            )
+            skip_scan = (
+                "{column}s(KioskName) AS (SELECT MIN({column}) FROM ride_data UNION ALL "
+                "SELECT (SELECT MIN({column}) FROM ride_data WHERE {column} > KioskName) FROM {column}s "
+                "WHERE KioskName IS NOT NULL)"
+            )
+            conn.execute(
+                f"WITH RECURSIVE {skip_scan.format(column='CheckoutKioskName')}, "
+                f"{skip_scan.format(column='ReturnKioskName')} "
+                "INSERT INTO temp.flow_kiosk SELECT KioskName, ROW_NUMBER() OVER (ORDER BY KioskName) FROM "
+                "(SELECT KioskName FROM CheckoutKioskNames UNION SELECT KioskName FROM ReturnKioskNames) "
+                "WHERE KioskName IS NOT NULL;"
+            )
+            kiosks = {each["KioskId"]: each["KioskName"] for each in conn.execute("SELECT * FROM temp.flow_kiosk;")}
+            origin, destination = "o.KioskId", "d.KioskId"
+            table_name = (
+                "ride_data t JOIN temp.flow_kiosk o ON o.KioskName = t.CheckoutKioskName "
+                "JOIN temp.flow_kiosk d ON d.KioskName = t.ReturnKioskName"
+            )
+        size = max(kiosks, default=0) + 1
+        qry = (
+            f"SELECT group_concat(((t.CheckoutEpoch / 3600) * {size} + {origin}) * {size} + {destination}, ' ') "
+            f"AS keys FROM {table_name} WHERE {' AND '.join('t.' + each for each in where)};"
+        )
+        keys = np.fromstring(conn.execute(qry, params).fetchone()["keys"] or "", dtype=np.int64, sep=" ")
+        conn.execute("DROP TABLE IF EXISTS temp.flow_kiosk;")
+        conn.commit()
 
-    def create_temp_table(self, table_name: str, sql: str) -> None:
+        hours, pairs = np.divmod(keys, size * size)
+        origins, destinations = np.divmod(pairs, size)
+        # compact codes, in kiosk name order, blank kiosk names are -1
+        names = sorted(name for name in kiosks.values() if name)
+        positions = {name: position for position, name in enumerate(names)}
+        codes = np.full(size, -1, dtype=np.int64)
+        for key, name in kiosks.items():
+            codes[key] = positions.get(name, -1)
+        origins, destinations = codes[origins], codes[destinations]
+        keep = (origins >= 0) & (destinations >= 0)
+        return names, origins[keep], destinations[keep], hours[keep] * 3600
+
+    def kiosk_flows(self, start: Optional[str] = None, end: Optional[str] = None) -> FlowMatrix:
+        """
+        Origin destination FlowMatrix of the trips with a checkout day between start and end, defaults to the
+        app date range. The last FLOW_CACHE_SIZE matrices are cached by range and database data version
+        """
+        start, end = start or self.start_range, end or self.end_range
+        data_version = self.session_connection().execute("PRAGMA data_version;").fetchone()["data_version"]
+        cached = self.flow_cache.pop((start, end), None)
+        if cached is None or cached[0] != data_version:
+            cached = (data_version, FlowMatrix(*self.flow_trips(start, end)))
+        self.flow_cache[(start, end)] = cached
+        while len(self.flow_cache) > FLOW_CACHE_SIZE:
+            self.flow_cache.pop(next(iter(self.flow_cache)))
+        return cached[1]
+
+    def bike_utilization(self, bike: Optional[str] = None) -> list:
+        """
+        Bike timeline rows, one bike or all of them most utilized first, ride and idle time in hours
+        """
+        qry = (
+            "SELECT Bike, Trips, ROUND(RideSecs / 3600.0, 2) AS RideHours, ROUND(IdleSecs / 3600.0, 2) AS IdleHours, "
+            "ROUND(MaxIdleSecs / 3600.0, 2) AS MaxIdleHours, Utilization, Overlaps, Impossible, "
+            "datetime(LastReturn, 'unixepoch') AS LastReturn, LastKioskName FROM bike_timeline "
+            f"{'WHERE Bike = ?' if bike is not None else ''} ORDER BY Utilization DESC, Bike;"
+        )
+        params = () if bike is None else (bike,)
+        run = None
+        if self.shard_months:
+            partial_sql = f"SELECT * FROM bike_timeline {'WHERE Bike = ?' if bike is not None else ''};"
+            run = functools.partial(self.gather, qry, params, partial_sql, params, "bike_timeline")
+        return self.cached_query(qry, params, run)
+
+    def kiosk_idle(self) -> list:
         """
-        create view if not exists tmp_table as select * from ride_data where `ReturnDateLocal` > '2024-05-15';
+        Idle gaps between rides and idle hours of the bikes returned at each kiosk, longest idle first
         """
-        pass
+        qry = (
+            "SELECT KioskName, SUM(Gaps) AS Gaps, COUNT(*) AS Bikes, ROUND(SUM(IdleSecs) / 3600.0, 2) AS IdleHours, "
+            "ROUND(SUM(IdleSecs) / 3600.0 / SUM(Gaps), 2) AS HoursPerGap FROM bike_idle "
+            "GROUP BY KioskName ORDER BY SUM(IdleSecs) DESC, KioskName;"
+        )
+        run = None
+        if self.shard_months:
+            run = functools.partial(self.gather, qry, (), "SELECT * FROM bike_idle;", (), "bike_idle")
+        return self.cached_query(qry, run=run)
+
+    def bike_flags(self, bike: Optional[str] = None) -> list:
+        """
+        Overlapping and impossible trips, of one bike or all of them
+        """
+        qry = (
+            "SELECT f.Bike, f.TripId, f.Flag, t.CheckoutDateTime, t.ReturnDateTime, t.CheckoutKioskName, "
+            "t.ReturnKioskName FROM bike_trip_flag f JOIN ride_data t ON t.TripId = f.TripId "
+            f"{'WHERE f.Bike = ?' if bike is not None else ''} ORDER BY f.Bike, t.CheckoutEpoch, f.TripId;"
+        )
+        params = () if bike is None else (bike,)
+        run = None
+        if self.shard_months:
+            # each shard flags and joins its own trips
+            final_sql = "SELECT * FROM partial ORDER BY Bike, CheckoutDateTime, TripId;"
+            run = functools.partial(self.gather, final_sql, (), qry, params)
+        return self.cached_query(qry, params, run)
+
+    def range_stats(self) -> dict:
+        qry = (
+            "SELECT COUNT(*) AS row_count, COUNT(DISTINCT FileName) AS file_count, "
+            "datetime(MIN(CheckoutEpoch), 'unixepoch') AS min_date, "
+            "datetime(MAX(CheckoutEpoch), 'unixepoch') AS max_date FROM {table};"
+        )
+        return self.query_range(qry)[0]
 
 
 class App:
     def __init__(self, db_name: Optional[str] = None) -> None:
         self.db_name = db_name or DB_NAME
         self.db = AppDB(self.db_name)
-        self.session_name_string = pendulum.now().format("YYYY-MM-DD_HH-mm-ss")
+        self.session_name_string = time.strftime("%Y-%m-%d_%H-%M-%S")
 
     def init_app(self) -> bool:
         """
@@ -291,10 +3717,22 @@ class App:
         sys.exit(exit_code)
 
     @classmethod
-    def print_stats(cls, stats_list: list) -> None:
-        print_strings = [f"{each['name']}: {each['value']}" for each in stats_list]
+    def print_stats(cls, stats: dict) -> None:
+        print_strings = [f"{name.replace('_', ' ')}: {value}" for name, value in stats.items()]
         print(*print_strings, sep="\n")
 
+    @classmethod
+    def print_table(cls, rows: list) -> None:
+        if not rows:
+            print("\n# No rows")
+            return
+        columns = list(rows[0].keys())
+        widths = [max(len(str(column)), *(len(str(row[column])) for row in rows)) for column in columns]
+        print("\n" + "  ".join(str(column).ljust(width) for column, width in zip(columns, widths)).rstrip())
+        print("  ".join("-" * width for width in widths))
+        for row in rows:
+            print("  ".join(str(row[column]).ljust(width) for column, width in zip(columns, widths)).rstrip())
+
     def show_main_menu(self) -> None:
         option_map = {
             "1": {"function": self.show_db_menu, "description": "Database Actions"},
@@ -310,13 +3748,30 @@ class App:
         option_map[user_choice]["function"]()
 
     def set_date_range(self) -> None:
-        pass
+        print("Dates as YYYY-MM-DD, leave blank for an open range")
+        start = input("Start date: ").strip() or None
+        end = input("End date: ").strip() or None
+        try:
+            self.db.set_date_range(start, end)
+        except Exception as e:
+            print(f"\n# Date range error | {e}")
+            return
+        self.print_stats(self.db.range_stats())
 
-    def drop_rows_by_filename(self):
-        pass
+    def drop_rows_by_filename(self) -> None:
+        self.print_table(self.db.catalog_files())
+        filename = input("Report file name to delete: ").strip()
+        if filename:
+            self.db.delete_rows_by_filename(filename)
 
-    def drop_rows_by_date_range(self):
-        pass
+    def drop_rows_by_date_range(self) -> None:
+        print("Dates as YYYY-MM-DD, leave blank for an open range")
+        start = input("Start date: ").strip() or None
+        end = input("End date: ").strip() or None
+        try:
+            self.db.delete_rows_by_date_range(start, end)
+        except Exception as e:
+            print(f"\n# Date range error | {e}")
 
     def show_db_menu(self) -> None:
         option_map = {
@@ -325,10 +3780,22 @@ class App:
                 "description": "Import report csv file",
             },
             "2": {
+                "function": self.import_report_directory,
+                "description": "Import report csv directory or glob pattern",
+            },
+            "3": {
                 "function": self.set_date_range,
                 "description": "Set temporary date range",
             },
-            "3": {
+            "4": {
+                "function": self.drop_rows_by_filename,
+                "description": "Delete rows by report file",
+            },
+            "5": {
+                "function": self.drop_rows_by_date_range,
+                "description": "Delete rows by date range",
+            },
+            "6": {
                 "function": self.show_main_menu,
                 "description": "Return to Main menu",
             },
@@ -349,12 +3816,169 @@ class App:
 
         self.db.import_report_to_db(file_path)
 
+    def import_report_directory(self) -> None:
+        source = input("Report directory or glob pattern: ")
+        results = self.db.import_reports(source)
+        failed = [each for each in results if each["status"] == "failed"]
+        print(f"\n# Imported {len(results) - len(failed)} of {len(results)} reports")
+
+    def run_command(self, args: argparse.Namespace, output=None) -> int:
+        """
+        Run a headless sub command and write its result to output as JSON, progress messages go to stderr.
+        Returns the process exit code
+        """
+        output = output or sys.stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            if not self.init_app():
+                return 1
+            if args.rebuild_stats:
+                self.db.db_stats(rebuild=True)
+            result, exit_code = getattr(self, f"command_{args.command}")(args, output)
+        if result is not None:
+            json.dump(result, output, indent=2, default=str)
+            output.write("\n")
+        return exit_code
+
+    def command_import(self, args: argparse.Namespace, output) -> tuple:
+        if args.kiosk_list:
+            with open(args.kiosk_list) as fopen:
+                self.db.known_kiosks = {line.strip() for line in fopen if line.strip()}
+        if os.path.isfile(args.source):
+            summary = self.db.import_report_to_db(args.source, args.chunk_size, args.stream, args.force)
+            results = [summary or {"file": os.path.split(args.source)[1], "status": "failed"}]
+        else:
+            results = self.db.import_reports(args.source, args.workers, args.chunk_size, args.force)
+        failed = not results or any(each["status"] == "failed" for each in results)
+        return results, int(failed)
+
+    def command_stats(self, args: argparse.Namespace, output) -> tuple:
+        result = {"stats": self.db.db_stats()}
+        if args.files:
+            result["files"] = self.db.catalog_files()
+        if args.quarantine:
+            result["quarantine"] = self.db.quarantine_counts()
+        return result, int(not result["stats"])
+
+    def command_delete(self, args: argparse.Namespace, output) -> tuple:
+        if args.file:
+            summary = self.db.delete_rows_by_filename(args.file, args.batch_size)
+        else:
+            summary = self.db.delete_rows_by_date_range(args.start, args.end, args.batch_size)
+        return summary, int(not summary or "error" in summary)
+
+    def command_report(self, args: argparse.Namespace, output) -> tuple:
+        definitions = self.db.report_definitions()
+        if args.name is None:
+            return {name: report["description"] for name, report in definitions.items()}, 0
+        return self.db.rollup_report(args.name, args.start, args.end), 0
+
+    def command_sketch(self, args: argparse.Namespace, output) -> tuple:
+        return self.db.sketch_report(tuple(args.by), args.start, args.end, args.exact), 0
+
+    def command_flows(self, args: argparse.Namespace, output) -> tuple:
+        flows = self.db.kiosk_flows(args.start, args.end)
+        result = {"trips": flows.trips, "net": flows.net_flows(args.weekday, args.hour)}
+        if args.matrix:
+            result.update(kiosks=flows.kiosks, matrix=flows.matrix(args.weekday, args.hour).tolist())
+        return result, 0
+
+    def command_bikes(self, args: argparse.Namespace, output) -> tuple:
+        result = {"bikes": self.db.bike_utilization(args.bike)}
+        if args.kiosks:
+            result["kiosks"] = self.db.kiosk_idle()
+        if args.flags:
+            result["flags"] = self.db.bike_flags(args.bike)
+        return result, 0
+
+    def command_archive(self, args: argparse.Namespace, output) -> tuple:
+        return self.db.archive_parquet(args.output, args.start, args.end, args.batch_size), 0
+
+    def command_restore(self, args: argparse.Namespace, output) -> tuple:
+        summary = self.db.restore_archive(args.source, args.start, args.end, args.batch_size)
+        return summary, int(not summary)
+
+    def command_normalize(self, args: argparse.Namespace, output) -> tuple:
+        summary = self.db.normalize_storage()
+        return summary, int(not summary)
+
+    def command_shards(self, args: argparse.Namespace, output) -> tuple:
+        result = {}
+        if args.by:
+            result["sharded"] = self.db.shard_storage(args.by)
+            if not result["sharded"]:
+                return result, 1
+        try:
+            if args.freeze:
+                self.db.freeze_shard(args.freeze)
+            if args.thaw:
+                self.db.freeze_shard(args.thaw, frozen=False)
+            if args.compact:
+                result["compacted"] = self.db.compact_shard(args.compact)
+        except ValueError as e:
+            print(f"\n# Shards failure | {e}")
+            return result, 1
+        result["shards"] = self.db.shard_list()
+        return result, 0
+
+    def command_export(self, args: argparse.Namespace, output) -> tuple:
+        if args.output is None:
+            self.db.export_rows(output, args.start, args.end, args.format)
+            return None, 0
+        with open(args.output, "w", newline="") as fopen:
+            row_count = self.db.export_rows(fopen, args.start, args.end, args.format)
+        return {"rows": row_count, "output": args.output}, 0
+
+    def show_report(self, name: str) -> None:
+        self.print_table(self.db.rollup_report(name))
+
+    def show_net_flows(self) -> None:
+        print("Leave blank for all weekdays or hours")
+        weekday = input("Checkout weekday, 0 Monday to 6 Sunday: ").strip()
+        hour = input("Checkout hour, 0 to 23: ").strip()
+        if weekday not in [""] + [str(each) for each in range(7)] or hour not in [""] + [
+            str(each) for each in range(24)
+        ]:
+            print("\n# Invalid weekday or hour")
+            return
+        flows = self.db.kiosk_flows()
+        self.print_table(flows.net_flows(int(weekday) if weekday else None, int(hour) if hour else None))
+
+    def show_sketch_report(self) -> None:
+        self.print_table(self.db.sketch_report())
+
+    def show_bike_utilization(self) -> None:
+        self.print_table(self.db.bike_utilization())
+
+    def show_kiosk_idle(self) -> None:
+        self.print_table(self.db.kiosk_idle())
+
     def show_report_menu(self) -> None:
         option_map = {
-            "1": {
-                "function": self.show_main_menu,
-                "description": "Return to Main menu",
-            },
+            str(number): {
+                "function": functools.partial(self.show_report, name),
+                "description": report["description"],
+            }
+            for number, (name, report) in enumerate(self.db.report_definitions().items(), start=1)
+        }
+        option_map[str(len(option_map) + 1)] = {
+            "function": self.show_net_flows,
+            "description": "Kiosk net inflow and outflow",
+        }
+        option_map[str(len(option_map) + 1)] = {
+            "function": self.show_sketch_report,
+            "description": "Distinct users and bikes, duration and distance quantiles by kiosk",
+        }
+        option_map[str(len(option_map) + 1)] = {
+            "function": self.show_bike_utilization,
+            "description": "Bike utilization",
+        }
+        option_map[str(len(option_map) + 1)] = {
+            "function": self.show_kiosk_idle,
+            "description": "Kiosk bike idle time",
+        }
+        option_map[str(len(option_map) + 1)] = {
+            "function": self.show_main_menu,
+            "description": "Return to Main menu",
         }
         options = list(f"{k}: {v['description']}" for k, v in option_map.items())
 
@@ -371,11 +3995,140 @@ def db_path_type(value: Optional[str] = None) -> str | None:
     return value
 
 
+def date_type(value: str) -> str:
+    try:
+        time.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid date, expected YYYY-MM-DD")
+    return value
+
+
+def delete_target_error(args: argparse.Namespace) -> Optional[str]:
+    """
+    The delete command takes --file, or a --start and or --end date range
+    """
+    if args.file is not None and (args.start is not None or args.end is not None):
+        return "argument --file: not allowed with a date range"
+    if args.file is None and args.start is None and args.end is None:
+        return "one of the arguments --file --start --end is required"
+    return None
+
+
+class CommandParser(argparse.ArgumentParser):
+    """
+    Sub command parser checking its arguments with validate, for combinations argparse groups can not express
+    """
+
+    def __init__(self, *args, validate=None, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.validate = validate
+
+    def parse_known_args(self, args=None, namespace=None) -> tuple:
+        parsed, extras = super().parse_known_args(args, namespace)
+        if self.validate is not None and (message := self.validate(parsed)):
+            self.error(message)
+        return parsed, extras
+
+
 def app_args() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description="Ride data processor")
     parser.add_argument(
         "--db-path", action="store", type=db_path_type, help="initialize app with custom database path name"
     )
+    parser.add_argument(
+        "--rebuild-stats", action="store_true", help="recompute the database statistics catalog from scratch"
+    )
+    parser.add_argument("--trace", metavar="PATH", help="append stage and query timings to a JSON lines trace file")
+    parser.add_argument(
+        "--slow-query-ms",
+        type=float,
+        default=SLOW_QUERY_SECS * 1000,
+        help="queries slower than this are traced with their query plan",
+    )
+    parser.add_argument("--query-cache", metavar="PATH", help="also keep query results in a cache file between runs")
+    commands = parser.add_subparsers(
+        dest="command",
+        metavar="command",
+        help="run headless and print JSON, omit for the interactive menus",
+        parser_class=CommandParser,
+    )
+
+    import_parser = commands.add_parser("import", help="import a report file, directory or glob pattern")
+    import_parser.add_argument("source", help="report csv file, directory or glob pattern")
+    import_parser.add_argument("--workers", type=int, help="parser processes for directory imports")
+    import_parser.add_argument("--chunk-size", type=int, default=IMPORT_CHUNK_SIZE, help="rows per write batch")
+    import_parser.add_argument("--stream", action="store_true", help="read a single report in chunks")
+    import_parser.add_argument("--force", action="store_true", help="ignore the import manifest")
+    import_parser.add_argument(
+        "--kiosk-list", metavar="PATH", help="known kiosk names, one per line, rows with other kiosks are quarantined"
+    )
+
+    stats_parser = commands.add_parser("stats", help="database statistics")
+    stats_parser.add_argument("--files", action="store_true", help="include per report file statistics")
+    stats_parser.add_argument("--quarantine", action="store_true", help="include quarantined rows per file and reason")
+
+    delete_parser = commands.add_parser(
+        "delete", help="delete rows by report file or checkout date range", validate=delete_target_error
+    )
+    delete_parser.add_argument("--file", help="report file name")
+    delete_parser.add_argument("--start", type=date_type, help="first checkout day, YYYY-MM-DD")
+    delete_parser.add_argument("--end", type=date_type, help="last checkout day, YYYY-MM-DD")
+    delete_parser.add_argument("--batch-size", type=int, default=DELETE_BATCH_SIZE, help="rows per transaction")
+
+    report_parser = commands.add_parser("report", help="run a rollup report, list reports without a name")
+    report_parser.add_argument("name", nargs="?", choices=list(AppDB.report_definitions()), help="report name")
+    report_parser.add_argument("--start", type=date_type, help="first checkout day, YYYY-MM-DD")
+    report_parser.add_argument("--end", type=date_type, help="last checkout day, YYYY-MM-DD")
+
+    sketch_parser = commands.add_parser(
+        "sketch", help="distinct users and bikes, duration and distance quantiles, from mergeable sketches"
+    )
+    sketch_parser.add_argument(
+        "--by", nargs="*", choices=SKETCH_GROUPS, default=["KioskName"], help="grouping columns, none for all trips"
+    )
+    sketch_parser.add_argument("--start", type=date_type, help="first checkout day, YYYY-MM-DD")
+    sketch_parser.add_argument("--end", type=date_type, help="last checkout day, YYYY-MM-DD")
+    sketch_parser.add_argument("--exact", action="store_true", help="count from the trips instead of the sketches")
+
+    flows_parser = commands.add_parser("flows", help="kiosk origin destination flows and net inflow")
+    flows_parser.add_argument("--start", type=date_type, help="first checkout day, YYYY-MM-DD")
+    flows_parser.add_argument("--end", type=date_type, help="last checkout day, YYYY-MM-DD")
+    flows_parser.add_argument("--weekday", type=int, choices=range(7), help="checkout weekday, 0 is Monday")
+    flows_parser.add_argument("--hour", type=int, choices=range(24), help="checkout hour of day")
+    flows_parser.add_argument("--matrix", action="store_true", help="include the checkout by return kiosk matrix")
+
+    bikes_parser = commands.add_parser("bikes", help="bike utilization, idle time and flagged trips")
+    bikes_parser.add_argument("--bike", help="one bike only")
+    bikes_parser.add_argument("--kiosks", action="store_true", help="include the idle time at each kiosk")
+    bikes_parser.add_argument("--flags", action="store_true", help="include the overlapping and impossible trips")
+
+    archive_parser = commands.add_parser("archive", help="write ride data to a month partitioned Parquet archive")
+    archive_parser.add_argument("output", help="archive directory")
+    archive_parser.add_argument("--start", type=date_type, help="first checkout day, YYYY-MM-DD, whole months")
+    archive_parser.add_argument("--end", type=date_type, help="last checkout day, YYYY-MM-DD, whole months")
+    archive_parser.add_argument("--batch-size", type=int, default=ARCHIVE_BATCH_SIZE, help="rows per batch")
+
+    restore_parser = commands.add_parser("restore", help="load trips back from a Parquet archive")
+    restore_parser.add_argument("source", help="archive directory")
+    restore_parser.add_argument("--start", type=date_type, help="first checkout day, YYYY-MM-DD")
+    restore_parser.add_argument("--end", type=date_type, help="last checkout day, YYYY-MM-DD")
+    restore_parser.add_argument("--batch-size", type=int, default=ARCHIVE_BATCH_SIZE, help="rows per batch")
+
+    commands.add_parser("normalize", help="store kiosk, program, user place and file names in dimension tables")
+
+    shards_parser = commands.add_parser("shards", help="list the shards of time partitioned storage")
+    shards_parser.add_argument(
+        "--by", choices=list(SHARD_PERIODS), help="move the trips to one database file per checkout year or month"
+    )
+    shards_parser.add_argument("--freeze", metavar="SHARD", help="refuse further writes to a shard, 2023 or 2023-06")
+    shards_parser.add_argument("--thaw", metavar="SHARD", help="allow writes to a frozen shard again")
+    shards_parser.add_argument("--compact", metavar="SHARD", help="vacuum one shard file")
+
+    export_parser = commands.add_parser("export", help="export ride data rows")
+    export_parser.add_argument("--start", type=date_type, help="first checkout day, YYYY-MM-DD")
+    export_parser.add_argument("--end", type=date_type, help="last checkout day, YYYY-MM-DD")
+    export_parser.add_argument("--format", choices=["csv", "jsonl"], default="csv", help="output format")
+    export_parser.add_argument("--output", help="output file path, stdout when omitted")
     return parser
 
 
@@ -384,8 +4137,18 @@ def run():
     parsed_args = args.parse_args()
 
     app = App(parsed_args.db_path)
+    if parsed_args.trace:
+        app.db.tracer = Tracer(parsed_args.trace, parsed_args.slow_query_ms / 1000)
+    if parsed_args.query_cache:
+        app.db.query_cache = QueryCache(path=parsed_args.query_cache)
+    if parsed_args.command:
+        sys.exit(app.run_command(parsed_args))
+
     if not app.init_app():
         app.exit_app(1)
+    if parsed_args.rebuild_stats:
+        print("# Rebuilding database statistics")
+        app.db.db_stats(rebuild=True)
 
     app.show_main_menu()
     pass
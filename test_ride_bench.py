@@ -0,0 +1,86 @@
+import csv
+import gzip
+import json
+import os
+import tempfile
+import unittest
+import zipfile
+
+from ride_bench import TripGenerator, compare_baseline, run
+from ride_data import AppDB
+
+
+class TestTripGenerator(unittest.TestCase):
+    def test_write_report(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            report_path = os.path.join(temp_dir, "report.csv")
+            TripGenerator(kiosks=5, bikes=20, days=10).write_report(report_path, 1_000, chunk_size=300)
+            with open(report_path, newline="") as fopen:
+                rows = list(csv.DictReader(fopen))
+
+            self.assertEqual(list(rows[0].keys()), AppDB.csv_fields())
+            self.assertEqual(len(rows), 1_000)
+            self.assertEqual(len({row["TripId"] for row in rows}), 1_000)
+            self.assertLessEqual(len({row["CheckoutKioskName"] for row in rows}), 5)
+            self.assertLessEqual(len({row["Bike"] for row in rows}), 20)
+            self.assertEqual(rows[0]["CheckoutDateLocal"], "2024-01-01")
+            self.assertEqual(rows[-1]["CheckoutDateLocal"], "2024-01-10")
+
+            app_db = AppDB(os.path.join(temp_dir, "test.db"))
+            app_db.init_db()
+            app_db.import_report_to_db(report_path)
+            self.assertEqual(app_db.db_stats()["row_count"], 1_000)
+
+    def test_write_report_compressed_reproducible(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            first, second = os.path.join(temp_dir, "first.csv.gz"), os.path.join(temp_dir, "second.csv.gz")
+            TripGenerator(seed=7).write_report(first, 500)
+            TripGenerator(seed=7).write_report(second, 500)
+            with gzip.open(first, "rt") as first_open, gzip.open(second, "rt") as second_open:
+                self.assertEqual(first_open.read(), second_open.read())
+
+    def test_write_report_zip(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            report_path = os.path.join(temp_dir, "report.zip")
+            TripGenerator(kiosks=5, bikes=20, days=10).write_report(report_path, 1_000, chunk_size=300)
+            with zipfile.ZipFile(report_path) as archive:
+                self.assertEqual(archive.namelist(), ["report.csv"])
+
+            app_db = AppDB(os.path.join(temp_dir, "test.db"))
+            app_db.init_db()
+            app_db.import_report_to_db(report_path)
+            self.assertEqual(app_db.db_stats()["row_count"], 1_000)
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_compare_baseline(self):
+        baseline = {"rows": 100, "results": {"import": {"seconds": 1.0}, "db_stats": {"seconds": 0.1}}}
+        current = {
+            "rows": 100,
+            "results": {"import": {"seconds": 1.1}, "db_stats": {"seconds": 0.2}},
+        }
+        regressions = compare_baseline(current, baseline, tolerance=0.25)
+        self.assertEqual([each["name"] for each in regressions], ["db_stats"])
+        self.assertEqual(regressions[0]["change"], 1.0)
+
+        current["rows"] = 200
+        self.assertEqual(compare_baseline(current, baseline), [])
+
+    def test_run(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output = os.path.join(temp_dir, "bench.json")
+            exit_code = run(["run", "--rows", "2000", "--repeat", "1", "--days", "20", "--output", output])
+            self.assertEqual(exit_code, 0)
+            with open(output) as fopen:
+                results = json.load(fopen)
+            self.assertEqual(results["rows"], 2_000)
+            for name in ("import", "db_stats", "date_range_view", "date_range_working_set", "report_daily"):
+                self.assertIn("seconds", results["results"][name])
+            self.assertIn("seconds", results["results"]["flow_trips"])
+            self.assertEqual(results["results"]["flow_trips"]["target_seconds"], 0.002)
+            self.assertGreater(results["results"]["import"]["rows_per_sec"], 0)
+            self.assertGreater(results["peak_rss_mb"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
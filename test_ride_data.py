@@ -1,6 +1,10 @@
 import csv
+import gzip
 import io
+import json
+import subprocess
 import sys
+import time
 import unittest
 
 # from unittest import mock
@@ -8,8 +12,10 @@ from unittest.mock import patch
 import sqlite3
 import os
 import tempfile
+import zipfile
 
-from ride_data import App, AppDB
+import ride_data
+from ride_data import App, AppDB, BikeTimeline, FlowMatrix, HyperLogLog, QuantileSketch, QueryCache, Tracer, app_args
 
 
 class TestAppDB(unittest.TestCase):
@@ -96,6 +102,51 @@ class TestAppDB(unittest.TestCase):
             with self.assertRaises(Exception):
                 app_db.init_db()
 
+    @patch("builtins.print")
+    def test_init_db_migrate_legacy(self, mock_print):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_db = os.path.join(temp_dir, "test.db")
+            conn = sqlite3.connect(temp_db)
+            conn.execute(AppDB.create_db_schema().replace(",`CheckoutEpoch` INTEGER,`ReturnEpoch` INTEGER", ""))
+            conn.execute(
+                "INSERT INTO ride_data (TripId, CheckoutDateLocal, CheckoutTimeLocal, ReturnDateLocal, ReturnTimeLocal) "
+                "VALUES (1, '2024-06-02', '16:06:24', '2024-06-02', '16:06:32');"
+            )
+            conn.commit()
+            conn.close()
+
+            app_db = AppDB(temp_db)
+            app_db.init_db()
+            app_db.init_db()
+            conn = app_db.connect_db(temp_db)
+            version = conn.execute("PRAGMA user_version;").fetchone()["user_version"]
+            self.assertEqual(version, app_db.schema_migrations()[-1][0])
+            row = conn.execute("SELECT CheckoutEpoch, ReturnEpoch FROM ride_data;").fetchone()
+            self.assertEqual(row, {"CheckoutEpoch": 1717344384, "ReturnEpoch": 1717344392})
+            indexes = {each["name"] for each in conn.execute("PRAGMA index_list(ride_data);").fetchall()}
+            self.assertTrue(set(AppDB.ride_data_indexes()) <= indexes)
+            plan = conn.execute("EXPLAIN QUERY PLAN SELECT * FROM ride_data WHERE CheckoutEpoch > 0;").fetchall()
+            self.assertIn("idx_ride_data_checkout_epoch", plan[0]["detail"])
+            conn.close()
+
+    def test_import_report_to_db_epoch(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            test_csv = os.path.join(temp_dir, "test.csv")
+            with open(test_csv, "w") as fopen:
+                fopen.writelines(self.sample_csv_lines())
+
+            temp_db = os.path.join(temp_dir, "test.db")
+            app_db = AppDB(temp_db)
+            app_db.init_db()
+            app_db.import_report_to_db(test_csv)
+            conn = app_db.connect_db(temp_db)
+            rows = conn.execute(
+                "SELECT CheckoutEpoch = CAST(strftime('%s', CheckoutDateTime) AS INTEGER) AS checkout_match, "
+                "ReturnEpoch = CAST(strftime('%s', ReturnDateTime) AS INTEGER) AS return_match FROM ride_data;"
+            ).fetchall()
+            conn.close()
+            self.assertEqual(rows, [{"checkout_match": 1, "return_match": 1}] * 2)
+
     def test_db_table_exists(self):
         conn = sqlite3.connect(":memory:")
         conn.execute("CREATE TABLE `foo` (bar str);")
@@ -135,6 +186,265 @@ class TestAppDB(unittest.TestCase):
             self.assertEqual(app_db.db_stats(), {})
             mock_print.assert_called_with("\n# DB stats error | no such table: ride_data")
 
+    def test_db_stats_custom_table(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_db = os.path.join(temp_dir, "test.db")
+            conn = sqlite3.connect(temp_db)
+            conn.execute(AppDB.create_db_schema())
+            sql = "INSERT INTO ride_data (FileName, CheckoutDateLocal, CheckoutTimeLocal) VALUES (?, ?, ?)"
+            conn.executemany(sql, [("foo.csv", "2024-04-01", "12:00:00"), ("bar.csv", "2024-05-01", "23:00:00")])
+            conn.execute("CREATE VIEW april AS SELECT * FROM ride_data WHERE CheckoutDateLocal < '2024-05-01';")
+            conn.commit()
+
+            stats = {
+                "file_count": 1,
+                "max_date": "2024-04-01 12:00:00",
+                "min_date": "2024-04-01 12:00:00",
+                "row_count": 1,
+            }
+            self.assertEqual(AppDB(temp_db).db_stats("april"), stats)
+
+    @patch("builtins.print")
+    def test_db_stats_catalog(self, mock_print):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            lines = self.sample_csv_lines()
+            with open(os.path.join(temp_dir, "one.csv"), "w") as fopen:
+                fopen.writelines(lines)
+            with open(os.path.join(temp_dir, "two.csv"), "w") as fopen:
+                fopen.writelines([lines[0], lines[2]])
+
+            app_db = AppDB(os.path.join(temp_dir, "test.db"))
+            app_db.init_db()
+            app_db.import_report_to_db(os.path.join(temp_dir, "one.csv"))
+            stats = {
+                "file_count": 1,
+                "max_date": "2024-06-02 16:07:27",
+                "min_date": "2024-06-02 16:06:24",
+                "row_count": 2,
+            }
+            self.assertEqual(app_db.db_stats(), stats)
+
+            # two.csv replaces one of one.csv's trips
+            app_db.import_report_to_db(os.path.join(temp_dir, "two.csv"))
+            stats = {
+                "file_count": 2,
+                "max_date": "2024-06-02 16:07:27",
+                "min_date": "2024-06-02 16:06:24",
+                "row_count": 2,
+            }
+            self.assertEqual(app_db.db_stats(), stats)
+            self.assertEqual(app_db.db_stats(rebuild=True), stats)
+
+            conn = app_db.connect_db(app_db.db_path)
+            catalog = conn.execute("SELECT FileName, RowCount FROM stats_catalog ORDER BY FileName;").fetchall()
+            conn.close()
+            self.assertEqual(catalog, [{"FileName": "one.csv", "RowCount": 1}, {"FileName": "two.csv", "RowCount": 1}])
+
+    @patch("builtins.print")
+    def test_rollup_report(self, mock_print):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            lines = self.sample_csv_lines()
+            with open(os.path.join(temp_dir, "june.csv"), "w") as fopen:
+                fopen.writelines(lines)
+            with open(os.path.join(temp_dir, "july.csv"), "w") as fopen:
+                fopen.writelines(
+                    [lines[0], lines[1].replace("33567793", "33600000").replace("2024-06-02", "2024-07-04")]
+                )
+
+            app_db = AppDB(os.path.join(temp_dir, "test.db"))
+            app_db.init_db()
+            app_db.import_report_to_db(os.path.join(temp_dir, "june.csv"))
+            app_db.import_report_to_db(os.path.join(temp_dir, "july.csv"))
+
+            self.assertEqual(
+                app_db.rollup_report("daily"),
+                [
+                    {"Day": "2024-06-02", "Trips": 2, "Minutes": 0.0, "Revenue": 0.0, "Distance": 0.0, "Calories": 0.0},
+                    {"Day": "2024-07-04", "Trips": 1, "Minutes": 0.0, "Revenue": 0.0, "Distance": 0.0, "Calories": 0.0},
+                ],
+            )
+            self.assertEqual(app_db.rollup_report("hourly", start="2024-07-01")[0]["Trips"], 1)
+            self.assertEqual(app_db.rollup_report("kiosk", end="2024-06-30")[0]["KioskName"], "Lauridsen Skatepark")
+
+            # incremental refresh matches a full rebuild
+            conn = app_db.connect_db(app_db.db_path)
+            incremental = conn.execute("SELECT * FROM rollup_hourly ORDER BY Day, Hour;").fetchall()
+            app_db.rebuild_rollups(conn)
+            self.assertEqual(conn.execute("SELECT * FROM rollup_hourly ORDER BY Day, Hour;").fetchall(), incremental)
+            conn.close()
+
+    @patch("builtins.print")
+    def test_set_date_range(self, mock_print):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            lines = self.sample_csv_lines()
+            with open(os.path.join(temp_dir, "june.csv"), "w") as fopen:
+                fopen.writelines(lines)
+            with open(os.path.join(temp_dir, "july.csv"), "w") as fopen:
+                fopen.writelines(
+                    [lines[0], lines[1].replace("33567793", "33600000").replace("2024-06-02", "2024-07-04")]
+                )
+
+            app_db = AppDB(os.path.join(temp_dir, "test.db"))
+            app_db.init_db()
+            app_db.import_report_to_db(os.path.join(temp_dir, "june.csv"))
+            app_db.set_date_range("2024-06-01", "2024-07-31")
+            self.assertEqual(app_db.working_set(), "ride_range")
+            self.assertEqual(app_db.range_stats()["row_count"], 2)
+
+            # the working set belongs to the session, another session of the database keeps its own
+            other = AppDB(app_db.db_path)
+            other.init_db()
+            other.set_date_range("2024-07-01", None)
+            other.drop_temp_tables()
+            rows = app_db.query_range("SELECT COUNT(*) AS cnt FROM {table};", materialize=False)
+            self.assertEqual(rows[0]["cnt"], 2)
+            self.assertEqual(other.query_rows("SELECT name FROM sqlite_master WHERE type = 'view';"), [])
+            other.close()
+
+            # reused range is materialized, and rebuilt once new data lands
+            self.assertEqual(app_db.working_set(), "temp.ride_range_set")
+            app_db.import_report_to_db(os.path.join(temp_dir, "july.csv"))
+            self.assertEqual(app_db.range_stats()["row_count"], 3)
+            self.assertEqual(app_db.query_range("SELECT COUNT(*) AS cnt FROM {table};")[0]["cnt"], 3)
+            self.assertEqual(app_db.working_set(), "temp.ride_range_set")
+
+            app_db.set_date_range("2024-07-01", None)
+            self.assertEqual(app_db.range_stats()["min_date"], "2024-07-04 16:06:24")
+            self.assertEqual(app_db.rollup_report("daily")[0]["Day"], "2024-07-04")
+            with self.assertRaises(ValueError):
+                app_db.set_date_range("2024-07-01", "2024-06-01")
+
+    @patch("builtins.print")
+    def test_delete_rows_by_filename(self, mock_print):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            lines = self.sample_csv_lines()
+            with open(os.path.join(temp_dir, "june.csv"), "w") as fopen:
+                fopen.writelines(lines)
+            with open(os.path.join(temp_dir, "july.csv"), "w") as fopen:
+                fopen.writelines(
+                    [lines[0], lines[1].replace("33567793", "33600000").replace("2024-06-02", "2024-07-04")]
+                )
+
+            app_db = AppDB(os.path.join(temp_dir, "test.db"))
+            app_db.init_db()
+            app_db.import_reports(temp_dir, workers=1)
+            summary = app_db.delete_rows_by_filename("june.csv", batch_size=1)
+            self.assertEqual((summary["rows"], summary["files"]), (2, ["june.csv"]))
+
+            stats = {
+                "file_count": 1,
+                "max_date": "2024-07-04 16:06:24",
+                "min_date": "2024-07-04 16:06:24",
+                "row_count": 1,
+            }
+            self.assertEqual(app_db.db_stats(), stats)
+            self.assertEqual([each["Day"] for each in app_db.rollup_report("daily")], ["2024-07-04"])
+            conn = app_db.connect_db(app_db.db_path)
+            self.assertEqual(conn.execute("PRAGMA auto_vacuum;").fetchone()["auto_vacuum"], 2)
+            manifest = conn.execute("SELECT FileName FROM import_manifest;").fetchall()
+            conn.close()
+            self.assertEqual(manifest, [{"FileName": "july.csv"}])
+
+            # deleted report is no longer skipped by the manifest
+            self.assertEqual(app_db.import_report_to_db(os.path.join(temp_dir, "june.csv"))["status"], "imported")
+
+    @patch("builtins.print")
+    def test_incremental_vacuum(self, mock_print):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            app_db = AppDB(os.path.join(temp_dir, "test.db"))
+            app_db.init_db()
+            with app_db.writer() as conn:
+                conn.execute("CREATE TABLE filler (`Value` TEXT);")
+                conn.executemany("INSERT INTO filler VALUES (?);", (("x" * 1000,) for _ in range(2_000)))
+                conn.commit()
+                conn.execute("DELETE FROM filler;")
+                conn.commit()
+                free_pages = conn.execute("PRAGMA freelist_count;").fetchone()["freelist_count"]
+                self.assertGreater(free_pages, 400)
+
+                # each step frees step_pages pages in one transaction
+                steps = []
+                conn.set_trace_callback(lambda sql: steps.append(sql) if "incremental_vacuum(" in sql else None)
+                self.assertEqual(AppDB.incremental_vacuum(conn, step_pages=200), free_pages)
+                conn.set_trace_callback(None)
+                self.assertEqual(len(steps), -(-free_pages // 200))
+                self.assertEqual(conn.execute("PRAGMA freelist_count;").fetchone()["freelist_count"], 0)
+
+    @patch("builtins.print")
+    def test_delete_rows_failure(self, mock_print):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            lines = self.sample_csv_lines()
+            test_csv = os.path.join(temp_dir, "test.csv")
+            with open(test_csv, "w") as fopen:
+                fopen.writelines(lines + [lines[2].replace("33567803", "33567900")])
+
+            app_db = AppDB(os.path.join(temp_dir, "test.db"))
+            app_db.init_db()
+            app_db.import_report_to_db(test_csv)
+            version = app_db.data_version()
+            refresh_derived = app_db.refresh_derived
+            calls = []
+
+            def fail_second(conn, touched, **kwargs):
+                calls.append(touched)
+                if len(calls) == 2:
+                    raise Exception("disk full")
+                return refresh_derived(conn, touched, **kwargs)
+
+            # the committed first batch is reported, with its derived rows refreshed and a newer data version
+            with patch.object(app_db, "refresh_derived", side_effect=fail_second):
+                summary = app_db.delete_rows_by_filename("test.csv", batch_size=1)
+            self.assertEqual((summary["rows"], summary["error"]), (1, "disk full"))
+            self.assertEqual(app_db.db_stats()["row_count"], 2)
+            self.assertEqual(app_db.rollup_report("daily")[0]["Trips"], 2)
+            self.assertEqual(app_db.sketch_report(())[0]["Trips"], 2)
+            # the batch and the bike timeline refresh after it each bump the data version
+            self.assertEqual(app_db.data_version(), version + 2)
+            self.assertEqual(sum(each["Trips"] for each in app_db.bike_utilization()), 2)
+
+    @patch("builtins.print")
+    def test_delete_rows_bike_timeline(self, mock_print):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            lines = self.sample_csv_lines()
+            test_csv = os.path.join(temp_dir, "test.csv")
+            with open(test_csv, "w") as fopen:
+                fopen.writelines(lines + [lines[2].replace("33567803", "33567900")])
+
+            app_db = AppDB(os.path.join(temp_dir, "test.db"))
+            app_db.init_db()
+            app_db.import_report_to_db(test_csv)
+
+            # the batches leave the bike timeline to one refresh after the last of them
+            with patch.object(app_db, "refresh_bike_timeline", wraps=app_db.refresh_bike_timeline) as refresh:
+                self.assertEqual(app_db.delete_rows_by_filename("test.csv", batch_size=1)["rows"], 3)
+            self.assertEqual([each.args[1] for each in refresh.call_args_list if each.args[1:]], [{"11434", "21865"}])
+            self.assertEqual(app_db.bike_utilization(), [])
+
+    @patch("builtins.print")
+    def test_delete_rows_by_date_range(self, mock_print):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            lines = self.sample_csv_lines()
+            test_csv = os.path.join(temp_dir, "test.csv")
+            with open(test_csv, "w") as fopen:
+                fopen.writelines(lines + [lines[1].replace("33567793", "33600000").replace("2024-06-02", "2024-07-04")])
+
+            app_db = AppDB(os.path.join(temp_dir, "test.db"))
+            app_db.init_db()
+            app_db.import_report_to_db(test_csv)
+            self.assertEqual(app_db.delete_rows_by_date_range("2024-07-01", None)["rows"], 1)
+            self.assertEqual(app_db.delete_rows_by_date_range("2024-07-01", "2024-07-31")["rows"], 0)
+            self.assertEqual(app_db.db_stats()["row_count"], 2)
+            self.assertEqual([each["Day"] for each in app_db.rollup_report("daily")], ["2024-06-02"])
+
+            # the report keeps its manifest entry, importing it again does not restore the deleted trips
+            self.assertEqual(app_db.import_reports(temp_dir, workers=1)[0]["status"], "skipped")
+            self.assertEqual(app_db.db_stats()["row_count"], 2)
+            with self.assertRaises(ValueError):
+                app_db.delete_rows_by_date_range(None, None)
+
+    def test_day_runs(self):
+        self.assertEqual(AppDB.day_runs({5, 1, 2, 3, 7}), [(1, 3), (5, 5), (7, 7)])
+
     def test_import_report_to_db(self):
         with tempfile.TemporaryDirectory() as temp_dir:
             # create temp csv file
@@ -147,6 +457,891 @@ class TestAppDB(unittest.TestCase):
             app_db.init_db()
             app_db.import_report_to_db(test_csv)
 
+    def test_import_report_to_db_rows(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            test_csv = os.path.join(temp_dir, "test.csv")
+            with open(test_csv, "w") as fopen:
+                fopen.writelines(self.sample_csv_lines())
+
+            temp_db = os.path.join(temp_dir, "test.db")
+            app_db = AppDB(temp_db)
+            app_db.init_db()
+            summary = app_db.import_report_to_db(test_csv)
+            self.assertEqual(summary["rows"], 2)
+            self.assertEqual(summary["file"], "test.csv")
+
+            conn = app_db.connect_db(temp_db)
+            rows = conn.execute("SELECT * FROM ride_data ORDER BY TripId;").fetchall()
+            conn.close()
+            self.assertEqual([each["TripId"] for each in rows], [33567793, 33567803])
+            self.assertEqual(rows[0]["Bike"], "21865")
+            self.assertEqual(rows[0]["UserCity"], "")
+            self.assertEqual(rows[0]["Distance"], 0.0)
+            self.assertEqual(rows[0]["CheckoutDateTime"], "2024-06-02 16:06:24")
+            self.assertEqual(rows[1]["ReturnDateTime"], "2024-06-02 16:07:35")
+
+    def test_prepare_report_frame_compact(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            lines = self.sample_csv_lines()
+            test_csv = os.path.join(temp_dir, "test.csv")
+            with open(test_csv, "w") as fopen:
+                # missing usage fee and return time
+                fopen.writelines([lines[0], lines[1].replace(",0,N,", ",,N,").replace("16:06:32", "")])
+
+            df = AppDB.prepare_report_frame(next(AppDB.read_report(test_csv)), "test.csv", "2024-06-03 00:00:00")
+            df = AppDB.validate_report_frame(df)[0]
+            self.assertEqual(str(df["CheckoutKioskName"].dtype), "category")
+            self.assertEqual(str(df["TripOver30Mins"].dtype), "boolean")
+            self.assertEqual(df["CheckoutEpoch"].tolist(), [1717344384])
+            self.assertTrue(df["ReturnEpoch"].isna().all())
+
+            row = dict(
+                zip(df.columns.to_list() + list(AppDB.datetime_text_columns()), next(AppDB.frame_rows(df, 10))[0])
+            )
+            self.assertEqual((row["UsageFee"], row["ReturnEpoch"]), (None, None))
+            self.assertEqual((row["UserCity"], row["TripOver30Mins"], row["AdjustmentFlag"]), ("", "N", "N"))
+            self.assertEqual((row["CheckoutDateTime"], row["ReturnDateTime"]), ("2024-06-02 16:06:24", "2024-06-02 "))
+
+    def test_validate_report_frame(self):
+        import numpy as np
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            lines = self.sample_csv_lines()
+            test_csv = os.path.join(temp_dir, "test.csv")
+            bad_lines = [
+                lines[1].replace("2395732", ""),
+                lines[1].replace("33567793", "33567799").replace(",0,0,0,N,", ",0,0,0,Yes,"),
+                lines[1].replace("33567793", "33567794").replace("16:06:24", "16:xx:24"),
+                lines[1].replace("33567793", "33567795").replace("16:06:32", "16:05:32"),
+                lines[1].replace("33567793", "33567796").replace(",0,0,0,N,", ",-1,0,0,N,"),
+                lines[1].replace("33567793", "33567797").replace(",0,0,0,N,", ",0,0,-2.5,N,"),
+                lines[1].replace("33567793", "33567798").replace(",Lauridsen Skatepark,", ",Nowhere,"),
+                lines[1].replace("33567793", "33567803"),
+            ]
+            with open(test_csv, "w") as fopen:
+                fopen.writelines(lines + bad_lines)
+
+            df = AppDB.prepare_report_frame(next(AppDB.read_report(test_csv)), "test.csv", "2024-06-03 00:00:00")
+            good, quarantine = AppDB.validate_report_frame(df, {"Lauridsen Skatepark"})
+            self.assertEqual(good["TripId"].tolist(), [33567793, 33567803])
+            self.assertEqual((str(good["TripId"].dtype), str(good["UserId"].dtype)), ("int64", "int64"))
+            reasons = [
+                "bad_type",
+                "bad_flag",
+                "bad_datetime",
+                "return_before_checkout",
+                "negative_duration",
+                "negative_fee",
+                "unknown_kiosk",
+                "duplicate_trip_id",
+            ]
+            self.assertEqual(quarantine["Reason"].tolist(), reasons)
+            rows = list(AppDB.quarantine_rows(quarantine.iloc[:1], "test.csv", "2024-06-03 00:00:00"))
+            self.assertEqual(rows[0][:3], ("test.csv", "33567793", "bad_type"))
+            self.assertEqual(json.loads(rows[0][3])["UserId"], None)
+            rows = list(AppDB.quarantine_rows(quarantine.iloc[1:2], "test.csv", "2024-06-03 00:00:00"))
+            self.assertEqual(json.loads(rows[0][3])["AdjustmentFlag"], "Yes")
+            self.assertEqual(str(good["AdjustmentFlag"].dtype), "boolean")
+
+            # without known kiosks only the other checks run, TripIds already loaded are duplicates
+            loaded = good["TripId"].to_numpy()
+            good, quarantine = AppDB.validate_report_frame(df, seen_trip_ids=lambda ids: ids[np.isin(ids, loaded)])
+            self.assertEqual(good["TripId"].tolist(), [33567798])
+            self.assertEqual(quarantine["Reason"].tolist()[-1], "duplicate_trip_id")
+
+    @patch("builtins.print")
+    def test_import_report_to_db_quarantine(self, mock_print):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            lines = self.sample_csv_lines()
+            test_csv = os.path.join(temp_dir, "test.csv")
+            with open(test_csv, "w") as fopen:
+                fopen.writelines(lines + [lines[1].replace("2395732", "2395732x"), lines[2]])
+
+            app_db = AppDB(os.path.join(temp_dir, "test.db"))
+            app_db.init_db()
+            summary = app_db.import_report_to_db(test_csv, chunk_size=2, stream=True)
+            self.assertEqual(summary["rows"], 2)
+            self.assertEqual(summary["quarantined"], {"bad_type": 1, "duplicate_trip_id": 1})
+            self.assertEqual(app_db.db_stats()["row_count"], 2)
+            counts = app_db.quarantine_counts()
+            self.assertEqual(
+                [(each["Reason"], each["Rows"]) for each in counts], [("bad_type", 1), ("duplicate_trip_id", 1)]
+            )
+
+            # a full import of the report again replaces its quarantined rows
+            app_db.known_kiosks = {"Lauridsen Skatepark"}
+            summary = app_db.import_report_to_db(test_csv, force=True)
+            self.assertEqual(summary["quarantined"], {"bad_type": 1, "duplicate_trip_id": 1})
+            with app_db.reader() as conn:
+                rows = conn.execute("SELECT TripId, Reason, RowData FROM import_quarantine ORDER BY Reason;").fetchall()
+            self.assertEqual([each["TripId"] for each in rows], ["33567793", "33567803"])
+            self.assertEqual(json.loads(rows[0]["RowData"])["UserId"], "2395732x")
+
+    def test_import_report_to_db_chunk_size(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            test_csv = os.path.join(temp_dir, "test.csv")
+            with open(test_csv, "w") as fopen:
+                fopen.writelines(self.sample_csv_lines())
+
+            results = []
+            for chunk_size in (1, 1000):
+                temp_db = os.path.join(temp_dir, f"test_{chunk_size}.db")
+                app_db = AppDB(temp_db)
+                app_db.init_db()
+                app_db.import_report_to_db(test_csv, chunk_size=chunk_size)
+                conn = app_db.connect_db(temp_db)
+                results.append(conn.execute("SELECT * FROM ride_data ORDER BY TripId;").fetchall())
+                conn.close()
+            for each in results:
+                [row.pop("ImportDateTime") for row in each]
+            self.assertEqual(results[0], results[1])
+
+    @patch("builtins.print")
+    def test_import_report_to_db_stream_failure(self, mock_print):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            lines = self.sample_csv_lines()
+            test_csv = os.path.join(temp_dir, "test.csv")
+            with open(test_csv, "w") as fopen:
+                fopen.writelines(lines + [lines[2].replace("33567803", "33567900")])
+
+            app_db = AppDB(os.path.join(temp_dir, "test.db"))
+            app_db.init_db()
+            version = app_db.data_version()
+            write_report_frame = app_db.write_report_frame
+            calls = []
+
+            def fail_second(conn, df, chunk_size):
+                calls.append(len(df))
+                if len(calls) == 2:
+                    raise Exception("disk full")
+                return write_report_frame(conn, df, chunk_size)
+
+            # the committed first chunk keeps its derived rows and a newer data version
+            with patch.object(app_db, "write_report_frame", side_effect=fail_second):
+                self.assertEqual(app_db.import_report_to_db(test_csv, chunk_size=1, stream=True), {})
+            self.assertEqual(app_db.db_stats()["row_count"], 1)
+            self.assertEqual(app_db.rollup_report("daily")[0]["Trips"], 1)
+            self.assertEqual(app_db.sketch_report(())[0]["Trips"], 1)
+            self.assertEqual(len(app_db.bike_utilization()), 1)
+            self.assertEqual(app_db.data_version(), version + 1)
+
+            # without a manifest entry the report loads in full again
+            self.assertEqual(app_db.import_report_to_db(test_csv, chunk_size=1, stream=True)["status"], "imported")
+            self.assertEqual(app_db.rollup_report("daily")[0]["Trips"], 3)
+
+    def test_import_report_to_db_stream_compressed(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            gz_csv = os.path.join(temp_dir, "test.csv.gz")
+            with gzip.open(gz_csv, "wt") as fopen:
+                fopen.writelines(self.sample_csv_lines())
+            zip_csv = os.path.join(temp_dir, "test.zip")
+            with zipfile.ZipFile(zip_csv, "w") as zopen:
+                zopen.writestr("test.csv", "".join(self.sample_csv_lines()))
+
+            for report in (gz_csv, zip_csv):
+                temp_db = os.path.join(temp_dir, f"{os.path.basename(report)}.db")
+                app_db = AppDB(temp_db)
+                app_db.init_db()
+                summary = app_db.import_report_to_db(report, chunk_size=1, stream=True)
+                self.assertEqual(summary["rows"], 2)
+
+                conn = app_db.connect_db(temp_db)
+                rows = conn.execute("SELECT TripId, FileName FROM ride_data ORDER BY TripId;").fetchall()
+                conn.close()
+                self.assertEqual(
+                    rows,
+                    [
+                        {"TripId": 33567793, "FileName": os.path.basename(report)},
+                        {"TripId": 33567803, "FileName": os.path.basename(report)},
+                    ],
+                )
+
+    def test_report_paths(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for name in ("b.csv", "a.csv.gz", "notes.txt"):
+                open(os.path.join(temp_dir, name), "w").close()
+            self.assertEqual(
+                AppDB.report_paths(temp_dir),
+                [os.path.join(temp_dir, "a.csv.gz"), os.path.join(temp_dir, "b.csv")],
+            )
+            self.assertEqual(AppDB.report_paths(os.path.join(temp_dir, "*.txt")), [os.path.join(temp_dir, "notes.txt")])
+
+    @patch("builtins.print")
+    def test_import_reports(self, mock_print):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            lines = self.sample_csv_lines()
+            with open(os.path.join(temp_dir, "one.csv"), "w") as fopen:
+                fopen.writelines(lines[:2])
+            with open(os.path.join(temp_dir, "two.csv"), "w") as fopen:
+                fopen.writelines([lines[0], lines[2]])
+            with open(os.path.join(temp_dir, "bad.csv"), "w") as fopen:
+                fopen.writelines(["foo,bar\n", "1,2\n"])
+            with open(os.path.join(temp_dir, "malformed.csv"), "w") as fopen:
+                fopen.writelines([lines[0], "foo,bar\n"])
+
+            temp_db = os.path.join(temp_dir, "test.db")
+            app_db = AppDB(temp_db)
+            app_db.init_db()
+            results = {each["file"]: each for each in app_db.import_reports(temp_dir, workers=2)}
+
+            self.assertEqual(results["one.csv"]["status"], "imported")
+            self.assertEqual(results["two.csv"]["rows"], 1)
+            self.assertEqual(results["bad.csv"]["status"], "failed")
+            self.assertEqual(results["malformed.csv"]["rows"], 0)
+            self.assertEqual(results["malformed.csv"]["quarantined"], {"bad_type": 1})
+            conn = app_db.connect_db(temp_db)
+            rows = conn.execute("SELECT FileName FROM ride_data ORDER BY TripId;").fetchall()
+            conn.close()
+            self.assertEqual(rows, [{"FileName": "one.csv"}, {"FileName": "two.csv"}])
+
+    @patch("builtins.print")
+    def test_import_report_to_db_manifest(self, mock_print):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            lines = self.sample_csv_lines()
+            test_csv = os.path.join(temp_dir, "test.csv")
+            with open(test_csv, "w") as fopen:
+                fopen.writelines(lines[:2])
+
+            temp_db = os.path.join(temp_dir, "test.db")
+            app_db = AppDB(temp_db)
+            app_db.init_db()
+            self.assertEqual(app_db.import_report_to_db(test_csv)["status"], "imported")
+            self.assertEqual(app_db.import_report_to_db(test_csv)["status"], "skipped")
+
+            # appended export, only the new row is loaded
+            with open(test_csv, "a") as fopen:
+                fopen.write(lines[2])
+            summary = app_db.import_report_to_db(test_csv)
+            self.assertEqual((summary["status"], summary["rows"]), ("appended", 1))
+
+            conn = app_db.connect_db(temp_db)
+            entry = conn.execute("SELECT * FROM import_manifest WHERE FileName = 'test.csv';").fetchone()
+            self.assertEqual(conn.execute("SELECT COUNT(*) AS cnt FROM ride_data;").fetchone()["cnt"], 2)
+            conn.close()
+            self.assertEqual((entry["RowCount"], entry["TripIdMin"], entry["TripIdMax"]), (2, 33567793, 33567803))
+            self.assertEqual(entry["FileSize"], os.path.getsize(test_csv))
+
+            # rewritten export, whole file is loaded again
+            with open(test_csv, "w") as fopen:
+                fopen.writelines([lines[0], lines[2]])
+            self.assertEqual(app_db.import_report_to_db(test_csv)["status"], "imported")
+            self.assertEqual(app_db.import_report_to_db(test_csv, force=True)["status"], "imported")
+
+    @patch("builtins.print")
+    def test_import_reports_manifest(self, mock_print):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with open(os.path.join(temp_dir, "one.csv"), "w") as fopen:
+                fopen.writelines(self.sample_csv_lines())
+
+            app_db = AppDB(os.path.join(temp_dir, "test.db"))
+            app_db.init_db()
+            self.assertEqual(app_db.import_reports(temp_dir, workers=1)[0]["status"], "imported")
+            self.assertEqual(app_db.import_reports(temp_dir, workers=1)[0]["status"], "skipped")
+
+    @patch("builtins.print")
+    def test_import_seconds(self, mock_print):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            test_csv = os.path.join(temp_dir, "test.csv")
+            with open(test_csv, "w") as fopen:
+                fopen.writelines(self.sample_csv_lines())
+
+            app_db = AppDB(os.path.join(temp_dir, "test.db"))
+            app_db.init_db()
+            refresh_derived = app_db.refresh_derived
+
+            def slow_refresh(conn, touched, **kwargs):
+                time.sleep(0.2)
+                return refresh_derived(conn, touched, **kwargs)
+
+            # the summary and manifest seconds include the derived table refresh after the load
+            with patch.object(app_db, "refresh_derived", side_effect=slow_refresh):
+                summaries = [app_db.import_report_to_db(test_csv)]
+                summaries += app_db.import_reports(test_csv, workers=1, force=True)
+                manifest = app_db.query_rows("SELECT ImportSeconds FROM import_manifest;")
+            self.assertTrue(all(summary["seconds"] >= 0.2 for summary in summaries))
+            self.assertLessEqual(summaries[0]["rows_per_sec"], 2 / 0.2)
+            self.assertGreaterEqual(manifest[0]["ImportSeconds"], 0.2)
+
+    @patch("builtins.print")
+    def test_import_report_to_db_trace(self, mock_print):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            test_csv = os.path.join(temp_dir, "test.csv")
+            with open(test_csv, "w") as fopen:
+                fopen.writelines(self.sample_csv_lines())
+
+            trace_path = os.path.join(temp_dir, "trace.jsonl")
+            app_db = AppDB(os.path.join(temp_dir, "test.db"))
+            app_db.init_db()
+            app_db.tracer = Tracer(trace_path, slow_query_secs=0)
+            summary = app_db.import_report_to_db(test_csv, chunk_size=1, stream=True)
+
+            for stage in ("read", "prepare", "bind", "execute", "commit", "refresh"):
+                self.assertIn(stage, summary["stages"])
+            self.assertEqual((summary["stages"]["execute"]["calls"], summary["stages"]["execute"]["rows"]), (2, 2))
+            with open(trace_path) as fopen:
+                records = [json.loads(line) for line in fopen]
+            self.assertEqual({each["run"] for each in records}, {app_db.tracer.run_id})
+            queries = [each for each in records if each["event"] == "query"]
+            self.assertTrue(all(each["slow"] for each in queries))
+            self.assertTrue(
+                any("plan" in each and each["sql"].startswith("INSERT INTO rollup_hourly") for each in queries)
+            )
+
+            self.assertEqual(app_db.import_reports(test_csv, force=True, workers=1)[0]["stages"]["read"]["rows"], 2)
+
+    @patch("builtins.print")
+    def test_normalize_storage(self, mock_print):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            lines = self.sample_csv_lines()
+            test_csv = os.path.join(temp_dir, "test.csv")
+            with open(test_csv, "w") as fopen:
+                fopen.writelines(lines[:2])
+            other_csv = os.path.join(temp_dir, "other.csv")
+            with open(other_csv, "w") as fopen:
+                fopen.writelines([lines[0], lines[2].replace("Lauridsen Skatepark", "Cowles Commons")])
+
+            temp_db = os.path.join(temp_dir, "test.db")
+            app_db = AppDB(temp_db)
+            app_db.init_db()
+            app_db.import_report_to_db(test_csv)
+            conn = app_db.connect_db(temp_db)
+            before = conn.execute("SELECT * FROM ride_data;").fetchall()
+            conn.close()
+
+            self.assertEqual(app_db.normalize_storage()["rows"], 1)
+            self.assertEqual(app_db.normalize_storage()["rows"], 0)
+            app_db.init_db()
+            app_db.drop_temp_tables()
+            app_db.import_report_to_db(other_csv)
+
+            conn = app_db.connect_db(temp_db)
+            self.assertEqual(AppDB.storage_table(conn), "ride_trip")
+            self.assertEqual(conn.execute("SELECT * FROM ride_data WHERE FileName = 'test.csv';").fetchall(), before)
+            row = conn.execute("SELECT * FROM ride_data WHERE FileName = 'other.csv';").fetchone()
+            self.assertEqual((row["CheckoutKioskName"], row["UserCity"]), ("Cowles Commons", ""))
+            kiosks = conn.execute("SELECT KioskName FROM dim_kiosk ORDER BY KioskName;").fetchall()
+            self.assertEqual([each["KioskName"] for each in kiosks], ["", "Cowles Commons", "Lauridsen Skatepark"])
+            conn.close()
+
+            self.assertEqual(app_db.delete_rows_by_filename("test.csv")["rows"], 1)
+            self.assertEqual(app_db.db_stats()["row_count"], 1)
+            self.assertEqual(app_db.rollup_report("kiosk")[0]["KioskName"], "Cowles Commons")
+
+    @patch("builtins.print")
+    def test_archive_parquet(self, mock_print):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            lines = self.sample_csv_lines()
+            test_csv = os.path.join(temp_dir, "test.csv")
+            with open(test_csv, "w") as fopen:
+                fopen.writelines(lines[:2] + [lines[2].replace("2024-06-02", "2024-07-01")])
+
+            temp_db = os.path.join(temp_dir, "test.db")
+            app_db = AppDB(temp_db)
+            app_db.init_db()
+            app_db.import_report_to_db(test_csv)
+            archive = os.path.join(temp_dir, "archive")
+            summary = app_db.archive_parquet(archive, batch_size=1)
+            self.assertEqual(summary["rows"], 2)
+            self.assertEqual(summary["files"], ["year=2024/month=6/part-0.parquet", "year=2024/month=7/part-0.parquet"])
+            # archiving a month again replaces it
+            self.assertEqual(app_db.archive_parquet(archive, "2024-07-15", "2024-07-15")["rows"], 1)
+
+            # the archive connection is closed when writing fails
+            connections, sqlite_connect = [], sqlite3.connect
+
+            def connect(*args, **kwargs):
+                connections.append(sqlite_connect(*args, **kwargs))
+                return connections[-1]
+
+            with patch("ride_data.sqlite3.connect", side_effect=connect), patch(
+                "pyarrow.dataset.write_dataset", side_effect=OSError("disk full")
+            ):
+                with self.assertRaises(OSError):
+                    app_db.archive_parquet(archive)
+            with self.assertRaises(sqlite3.ProgrammingError):
+                connections[0].execute("SELECT 1;")
+
+            df = AppDB.read_archive(archive, start="2024-07-01", columns=["TripId", "CheckoutEpoch", "UsageFee"])
+            self.assertEqual(df.columns.to_list(), ["TripId", "CheckoutEpoch", "UsageFee"])
+            self.assertEqual(df["TripId"].to_list(), [33567803])
+            self.assertEqual(AppDB.read_archive(archive, "2024-06-03", "2024-06-30").empty, True)
+
+            restored_db = os.path.join(temp_dir, "restored.db")
+            restored = AppDB(restored_db)
+            restored.init_db()
+            restored.normalize_storage()
+            self.assertEqual(restored.restore_archive(archive)["rows"], 2)
+            queries = []
+            for each in (temp_db, restored_db):
+                conn = app_db.connect_db(each)
+                queries.append(conn.execute("SELECT * FROM ride_data ORDER BY TripId;").fetchall())
+                conn.close()
+            self.assertEqual(queries[0], queries[1])
+            self.assertEqual(restored.db_stats()["row_count"], 2)
+
+    def test_query_cache(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache_path = os.path.join(temp_dir, "cache.db")
+            cache = QueryCache(max_bytes=40, path=cache_path)
+            first, second = (
+                QueryCache.key("test.db", "SELECT  *\n FROM t WHERE a = ?;", (each,), 1) for each in (1, 2)
+            )
+            self.assertEqual(first, QueryCache.key("test.db", "SELECT * FROM t WHERE a = ?;", (1,), 1))
+            cache.put(first, [{"a": 1, "name": "first"}])
+            cache.put(second, [{"a": 2, "name": "second"}])
+            # over the memory budget the least recently used result is evicted, the disk tier still has it
+            self.assertEqual(list(cache.entries), [second])
+            self.assertEqual(cache.get(first), [{"a": 1, "name": "first"}])
+            self.assertEqual(QueryCache(path=cache_path).get(second), [{"a": 2, "name": "second"}])
+
+            # a newer data version expires the older results
+            newer = QueryCache.key("test.db", "SELECT * FROM t WHERE a = ?;", (1,), 2)
+            self.assertIsNone(cache.get(newer))
+            self.assertEqual(cache.entries, {})
+            self.assertIsNone(QueryCache(path=cache_path).get(first))
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    @patch("builtins.print")
+    def test_cached_query(self, mock_print):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            lines = self.sample_csv_lines()
+            test_csv = os.path.join(temp_dir, "test.csv")
+            with open(test_csv, "w") as fopen:
+                fopen.writelines(lines[:2])
+            next_csv = os.path.join(temp_dir, "next.csv")
+            with open(next_csv, "w") as fopen:
+                fopen.writelines([lines[0], lines[2]])
+
+            app_db = AppDB(os.path.join(temp_dir, "test.db"))
+            app_db.init_db()
+            app_db.import_report_to_db(test_csv)
+            version = app_db.data_version()
+            self.assertEqual(app_db.db_stats()["row_count"], 1)
+            self.assertEqual(app_db.rollup_report("daily")[0]["Trips"], 1)
+            app_db.db_stats()["row_count"] = 5
+            self.assertEqual(app_db.db_stats()["row_count"], 1)
+            self.assertEqual(app_db.query_cache.hits, 2)
+
+            # an import bumps the data version, cached results are not served again
+            app_db.import_report_to_db(next_csv)
+            self.assertEqual(app_db.data_version(), version + 1)
+            self.assertEqual(app_db.db_stats()["row_count"], 2)
+            self.assertEqual(app_db.rollup_report("daily")[0]["Trips"], 2)
+            app_db.delete_rows_by_filename("next.csv")
+            self.assertEqual(app_db.db_stats()["row_count"], 1)
+
+            # a database recreated at the same path starts over at the same data version, but has a new id
+            cache_path = os.path.join(temp_dir, "cache.db")
+            app_db.query_cache = QueryCache(path=cache_path)
+            self.assertEqual(app_db.db_stats()["row_count"], 1)
+            version = app_db.data_version()
+            app_db.close()
+            os.remove(os.path.join(temp_dir, "test.db"))
+            recreated = AppDB(os.path.join(temp_dir, "test.db"))
+            recreated.query_cache = QueryCache(path=cache_path)
+            recreated.init_db()
+            recreated.import_report_to_db(next_csv)
+            recreated.import_report_to_db(test_csv)
+            with recreated.writer() as conn:
+                for _ in range(version - recreated.data_version()):
+                    recreated.bump_data_version(conn)
+                conn.commit()
+            self.assertEqual(recreated.data_version(), version)
+            self.assertEqual(recreated.db_stats()["row_count"], 2)
+            self.assertEqual(recreated.query_cache.hits, 0)
+
+    @patch("builtins.print")
+    def test_connection_pool(self, mock_print):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            test_csv = os.path.join(temp_dir, "test.csv")
+            with open(test_csv, "w") as fopen:
+                fopen.writelines(self.sample_csv_lines()[:3])
+
+            app_db = AppDB(os.path.join(temp_dir, "test.db"))
+            app_db.init_db()
+            app_db.import_report_to_db(test_csv)
+            with app_db.reader() as conn:
+                self.assertEqual(conn.execute("PRAGMA journal_mode;").fetchone(), {"journal_mode": "wal"})
+                pooled = conn
+
+            # a reader sees the last commit while the writer holds an open transaction
+            with app_db.writer() as write_conn:
+                write_conn.execute("DELETE FROM ride_data;")
+                self.assertEqual(app_db.query_rows("SELECT COUNT(*) AS n FROM ride_data;"), [{"n": 2}])
+                with app_db.reader() as conn:
+                    self.assertIs(conn, pooled)
+                    with app_db.reader() as other:
+                        self.assertIsNot(other, pooled)
+                write_conn.rollback()
+
+            frame = app_db.query_frame("SELECT TripId, Bike FROM ride_data ORDER BY TripId;")
+            self.assertEqual(list(frame.columns), ["TripId", "Bike"])
+            self.assertEqual(len(frame), 2)
+            self.assertEqual(len(app_db.read_pool), 2)
+            app_db.close()
+            self.assertEqual((app_db.read_pool, app_db.write_conn), ([], None))
+            self.assertEqual(app_db.db_stats()["row_count"], 2)
+
+    def test_flow_matrix(self):
+        import numpy as np
+
+        # Monday 2024-06-03 08:xx twice A -> B, Tuesday 17:xx B -> A
+        epochs = np.array([1717401600, 1717402000, 1717520400])
+        origins, destinations = np.array([0, 0, 1]), np.array([1, 1, 0])
+        dense = FlowMatrix(["A", "B"], origins, destinations, epochs)
+        with patch.object(ride_data, "DENSE_FLOW_CELLS", 0):
+            sparse = FlowMatrix(["A", "B"], origins, destinations, epochs)
+        self.assertIsNotNone(dense.counts)
+        self.assertIsNone(sparse.counts)
+        for each in (dense, sparse):
+            self.assertEqual(each.matrix().tolist(), [[0, 2], [1, 0]])
+            self.assertEqual(each.matrix(weekday=0, hour=8).tolist(), [[0, 2], [0, 0]])
+            self.assertEqual(each.matrix(hour=17).tolist(), [[0, 0], [1, 0]])
+            self.assertEqual(
+                each.net_flows(),
+                [
+                    {"KioskName": "A", "Outflow": 2, "Inflow": 1, "Net": -1},
+                    {"KioskName": "B", "Outflow": 1, "Inflow": 2, "Net": 1},
+                ],
+            )
+
+    def test_bike_timeline(self):
+        import numpy as np
+
+        # bike A: trip 11 starts before trip 10 is back, trip 12 is returned before its checkout
+        timeline = BikeTimeline(
+            ["A", "B"],
+            ["K1", "K2"],
+            trip_ids=np.array([12, 10, 20, 11]),
+            bike_codes=np.array([0, 0, 1, 0]),
+            checkouts=np.array([200, 0, 0, 50]),
+            returns=np.array([150, 100, 10, 60]),
+            return_kiosks=np.array([0, 0, 1, 1]),
+        )
+        self.assertEqual(
+            timeline.bike_rows(),
+            [("A", 3, 110, 100, 100, 0, 200, 200, 0.55, 1, 1, "K1"), ("B", 1, 10, 0, 0, 0, 0, 10, 1.0, 0, 0, "K2")],
+        )
+        self.assertEqual(timeline.idle_rows(), [("A", "K2", 1, 100)])
+        self.assertEqual(timeline.flag_rows(), [("A", 11, "overlap"), ("A", 12, "impossible")])
+
+        appended = BikeTimeline(
+            ["A"],
+            ["K1", "K2"],
+            trip_ids=np.array([13]),
+            bike_codes=np.array([0]),
+            checkouts=np.array([500]),
+            returns=np.array([-1]),
+            return_kiosks=np.array([0]),
+            previous_returns=np.array([200]),
+            previous_kiosks=np.array([1]),
+        )
+        self.assertEqual(appended.bike_rows(), [("A", 1, 0, 300, 300, 500, 500, 500, None, 0, 1, "K1")])
+        self.assertEqual(appended.idle_rows(), [("A", "K2", 1, 300)])
+
+    @patch("builtins.print")
+    def test_bike_timeline_refresh(self, mock_print):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            lines = self.sample_csv_lines()
+            test_csv = os.path.join(temp_dir, "test.csv")
+            with open(test_csv, "w") as fopen:
+                fopen.writelines(lines)
+            next_csv = os.path.join(temp_dir, "next.csv")
+            with open(next_csv, "w") as fopen:
+                fopen.writelines(
+                    [lines[0], lines[1].replace("33567793", "33567900").replace("2024-06-02", "2024-06-03")]
+                )
+
+            app_db = AppDB(os.path.join(temp_dir, "test.db"))
+            app_db.init_db()
+            app_db.import_report_to_db(test_csv)
+            app_db.import_report_to_db(next_csv)
+            bikes = app_db.bike_utilization()
+            self.assertEqual([each["Bike"] for each in bikes], ["11434", "21865"])
+            self.assertEqual((bikes[1]["Trips"], bikes[1]["IdleHours"], bikes[1]["Utilization"]), (2, 24.0, 0.0002))
+            self.assertEqual(
+                app_db.kiosk_idle(),
+                [{"KioskName": "Lauridsen Skatepark", "Gaps": 1, "Bikes": 1, "IdleHours": 24.0, "HoursPerGap": 24.0}],
+            )
+            self.assertEqual(app_db.bike_flags(), [])
+
+            def timeline_tables() -> list:
+                conn = app_db.connect_db(app_db.db_path)
+                tables = [
+                    conn.execute(f"SELECT * FROM {each} ORDER BY 1, 2;").fetchall()
+                    for each in ("bike_timeline", "bike_idle")
+                ]
+                conn.close()
+                return tables
+
+            # the appended trip was merged into the bike's rows, a full rebuild agrees
+            merged = timeline_tables()
+            with app_db.connect_db(app_db.db_path) as conn:
+                app_db.refresh_bike_timeline(conn)
+            conn.close()
+            self.assertEqual(timeline_tables(), merged)
+
+            app_db.delete_rows_by_filename("next.csv")
+            self.assertEqual(app_db.bike_utilization("21865")[0]["Trips"], 1)
+            self.assertEqual(app_db.kiosk_idle(), [])
+
+    def test_sketches(self):
+        import numpy as np
+
+        values = np.array([str(each) for each in range(20_000)], dtype=object)
+        groups = np.repeat([0, 1], 10_000)
+        users = HyperLogLog.from_values(groups, values, 3)
+        estimates = users.estimates()
+        self.assertLess(abs(estimates[0] - 10_000), 10_000 * 4 * 0.0163)
+        self.assertEqual(estimates[2], 0)
+        self.assertEqual(round(HyperLogLog.from_values(np.zeros(3), np.array(["a", "b", "a"]), 1).estimates()[0]), 2)
+
+        # dense and sparse encodings merge into the sketch of the union
+        encoded = users.to_bytes() + HyperLogLog.from_values(np.zeros(2), np.array(["a", "b"]), 1).to_bytes()
+        self.assertEqual([len(each) for each in encoded], [4096, 4096, 0, 6])
+        merged = HyperLogLog.from_bytes([0, 0, 0, 0], encoded, 1).estimates()[0]
+        self.assertEqual(
+            merged, HyperLogLog.from_values(np.zeros(20_002), np.append(values, ["a", "b"]), 1).estimates()[0]
+        )
+
+        durations = np.append(np.arange(1.0, 1001.0), [0.0, -2.0])
+        sketch = QuantileSketch.from_values(np.zeros(len(durations)), durations, 2)
+        # rank floor(0.5 * 1001) of the sorted values is 499
+        self.assertLess(abs(sketch.quantiles(0.5)[0] - 499) / 499, 0.01)
+        self.assertEqual(sketch.quantiles(0.0)[0], 0.0)
+        self.assertTrue(np.isnan(sketch.quantiles(0.5)[1]))
+        halves = [QuantileSketch.from_values(np.zeros(501), part, 1).to_bytes()[0] for part in np.split(durations, 2)]
+        merged = QuantileSketch.from_bytes([0, 0], halves, 1)
+        self.assertEqual(merged.quantiles(0.95)[0], sketch.quantiles(0.95)[0])
+
+    def assert_sketch_rows(self, rows: list, exact: list) -> None:
+        # small distinct counts are exact, quantiles are within 1%
+        self.assertEqual(len(rows), len(exact))
+        for row, exact_row in zip(rows, exact):
+            for name, value in exact_row.items():
+                if name[-3:-2] == "P" and value is not None:
+                    self.assertAlmostEqual(row[name], value, delta=value * 0.01 + 0.005)
+                else:
+                    self.assertEqual(row[name], value)
+
+    @patch("builtins.print")
+    def test_sketch_report(self, mock_print):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            lines = self.sample_csv_lines()
+            test_csv = os.path.join(temp_dir, "test.csv")
+            with open(test_csv, "w") as fopen:
+                fopen.writelines(lines)
+            next_csv = os.path.join(temp_dir, "next.csv")
+            with open(next_csv, "w") as fopen:
+                fopen.writelines(
+                    [
+                        lines[0],
+                        lines[1]
+                        .replace("33567793", "33567900")
+                        .replace("2395732", "2395733")
+                        .replace(",0,0,0,N,.0,", ",12,12,0,N,1.5,")
+                        .replace("2024-06-02", "2024-07-03"),
+                    ]
+                )
+
+            app_db = AppDB(os.path.join(temp_dir, "test.db"))
+            app_db.init_db()
+            app_db.import_report_to_db(test_csv)
+            self.assertEqual(
+                app_db.sketch_report(),
+                [
+                    {
+                        "KioskName": "Lauridsen Skatepark",
+                        "Trips": 2,
+                        "Users": 1,
+                        "Bikes": 2,
+                        "DurationP50": 0.0,
+                        "DurationP95": 0.0,
+                        "DistanceP50": 0.0,
+                        "DistanceP95": 0.0,
+                    }
+                ],
+            )
+
+            # an import refreshes the sketches of its days, sketches merge across days and months
+            app_db.import_report_to_db(next_csv)
+            for group_by in ((), ("Month",), ("Day", "KioskName"), ("MembershipType",)):
+                self.assert_sketch_rows(app_db.sketch_report(group_by), app_db.sketch_report(group_by, exact=True))
+            rows = app_db.sketch_report(())
+            self.assertEqual((rows[0]["Trips"], rows[0]["Users"], rows[0]["Bikes"]), (3, 2, 2))
+            self.assertEqual(rows[0]["DurationP95"], 0.0)
+            self.assertAlmostEqual(
+                app_db.sketch_report(("Month",), start="2024-07-01")[0]["DurationP50"], 12, delta=0.12
+            )
+            with self.assertRaises(ValueError):
+                app_db.sketch_report(("Bike",))
+
+            app_db.delete_rows_by_filename("next.csv")
+            self.assertEqual([each["Trips"] for each in app_db.sketch_report(("Month",))], [2])
+            app_db.import_report_to_db(next_csv)
+            app_db.shard_storage("month")
+            self.assert_sketch_rows(app_db.sketch_report(("Month",)), app_db.sketch_report(("Month",), exact=True))
+            self.assertEqual([each["Users"] for each in app_db.sketch_report(("Month",))], [1, 1])
+
+    @patch("builtins.print")
+    def test_kiosk_flows(self, mock_print):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            lines = self.sample_csv_lines()
+            test_csv = os.path.join(temp_dir, "test.csv")
+            with open(test_csv, "w") as fopen:
+                fopen.writelines(
+                    [lines[0], lines[1].replace("Lauridsen Skatepark,Lauridsen", "Lauridsen Skatepark,Cowles")]
+                )
+            other_csv = os.path.join(temp_dir, "other.csv")
+            with open(other_csv, "w") as fopen:
+                fopen.writelines([lines[0], lines[2]])
+
+            app_db = AppDB(os.path.join(temp_dir, "test.db"))
+            app_db.init_db()
+            app_db.import_report_to_db(test_csv)
+            flows = app_db.kiosk_flows()
+            self.assertEqual(flows.kiosks, ["Cowles Skatepark", "Lauridsen Skatepark"])
+            self.assertEqual(flows.matrix().tolist(), [[0, 0], [1, 0]])
+            self.assertIs(app_db.kiosk_flows(), flows)
+
+            # a new import changes the data version, the cached matrix is rebuilt
+            app_db.import_report_to_db(other_csv)
+            self.assertEqual(app_db.kiosk_flows().matrix().tolist(), [[0, 0], [1, 1]])
+            self.assertEqual(app_db.kiosk_flows("2024-06-03").trips, 0)
+
+            app_db.normalize_storage()
+            flows = app_db.kiosk_flows()
+            self.assertEqual(flows.kiosks, ["Cowles Skatepark", "Lauridsen Skatepark"])
+            self.assertEqual(
+                flows.net_flows(weekday=6, hour=16)[0],
+                {"KioskName": "Lauridsen Skatepark", "Outflow": 2, "Inflow": 1, "Net": -1},
+            )
+
+    @patch("builtins.print")
+    def test_shard_storage(self, mock_print):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            lines = self.sample_csv_lines()
+            test_csv = os.path.join(temp_dir, "test.csv")
+            with open(test_csv, "w") as fopen:
+                fopen.writelines([*lines, lines[1].replace("33567793", "33567900").replace("2024-06-02", "2023-12-31")])
+            next_csv = os.path.join(temp_dir, "next.csv")
+            with open(next_csv, "w") as fopen:
+                fopen.writelines(
+                    [lines[0], lines[2].replace("33567803", "33567901").replace("2024-06-02", "2025-01-05")]
+                )
+
+            plain = AppDB(os.path.join(temp_dir, "plain.db"))
+            app_db = AppDB(os.path.join(temp_dir, "test.db"))
+            for each in (plain, app_db):
+                each.init_db()
+                each.import_report_to_db(test_csv)
+            summary = app_db.shard_storage("year")
+            self.assertEqual((summary["rows"], summary["shards"]), (3, ["2023", "2024"]))
+            self.assertEqual(app_db.query_rows("SELECT COUNT(*) AS n FROM ride_data;"), [{"n": 0}])
+            self.assertTrue(os.path.exists(os.path.join(temp_dir, "test.shards", "ride_2023.db")))
+
+            # imports are routed by checkout year, stats and reports are gathered from the shards
+            for each in (plain, app_db):
+                each.import_report_to_db(next_csv)
+            self.assertEqual(app_db.shard_keys(), ["2023", "2024", "2025"])
+            self.assertEqual(app_db.shard_keys(*AppDB.shard_bounds("2024")), ["2024"])
+            # the shard databases are created quietly
+            initialized = [each for each in mock_print.call_args_list if each.args == ("# Intializing database",)]
+            self.assertEqual(len(initialized), 2)
+            for name in ("row_count", "file_count", "min_date", "max_date"):
+                self.assertEqual(app_db.db_stats()[name], plain.db_stats()[name])
+            self.assertEqual(app_db.rollup_report("daily"), plain.rollup_report("daily"))
+            self.assertEqual(app_db.bike_utilization(), plain.bike_utilization())
+            output = io.StringIO()
+            self.assertEqual(app_db.export_rows(output, "2023-12-01", "2024-06-02"), 3)
+
+            # a frozen shard refuses imports and deletes until it is thawed
+            app_db.freeze_shard("2023")
+            self.assertEqual([each["frozen"] for each in app_db.shard_list()], [True, False, False])
+            self.assertEqual(app_db.import_report_to_db(test_csv, force=True), {})
+            self.assertEqual(app_db.delete_rows_by_date_range("2023-12-01", "2023-12-31"), {})
+            app_db.freeze_shard("2023", frozen=False)
+            self.assertEqual(app_db.delete_rows_by_date_range("2023-12-01", "2023-12-31")["rows"], 1)
+            self.assertEqual(app_db.db_stats()["row_count"], 3)
+            self.assertEqual(app_db.compact_shard("2023")["shard"], "2023")
+            with self.assertRaises(ValueError):
+                app_db.freeze_shard("2022")
+
+            # a re-imported trip whose checkout moved year leaves no copy in its old shard
+            moved_csv = os.path.join(temp_dir, "moved.csv")
+            with open(moved_csv, "w") as fopen:
+                fopen.writelines(
+                    [lines[0], lines[2].replace("33567803", "33567901").replace("2024-06-02", "2024-12-30")]
+                )
+            plain.delete_rows_by_date_range("2023-12-01", "2023-12-31")
+            for each in (plain, app_db):
+                each.import_report_to_db(moved_csv)
+            self.assertEqual(app_db.db_stats()["row_count"], plain.db_stats()["row_count"])
+            self.assertEqual(app_db.rollup_report("daily"), plain.rollup_report("daily"))
+            self.assertEqual(app_db.shard("2025").query_rows("SELECT COUNT(*) AS n FROM ride_data;"), [{"n": 0}])
+
+    @patch("builtins.print")
+    def test_shard_storage_many_shards(self, mock_print):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            lines = self.sample_csv_lines()
+            test_csv = os.path.join(temp_dir, "test.csv")
+            with open(test_csv, "w") as fopen:
+                fopen.write(lines[0])
+                for month in range(1, 13):
+                    fopen.write(
+                        lines[1]
+                        .replace("33567793", f"335678{month:02d}")
+                        .replace("2024-06-02", f"2024-{month:02d}-02")
+                        .replace("Lauridsen Skatepark,0", f"Kiosk {month % 3},0")
+                    )
+
+            plain = AppDB(os.path.join(temp_dir, "plain.db"))
+            app_db = AppDB(os.path.join(temp_dir, "test.db"))
+            for each in (plain, app_db):
+                each.init_db()
+                each.import_report_to_db(test_csv)
+            self.assertEqual(len(app_db.shard_storage("month")["shards"]), 12)
+
+            # more shards than can be attached at once, read a batch of them at a time
+            output = io.StringIO()
+            self.assertEqual(app_db.export_rows(output, "2024-01-01", "2024-12-31"), 12)
+            self.assertEqual(len(output.getvalue().splitlines()), 13)
+            flows = app_db.kiosk_flows("2024-01-01", "2024-12-31")
+            self.assertEqual(flows.kiosks, plain.kiosk_flows("2024-01-01", "2024-12-31").kiosks)
+            self.assertEqual(flows.matrix().tolist(), plain.kiosk_flows("2024-01-01", "2024-12-31").matrix().tolist())
+            app_db.set_date_range("2024-01-01", "2024-12-31")
+            self.assertEqual(app_db.query_range("SELECT COUNT(*) AS cnt FROM {table};")[0]["cnt"], 12)
+            self.assertEqual(app_db.archive_parquet(os.path.join(temp_dir, "archive"))["rows"], 12)
+
+            # the copied range is rebuilt once the data changes
+            app_db.delete_rows_by_date_range("2024-03-01", "2024-03-31")
+            self.assertEqual(app_db.query_range("SELECT COUNT(*) AS cnt FROM {table};")[0]["cnt"], 11)
+            app_db.set_date_range("2024-01-01", "2024-02-28")
+            self.assertEqual(app_db.query_range("SELECT COUNT(*) AS cnt FROM {table};")[0]["cnt"], 2)
+
+            # a failing shard stops the delete, the shards before it are reported and the data version bumped
+            version = app_db.data_version()
+            with patch.object(app_db.shard("2024-04"), "delete_rows", return_value={}):
+                summary = app_db.delete_rows_by_date_range("2024-01-01", "2024-06-30")
+            self.assertEqual((summary["rows"], summary["error"]), (2, "shard 2024-04 | delete failed"))
+            self.assertEqual(app_db.data_version(), version + 1)
+            self.assertEqual(app_db.db_stats()["row_count"], 9)
+
+            # a TripId repeated in a later chunk is found in the shard an earlier chunk loaded it to
+            repeated_csv = os.path.join(temp_dir, "repeated.csv")
+            repeated = lines[1].replace("33567793", "33569999").replace("2024-06-02", "2024-08-09")
+            with open(repeated_csv, "w") as fopen:
+                fopen.writelines([lines[0], repeated, repeated.replace("2024-08-09", "2024-09-09")])
+            summary = app_db.import_report_to_db(repeated_csv, chunk_size=1, stream=True)
+            self.assertEqual((summary["rows"], summary["quarantined"]), (1, {"duplicate_trip_id": 1}))
+
+    @patch("builtins.print")
+    def test_import_reports_none_found(self, mock_print):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            app_db = AppDB(os.path.join(temp_dir, "test.db"))
+            self.assertEqual(app_db.import_reports(temp_dir), [])
+            mock_print.assert_called_with(f"\n# No reports found | {temp_dir}")
+
     @patch("builtins.print")
     def test_import_report_to_db_no_table(self, mock_print):
         with tempfile.TemporaryDirectory() as temp_dir:
@@ -172,8 +1367,117 @@ class TestAppDB(unittest.TestCase):
 
 
 class TestApp(unittest.TestCase):
+    def sample_csv_lines(self) -> list:
+        return TestAppDB.sample_csv_lines(self)
+
+    def run_command(self, db_path: str, *argv: str) -> tuple:
+        output = io.StringIO()
+        with patch("sys.stderr", io.StringIO()):
+            exit_code = App(db_path).run_command(app_args().parse_args(["--db-path", db_path, *argv]), output)
+        return exit_code, output.getvalue()
+
+    def test_run_command(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            test_csv = os.path.join(temp_dir, "test.csv")
+            with open(test_csv, "w") as fopen:
+                fopen.writelines(self.sample_csv_lines())
+            temp_db = os.path.join(temp_dir, "test.db")
+
+            exit_code, output = self.run_command(temp_db, "import", test_csv)
+            self.assertEqual((exit_code, json.loads(output)[0]["status"]), (0, "imported"))
+            exit_code, output = self.run_command(temp_db, "stats", "--files", "--quarantine")
+            self.assertEqual(json.loads(output)["stats"]["row_count"], 2)
+            self.assertEqual(json.loads(output)["quarantine"], [])
+            self.assertEqual(json.loads(output)["files"][0]["FileName"], "test.csv")
+            exit_code, output = self.run_command(temp_db, "report", "daily", "--start", "2024-06-01")
+            self.assertEqual(json.loads(output)[0]["Trips"], 2)
+            exit_code, output = self.run_command(temp_db, "sketch", "--by", "Month", "--exact")
+            self.assertEqual(json.loads(output)[0]["Users"], 1)
+            exit_code, output = self.run_command(temp_db, "flows", "--hour", "16", "--matrix")
+            self.assertEqual(json.loads(output)["matrix"], [[2]])
+            exit_code, output = self.run_command(temp_db, "bikes", "--kiosks", "--flags")
+            self.assertEqual(len(json.loads(output)["bikes"]), 2)
+            self.assertEqual((json.loads(output)["kiosks"], json.loads(output)["flags"]), ([], []))
+
+            exit_code, output = self.run_command(temp_db, "export", "--end", "2024-06-02")
+            rows = list(csv.DictReader(io.StringIO(output)))
+            self.assertEqual([each["TripId"] for each in rows], ["33567793", "33567803"])
+            exit_code, output = self.run_command(temp_db, "export", "--format", "jsonl", "--start", "2024-06-03")
+            self.assertEqual(output, "")
+
+            with self.assertRaises(SystemExit):
+                self.run_command(temp_db, "delete", "--file", "test.csv", "--end", "2024-06-02")
+            with self.assertRaises(SystemExit):
+                self.run_command(temp_db, "delete")
+            exit_code, output = self.run_command(temp_db, "delete", "--end", "2024-06-01")
+            self.assertEqual((exit_code, json.loads(output)["rows"]), (0, 0))
+            exit_code, output = self.run_command(temp_db, "delete", "--file", "test.csv")
+            self.assertEqual((exit_code, json.loads(output)["rows"]), (0, 2))
+            exit_code, output = self.run_command(temp_db, "import", os.path.join(temp_dir, "missing"))
+            self.assertEqual(exit_code, 1)
+
+    def test_run_shards(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            test_csv = os.path.join(temp_dir, "test.csv")
+            with open(test_csv, "w") as fopen:
+                fopen.writelines(self.sample_csv_lines())
+            temp_db = os.path.join(temp_dir, "test.db")
+
+            self.run_command(temp_db, "import", test_csv)
+            exit_code, output = self.run_command(temp_db, "shards", "--by", "month", "--freeze", "2024-06")
+            result = json.loads(output)
+            self.assertEqual((exit_code, result["sharded"]["rows"]), (0, 2))
+            self.assertEqual(
+                [(each["shard"], each["row_count"], each["frozen"]) for each in result["shards"]],
+                [("2024-06", 2, True)],
+            )
+            exit_code, output = self.run_command(temp_db, "report", "daily", "--start", "2024-06-01")
+            self.assertEqual(json.loads(output)[0]["Trips"], 2)
+            exit_code, output = self.run_command(temp_db, "shards", "--by", "year")
+            self.assertEqual(exit_code, 1)
+            exit_code, output = self.run_command(temp_db, "shards", "--thaw", "2024-05")
+            self.assertEqual(exit_code, 1)
+
+    def test_run_trace(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            test_csv = os.path.join(temp_dir, "test.csv")
+            with open(test_csv, "w") as fopen:
+                fopen.writelines(self.sample_csv_lines())
+            temp_db = os.path.join(temp_dir, "test.db")
+            trace_path = os.path.join(temp_dir, "trace.jsonl")
+
+            command = [sys.executable, "ride_data.py", "--db-path", temp_db, "--trace", trace_path, "import", test_csv]
+            result = subprocess.run(command, capture_output=True, text=True, cwd=os.path.dirname(__file__) or ".")
+            self.assertEqual(result.returncode, 0)
+            self.assertIn("execute", json.loads(result.stdout)[0]["stages"])
+            with open(trace_path) as fopen:
+                events = {json.loads(line)["event"] for line in fopen}
+            self.assertEqual(events, {"stage", "query"})
+
+    def test_app_args_invalid_date(self):
+        with patch("sys.stderr", io.StringIO()), self.assertRaises(SystemExit):
+            app_args().parse_args(["report", "daily", "--start", "06/01/2024"])
+
+    def test_lazy_heavy_imports(self):
+        check = "import sys, ride_data; print(sorted({'pandas', 'pendulum'} & set(sys.modules)))"
+        result = subprocess.run(
+            [sys.executable, "-c", check], capture_output=True, text=True, cwd=os.path.dirname(__file__)
+        )
+        self.assertEqual(result.stdout.strip(), "[]")
+
+    @patch("builtins.print")
+    def test_print_table(self, mock_print):
+        App.print_table([{"Day": "2024-06-02", "Trips": 12}, {"Day": "2024-06-03", "Trips": 7}])
+        self.assertEqual(
+            [each.args[0] for each in mock_print.call_args_list],
+            ["\nDay         Trips", "----------  -----", "2024-06-02  12", "2024-06-03  7"],
+        )
+
+    @patch("builtins.print")
+    def test_print_table_empty(self, mock_print):
+        App.print_table([])
+        mock_print.assert_called_with("\n# No rows")
 
-    pass
 
 if __name__ == "__main__":
     unittest.main()